@@ -0,0 +1,414 @@
+# analytics.py - аналитика смены: ожидание в очереди, обеды, длина очереди
+"""
+Сырые события лежат в queue_exits (кто, когда встал и когда вышел из очереди),
+queue (кто стоит сейчас) и lunch_sessions. Дашборды читают только почасовые
+агрегаты analytics_*_hourly, которые refresh_rollups() дополняет инкрементально:
+у каждого агрегата есть водяной знак в analytics_state, и за один прогон
+обрабатываются только события между ним и текущим моментом (по индексам).
+
+Все функции принимают курсор psycopg2 (RealDictCursor) и ничего не коммитят сами.
+"""
+from datetime import timedelta, timezone
+
+# Причины выхода из очереди, которые означают "дождался" (забрал заказ / отпустила касса).
+# Уход на обед и ночная очистка ожиданием не считаются.
+SERVED_REASONS = ("left", "removed")
+
+# Границы гистограммы ожидания, минуты (последняя корзина - всё, что дольше)
+WAIT_BUCKETS = (5, 10, 20, 30, 60)
+
+# Ключ advisory-блокировки: агрегаты аддитивны, два одновременных прогона задвоили бы данные
+REFRESH_LOCK_KEY = 4_203_401
+
+# Отступ от "сейчас": транзакции, начатые чуть раньше, ещё могут дописывать события
+SETTLE = timedelta(minutes=1)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS queue_exits (
+        tg_id BIGINT NOT NULL,
+        join_time TIMESTAMPTZ NOT NULL,
+        exit_time TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        reason TEXT NOT NULL -- 'left', 'removed', 'lunch', 'daily_clear'
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS queue_exits_exit_time_idx ON queue_exits (exit_time)",
+    "CREATE INDEX IF NOT EXISTS queue_exits_join_time_idx ON queue_exits (join_time)",
+    "CREATE INDEX IF NOT EXISTS queue_join_time_idx ON queue (join_time)",
+    "CREATE INDEX IF NOT EXISTS lunch_sessions_end_time_idx ON lunch_sessions (end_time)",
+    """
+    CREATE TABLE IF NOT EXISTS analytics_state (
+        name TEXT PRIMARY KEY,
+        watermark TIMESTAMPTZ NOT NULL
+    )
+    """,
+    # Ожидание: по часу входа в очередь
+    """
+    CREATE TABLE IF NOT EXISTS analytics_wait_hourly (
+        hour TIMESTAMPTZ PRIMARY KEY,
+        served INT NOT NULL,
+        wait_sum DOUBLE PRECISION NOT NULL,
+        wait_max DOUBLE PRECISION NOT NULL,
+        b5 INT NOT NULL, b10 INT NOT NULL, b20 INT NOT NULL,
+        b30 INT NOT NULL, b60 INT NOT NULL, b_inf INT NOT NULL
+    )
+    """,
+    # Обеды: по часу начала обеда и курьеру
+    """
+    CREATE TABLE IF NOT EXISTS analytics_lunch_hourly (
+        hour TIMESTAMPTZ NOT NULL,
+        tg_id BIGINT NOT NULL,
+        sessions INT NOT NULL,
+        duration_sum DOUBLE PRECISION NOT NULL,
+        duration_max DOUBLE PRECISION NOT NULL,
+        overruns INT NOT NULL,
+        overrun_sum DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (hour, tg_id)
+    )
+    """,
+    # Длина очереди: по часам, только завершённые часы
+    """
+    CREATE TABLE IF NOT EXISTS analytics_queue_hourly (
+        hour TIMESTAMPTZ PRIMARY KEY,
+        joins INT NOT NULL,
+        exits INT NOT NULL,
+        length_max INT NOT NULL,
+        length_end INT NOT NULL
+    )
+    """,
+]
+
+
+def init_schema(cur):
+    for statement in SCHEMA:
+        cur.execute(statement)
+
+
+def _watermark(cur, name, default_sql):
+    cur.execute("SELECT watermark FROM analytics_state WHERE name = %s", (name,))
+    row = cur.fetchone()
+    if row:
+        return row['watermark']
+    cur.execute(f"SELECT ({default_sql}) AS watermark")
+    return cur.fetchone()['watermark']
+
+
+def _set_watermark(cur, name, value):
+    cur.execute("""
+        INSERT INTO analytics_state (name, watermark) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark
+    """, (name, value))
+
+
+def _refresh_wait(cur, cutoff):
+    wm = _watermark(cur, "wait", "SELECT COALESCE(MIN(exit_time), NOW()) FROM queue_exits")
+    if wm >= cutoff:
+        return 0
+    b5, b10, b20, b30, b60 = (m * 60 for m in WAIT_BUCKETS)
+    cur.execute("""
+        INSERT INTO analytics_wait_hourly AS a
+            (hour, served, wait_sum, wait_max, b5, b10, b20, b30, b60, b_inf)
+        SELECT date_trunc('hour', join_time), COUNT(*), SUM(w), MAX(w),
+               COUNT(*) FILTER (WHERE w < %(b5)s),
+               COUNT(*) FILTER (WHERE w >= %(b5)s AND w < %(b10)s),
+               COUNT(*) FILTER (WHERE w >= %(b10)s AND w < %(b20)s),
+               COUNT(*) FILTER (WHERE w >= %(b20)s AND w < %(b30)s),
+               COUNT(*) FILTER (WHERE w >= %(b30)s AND w < %(b60)s),
+               COUNT(*) FILTER (WHERE w >= %(b60)s)
+        FROM (
+            SELECT join_time, EXTRACT(EPOCH FROM exit_time - join_time) AS w
+            FROM queue_exits
+            WHERE exit_time >= %(wm)s AND exit_time < %(cutoff)s AND reason IN %(reasons)s
+        ) e
+        GROUP BY 1
+        ON CONFLICT (hour) DO UPDATE SET
+            served = a.served + EXCLUDED.served,
+            wait_sum = a.wait_sum + EXCLUDED.wait_sum,
+            wait_max = GREATEST(a.wait_max, EXCLUDED.wait_max),
+            b5 = a.b5 + EXCLUDED.b5, b10 = a.b10 + EXCLUDED.b10, b20 = a.b20 + EXCLUDED.b20,
+            b30 = a.b30 + EXCLUDED.b30, b60 = a.b60 + EXCLUDED.b60, b_inf = a.b_inf + EXCLUDED.b_inf
+    """, {"wm": wm, "cutoff": cutoff, "reasons": SERVED_REASONS,
+          "b5": b5, "b10": b10, "b20": b20, "b30": b30, "b60": b60})
+    changed = cur.rowcount
+    _set_watermark(cur, "wait", cutoff)
+    return changed
+
+
+def _refresh_lunch(cur, cutoff, lunch_limit_seconds):
+    wm = _watermark(cur, "lunch", "SELECT COALESCE(MIN(end_time), NOW()) FROM lunch_sessions")
+    if wm >= cutoff:
+        return 0
+    cur.execute("""
+        INSERT INTO analytics_lunch_hourly AS a
+            (hour, tg_id, sessions, duration_sum, duration_max, overruns, overrun_sum)
+        SELECT date_trunc('hour', start_time), tg_id, COUNT(*), SUM(d), MAX(d),
+               COUNT(*) FILTER (WHERE d > allowed), SUM(GREATEST(d - allowed, 0))
+        FROM (
+            SELECT tg_id, start_time, EXTRACT(EPOCH FROM end_time - start_time) AS d,
+                   COALESCE(allowed_seconds, %(limit)s) AS allowed
+            FROM lunch_sessions
+            WHERE end_time >= %(wm)s AND end_time < %(cutoff)s
+              -- обед не длится неделями: ограничение по start_time сужает просмотр
+              AND start_time >= %(wm)s - INTERVAL '7 days'
+        ) s
+        GROUP BY 1, 2
+        ON CONFLICT (hour, tg_id) DO UPDATE SET
+            sessions = a.sessions + EXCLUDED.sessions,
+            duration_sum = a.duration_sum + EXCLUDED.duration_sum,
+            duration_max = GREATEST(a.duration_max, EXCLUDED.duration_max),
+            overruns = a.overruns + EXCLUDED.overruns,
+            overrun_sum = a.overrun_sum + EXCLUDED.overrun_sum
+    """, {"wm": wm, "cutoff": cutoff, "limit": lunch_limit_seconds})
+    changed = cur.rowcount
+    _set_watermark(cur, "lunch", cutoff)
+    return changed
+
+
+def _refresh_queue_length(cur, cutoff):
+    """Длина очереди по завершённым часам: бегущая сумма входов (+1) и выходов (-1)."""
+    hour_cutoff = cutoff.replace(minute=0, second=0, microsecond=0)
+    wm = _watermark(cur, "queue", "SELECT date_trunc('hour', COALESCE(MIN(join_time), NOW())) FROM queue_exits")
+    if wm >= hour_cutoff:
+        return 0
+    # Длина очереди в момент wm: вошли раньше wm и к wm ещё не вышли
+    cur.execute("""
+        SELECT (SELECT COUNT(*) FROM queue WHERE join_time < %(wm)s)
+             + (SELECT COUNT(*) FROM queue_exits WHERE exit_time >= %(wm)s AND join_time < %(wm)s) AS base
+    """, {"wm": wm})
+    base = cur.fetchone()['base']
+    cur.execute("""
+        WITH ev AS (
+            SELECT join_time AS t, 1 AS d FROM queue_exits
+            WHERE join_time >= %(wm)s AND join_time < %(cutoff)s
+            UNION ALL
+            SELECT exit_time, -1 FROM queue_exits
+            WHERE exit_time >= %(wm)s AND exit_time < %(cutoff)s
+            UNION ALL
+            SELECT join_time, 1 FROM queue
+            WHERE join_time >= %(wm)s AND join_time < %(cutoff)s
+        ), running AS (
+            SELECT t, d, %(base)s + SUM(d) OVER (ORDER BY t, d DESC ROWS UNBOUNDED PRECEDING) AS len
+            FROM ev
+        )
+        SELECT date_trunc('hour', t) AS hour,
+               COUNT(*) FILTER (WHERE d = 1) AS joins,
+               COUNT(*) FILTER (WHERE d = -1) AS exits,
+               MAX(len) AS length_max,
+               (ARRAY_AGG(len ORDER BY t DESC, d))[1] AS length_end
+        FROM running
+        GROUP BY 1
+    """, {"wm": wm, "cutoff": hour_cutoff, "base": base})
+    by_hour = {row['hour']: row for row in cur.fetchall()}
+
+    # Часы без событий тоже пишем: длина очереди в них постоянна
+    rows = []
+    length = base
+    hour = wm
+    while hour < hour_cutoff:
+        row = by_hour.get(hour)
+        if row:
+            rows.append((hour, row['joins'], row['exits'], max(length, row['length_max']), row['length_end']))
+            length = row['length_end']
+        else:
+            rows.append((hour, 0, 0, length, length))
+        hour += timedelta(hours=1)
+    cur.executemany("""
+        INSERT INTO analytics_queue_hourly (hour, joins, exits, length_max, length_end)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (hour) DO NOTHING
+    """, rows)
+    _set_watermark(cur, "queue", hour_cutoff)
+    return len(rows)
+
+
+def refresh_rollups(cur, lunch_limit_seconds=20 * 60):
+    """Дополняет все агрегаты событиями после их водяных знаков. Возвращает
+    {агрегат: число изменённых строк} или None, если прогон уже идёт в другом процессе.
+    Перерасход обеда считается от allowed_seconds сессии; lunch_limit_seconds -
+    только для старых сессий, где он не записан."""
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (REFRESH_LOCK_KEY,))
+    if not cur.fetchone()['locked']:
+        return None
+    cur.execute("SELECT NOW() AS now")
+    cutoff = cur.fetchone()['now'] - SETTLE
+    return {
+        "wait": _refresh_wait(cur, cutoff),
+        "lunch": _refresh_lunch(cur, cutoff, lunch_limit_seconds),
+        "queue": _refresh_queue_length(cur, cutoff),
+    }
+
+
+def reaggregate(cur, since, lunch_limit_seconds=20 * 60):
+    """Пересчитывает агрегаты с часа since - для событий, задним числом вставленных
+    за водяные знаки (проигрывание журнала после недоступности базы). Часы, в
+    которые такие события попадают, удаляются и собираются заново из сырых
+    событий - до текущих водяных знаков; дальше их, как обычно, дополнит refresh_rollups."""
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (REFRESH_LOCK_KEY,))
+    # Ожидание и длина очереди считаются и по часу входа: берём и вышедших позже
+    # since, но вставших раньше
+    cur.execute("""
+        SELECT date_trunc('hour', LEAST(%(since)s, MIN(join_time))) AS hour
+        FROM queue_exits WHERE exit_time >= %(since)s
+    """, {"since": since})
+    queue_hour = hour = cur.fetchone()['hour']
+    cur.execute("SELECT watermark FROM analytics_state WHERE name = 'wait'")
+    row = cur.fetchone()
+    if row and row['watermark'] > hour:
+        b5, b10, b20, b30, b60 = (m * 60 for m in WAIT_BUCKETS)
+        cur.execute("DELETE FROM analytics_wait_hourly WHERE hour >= %s", (hour,))
+        cur.execute("""
+            INSERT INTO analytics_wait_hourly
+                (hour, served, wait_sum, wait_max, b5, b10, b20, b30, b60, b_inf)
+            SELECT date_trunc('hour', join_time), COUNT(*), SUM(w), MAX(w),
+                   COUNT(*) FILTER (WHERE w < %(b5)s),
+                   COUNT(*) FILTER (WHERE w >= %(b5)s AND w < %(b10)s),
+                   COUNT(*) FILTER (WHERE w >= %(b10)s AND w < %(b20)s),
+                   COUNT(*) FILTER (WHERE w >= %(b20)s AND w < %(b30)s),
+                   COUNT(*) FILTER (WHERE w >= %(b30)s AND w < %(b60)s),
+                   COUNT(*) FILTER (WHERE w >= %(b60)s)
+            FROM (
+                SELECT join_time, EXTRACT(EPOCH FROM exit_time - join_time) AS w
+                FROM queue_exits
+                WHERE join_time >= %(hour)s AND exit_time >= %(hour)s AND exit_time < %(wm)s
+                  AND reason IN %(reasons)s
+            ) e
+            GROUP BY 1
+        """, {"hour": hour, "wm": row['watermark'], "reasons": SERVED_REASONS,
+              "b5": b5, "b10": b10, "b20": b20, "b30": b30, "b60": b60})
+
+    # Обеды - по часу начала
+    cur.execute("""
+        SELECT date_trunc('hour', LEAST(%(since)s, MIN(start_time))) AS hour
+        FROM lunch_sessions WHERE end_time >= %(since)s AND start_time >= %(since)s - INTERVAL '7 days'
+    """, {"since": since})
+    hour = cur.fetchone()['hour']
+    cur.execute("SELECT watermark FROM analytics_state WHERE name = 'lunch'")
+    row = cur.fetchone()
+    if row and row['watermark'] > hour:
+        cur.execute("DELETE FROM analytics_lunch_hourly WHERE hour >= %s", (hour,))
+        cur.execute("""
+            INSERT INTO analytics_lunch_hourly
+                (hour, tg_id, sessions, duration_sum, duration_max, overruns, overrun_sum)
+            SELECT date_trunc('hour', start_time), tg_id, COUNT(*), SUM(d), MAX(d),
+                   COUNT(*) FILTER (WHERE d > allowed), SUM(GREATEST(d - allowed, 0))
+            FROM (
+                SELECT tg_id, start_time, EXTRACT(EPOCH FROM end_time - start_time) AS d,
+                       COALESCE(allowed_seconds, %(limit)s) AS allowed
+                FROM lunch_sessions
+                WHERE start_time >= %(hour)s AND end_time >= %(hour)s AND end_time < %(wm)s
+            ) s
+            GROUP BY 1, 2
+        """, {"hour": hour, "wm": row['watermark'], "limit": lunch_limit_seconds})
+
+    # Длину очереди refresh_rollups пересобирает сама: часы удаляем, знак переводим назад
+    cur.execute("SELECT watermark FROM analytics_state WHERE name = 'queue'")
+    row = cur.fetchone()
+    if row and row['watermark'] > queue_hour:
+        cur.execute("DELETE FROM analytics_queue_hourly WHERE hour >= %s", (queue_hour,))
+        _set_watermark(cur, "queue", queue_hour)
+
+
+# === ОТЧЁТЫ ===
+def _range_params(date_from, date_to, tz):
+    return {"from": date_from, "to": date_to, "tz": tz}
+
+_RANGE = ("hour >= (%(from)s::date)::timestamp AT TIME ZONE %(tz)s "
+          "AND hour < (%(to)s::date + 1)::timestamp AT TIME ZONE %(tz)s")
+
+
+def _approx_percentile(buckets, total, p):
+    """Верхняя граница корзины гистограммы, в которую попадает перцентиль p (минуты);
+    None - перцентиль в последней, открытой корзине."""
+    if not total:
+        return None
+    need = total * p
+    seen = 0
+    for bound, count in zip(WAIT_BUCKETS + (None,), buckets):
+        seen += count
+        if seen >= need:
+            return bound
+    return None
+
+
+def wait_by_hour_of_day(cur, date_from, date_to, tz):
+    """Ожидание в очереди по часу дня (местное время) за период."""
+    cur.execute(f"""
+        SELECT EXTRACT(HOUR FROM hour AT TIME ZONE %(tz)s)::int AS hour_of_day,
+               SUM(served)::int AS served, SUM(wait_sum) AS wait_sum, MAX(wait_max) AS wait_max,
+               SUM(b5)::int AS b5, SUM(b10)::int AS b10, SUM(b20)::int AS b20,
+               SUM(b30)::int AS b30, SUM(b60)::int AS b60, SUM(b_inf)::int AS b_inf
+        FROM analytics_wait_hourly
+        WHERE {_RANGE}
+        GROUP BY 1
+        ORDER BY 1
+    """, _range_params(date_from, date_to, tz))
+    result = []
+    labels = [f"<{WAIT_BUCKETS[0]}"] + [f"{a}-{b}" for a, b in zip(WAIT_BUCKETS, WAIT_BUCKETS[1:])] + [f">={WAIT_BUCKETS[-1]}"]
+    for row in cur.fetchall():
+        buckets = [row['b5'], row['b10'], row['b20'], row['b30'], row['b60'], row['b_inf']]
+        served = row['served']
+        result.append({
+            "hour": row['hour_of_day'],
+            "served": served,
+            "avg_wait_minutes": round(row['wait_sum'] / served / 60, 1) if served else None,
+            "max_wait_minutes": round(row['wait_max'] / 60, 1),
+            "p50_minutes_le": _approx_percentile(buckets, served, 0.5),
+            "p90_minutes_le": _approx_percentile(buckets, served, 0.9),
+            "histogram_minutes": dict(zip(labels, buckets)),
+        })
+    return result
+
+
+def lunch_summary(cur, date_from, date_to, tz):
+    """Обеды за период: итоги и курьеры, превышавшие длительность обеда."""
+    cur.execute(f"""
+        SELECT l.tg_id, c.name,
+               SUM(l.sessions)::int AS sessions, SUM(l.duration_sum) AS duration_sum,
+               MAX(l.duration_max) AS duration_max, SUM(l.overruns)::int AS overruns,
+               SUM(l.overrun_sum) AS overrun_sum
+        FROM analytics_lunch_hourly l
+        LEFT JOIN couriers c ON c.tg_id = l.tg_id
+        WHERE {_RANGE.replace('hour', 'l.hour')}
+        GROUP BY l.tg_id, c.name
+        ORDER BY overruns DESC, overrun_sum DESC
+    """, _range_params(date_from, date_to, tz))
+    couriers = []
+    totals = {"sessions": 0, "duration_sum": 0.0, "overruns": 0}
+    for row in cur.fetchall():
+        totals["sessions"] += row['sessions']
+        totals["duration_sum"] += row['duration_sum']
+        totals["overruns"] += row['overruns']
+        couriers.append({
+            "tg_id": row['tg_id'],
+            "name": row['name'],
+            "sessions": row['sessions'],
+            "avg_minutes": round(row['duration_sum'] / row['sessions'] / 60, 1),
+            "max_minutes": round(row['duration_max'] / 60, 1),
+            "overruns": row['overruns'],
+            "overrun_minutes": round(row['overrun_sum'] / 60, 1),
+        })
+    sessions = totals["sessions"]
+    return {
+        "sessions": sessions,
+        "avg_minutes": round(totals["duration_sum"] / sessions / 60, 1) if sessions else None,
+        "overruns": totals["overruns"],
+        "couriers": couriers,
+    }
+
+
+def queue_length_series(cur, date_from, date_to, tz):
+    """Длина очереди по часам за период (только завершённые часы)."""
+    cur.execute(f"""
+        SELECT hour, joins, exits, length_max, length_end
+        FROM analytics_queue_hourly
+        WHERE {_RANGE}
+        ORDER BY hour
+    """, _range_params(date_from, date_to, tz))
+    return [{
+        "hour": row['hour'].astimezone(timezone.utc).isoformat(),
+        "joins": row['joins'],
+        "exits": row['exits'],
+        "length_max": row['length_max'],
+        "length_end": row['length_end'],
+    } for row in cur.fetchall()]
+
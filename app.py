@@ -1,27 +1,62 @@
 # app.py - чистый aiohttp сервер с Telegram ботом (только API и касса)
 import asyncio
+import base64
+import binascii
+import contextvars
+import csv
+import functools
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
+import select
+import signal
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 from zoneinfo import ZoneInfo
 from typing import Union
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiogram.exceptions import TelegramBadRequest
-from aiohttp import web
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Update
+from aiogram.webhook.aiohttp_server import setup_application
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientError, ClientSession, ClientTimeout, UnixConnector, web
 from aiohttp.web import Request, Response
-from datetime import datetime, timedelta
-# --- Добавляем aiocron ---
-import aiocron
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+from datetime import datetime, timedelta, timezone
+import analytics
+import broadcast
+import retention
+import roster
+import journal
+import logsetup
+import lunch_policy
+import queue_order
+import traffic
+from records import Courier, LogEntry, LunchSession, QueueEntry, fetch_all, fetch_one, tuple_cursor
+# aiocron импортируется лениво при запуске планировщика (см. start_scheduler)
+
+# Настройка логирования: хендлеры только кладут записи в очередь, форматирует и
+# пишет их фоновый поток (см. logsetup.py)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# json - по строке JSON на запись, text - прежний формат logging по умолчанию
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Шумные логгеры: "имя=N" - писать одну INFO-запись из N (WARNING и выше - всегда)
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "aiogram.event=10,aiohttp.access=10")
+logsetup.setup(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE)
 logger = logging.getLogger(__name__)
 
 # === НАСТРОЙКИ ===
@@ -46,18 +81,524 @@ BASE_URL = os.getenv("BASE_URL", "https://your-app-name.up.railway.app").rstrip(
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_SECRET = "courier_bot_secret_2025"
 
+# Часовой пояс точки: в нём пишется время в логах и считаются даты выгрузок
+BUSINESS_TZ = os.getenv("BUSINESS_TZ", "Asia/Yekaterinburg")
+
+# Токен для служебных API (выгрузки, история). Если не задан - доступ как у остального /api
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Telegram id менеджеров через запятую: им доступны служебные команды бота (/broadcast)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Адрес Bot API. Пусто - api.telegram.org; для нагрузочных тестов можно указать
+# локальную заглушку: TELEGRAM_API_BASE=http://127.0.0.1:8081 (см. fake_telegram.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
+
+# Пул соединений с БД (создаётся на этапе старта, см. staged_startup)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# Сколько ждать свободного соединения, когда все DB_POOL_MAX заняты (секунды; ждут
+# только вызовы из потоков, в event loop - отказ сразу). Исчерпанный пул - очередь
+# к базе, а не её отказ: предохранитель его не учитывает
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", 5))
+
+# Сколько вебхук/API ждут готовности БД при холодном старте, прежде чем ответить 503
+STARTUP_DB_WAIT = float(os.getenv("STARTUP_DB_WAIT", 10))
+# Период фоновой проверки БД для /health/ready (секунды)
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", 5))
+# Обработка апдейтов: число дорожек (по умолчанию = размер пула БД), ёмкость очереди
+# дорожки и сколько ждать места в ней, прежде чем ответить Telegram 503. Запросы к БД
+# хендлеры пока делают прямо в event loop, поэтому к базе одновременно идёт один
+# хендлер: дорожки ограничивают число начатых апдейтов (и запросов к Bot API), а не
+# занятых соединений пула, и медленный запрос задерживает все дорожки
+UPDATE_LANES = int(os.getenv("UPDATE_LANES", DB_POOL_MAX))
+UPDATE_LANE_CAPACITY = int(os.getenv("UPDATE_LANE_CAPACITY", 100))
+UPDATE_ENQUEUE_WAIT = float(os.getenv("UPDATE_ENQUEUE_WAIT", 2))
+# Защита от повторов: сколько последних update_id помнить, окно склейки двойных
+# нажатий в кассе (действие + tg_id) и время жизни явного Idempotency-Key
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", 10000))
+CASHIER_DEDUP_WINDOW = float(os.getenv("CASHIER_DEDUP_WINDOW", 3))
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", 600))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 5000))
+# Допустимый возраст снимка очереди после изменения (секунды, 0 - всегда свежий):
+# касса опрашивает очередь раз в 5 с, курьер же должен сразу видеть своё действие
+QUEUE_READ_TTL_API = float(os.getenv("QUEUE_READ_TTL_API", 0.25))
+QUEUE_READ_TTL_BOT = float(os.getenv("QUEUE_READ_TTL_BOT", 0))
+# Выгрузка логов: строк на одну пачку из серверного курсора и одновременных выгрузок
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 2000))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", 2))
+# Аналитика смены: как часто дополнять почасовые агрегаты (секунды)
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv("ANALYTICS_REFRESH_INTERVAL", 300))
+# Правила обеда (см. lunch_policy.py): длительность в минутах, сколько обедов за смену и
+# начало смены по BUSINESS_TZ (по умолчанию - вместе с ежедневной очисткой очереди).
+# LOCATION - название точки, LUNCH_OVERRIDES - отличия отдельных точек:
+# "vainera:duration=30,max=3;malysheva:max=1,shift_start=08:00"
+LOCATION = os.getenv("LOCATION", "")
+try:
+    LUNCH_POLICY = lunch_policy.configure(
+        BUSINESS_TZ,
+        duration_minutes=float(os.getenv("LUNCH_DURATION_MINUTES", 20)),
+        max_per_shift=int(os.getenv("LUNCH_MAX_PER_SHIFT", 2)),
+        shift_start=os.getenv("SHIFT_START", "01:00"),
+        location=LOCATION,
+        overrides=os.getenv("LUNCH_OVERRIDES", ""),
+    )
+except ValueError as e:
+    raise RuntimeError(f"❌ Неверные правила обеда: {e}")
+# Порядок очереди (см. queue_order.py): QUEUE_POLICY - fifo (с обеда - в конец) или
+# return_slot (с обеда - на прежнее место); QUEUE_CLASSES - классы курьеров по
+# приоритету, например "car,*,foot" ("*" - курьеры без класса). Класс курьеру
+# назначается через POST /api/couriers/{tg_id}/queue_class
+try:
+    QUEUE_DISCIPLINE = queue_order.QueueDiscipline(
+        os.getenv("QUEUE_POLICY", "fifo"), os.getenv("QUEUE_CLASSES", ""),
+    )
+except ValueError as e:
+    raise RuntimeError(f"❌ Неверные правила очереди: {e}")
+# Хранение истории: сколько полных месяцев держать в базе (0 - хранить всё).
+# Более старые месяцы выгружаются в ARCHIVE_DIR (CSV.gz) и удаляются из базы
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+RETENTION_MONTHS = {
+    "logs": int(os.getenv("LOGS_RETENTION_MONTHS", 0)),
+    "lunch_sessions": int(os.getenv("LUNCH_RETENTION_MONTHS", 0)),
+    "orders": int(os.getenv("ORDERS_RETENTION_MONTHS", 0)),
+    "queue_exits": int(os.getenv("QUEUE_EXITS_RETENTION_MONTHS", 0)),
+}
+PARTITIONS_AHEAD = 2
+# Реплика для чтения (необязательно): очередь, история, аналитика и выгрузки читаются
+# с неё, пока отставание не больше REPLICA_MAX_LAG секунд и она не отвечает ошибками
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+# Без ответа базы за DB_CONNECT_TIMEOUT секунд бот переходит на локальный журнал JOURNAL_PATH
+# (при WEB_WORKERS > 1 у воркеров 1, 2, ... свои файлы JOURNAL_PATH.w<номер>)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 3))
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "journal.sqlite3")
+# Предел времени одного запроса к БД (секунды, 0 - без предела). Долгие фоновые
+# задачи (выгрузки, загрузка списка, аналитика, архив) работают без него
+DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", 5))
+# Таймаут запроса к Bot API (секунды; по умолчанию в aiogram - 60)
+TELEGRAM_REQUEST_TIMEOUT = float(os.getenv("TELEGRAM_REQUEST_TIMEOUT", 10))
+# Предохранители БД и Bot API: размыкаются, если за последние CIRCUIT_WINDOW секунд было
+# не меньше CIRCUIT_MIN_CALLS вызовов и доля неудачных (ошибка соединения, таймаут или
+# вызов дольше *_SLOW_CALL секунд) не меньше CIRCUIT_FAILURE_RATE. Разомкнутый
+# отказывает сразу, через CIRCUIT_OPEN_SECONDS пропускает пробные вызовы (у БД - только
+# фоновую пробу /health/ready, хендлеры до замыкания работают по журналу)
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", 10))
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", 10))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 5))
+DB_SLOW_CALL = float(os.getenv("DB_SLOW_CALL", 2))
+TELEGRAM_SLOW_CALL = float(os.getenv("TELEGRAM_SLOW_CALL", 5))
+# Сколько /api/queue ждёт обновления снимка, прежде чем отдать предыдущий
+QUEUE_READ_DEADLINE = float(os.getenv("QUEUE_READ_DEADLINE", 1))
+# За сколько дней история выходов из очереди подаётся в модель ожидания при старте
+ETA_HISTORY_DAYS = int(os.getenv("ETA_HISTORY_DAYS", 14))
+# Ограничение частоты нажатий курьера: "callback_data=нажатий/секунд" через запятую,
+# "*" - для остальных кнопок. Лишние нажатия отклоняются, не доходя до базы
+CALLBACK_RATE_LIMITS = os.getenv("CALLBACK_RATE_LIMITS", "join=3/10,leave=3/10,lunch_start=3/10,*=10/10")
+# Рассылки: сообщений в секунду на все рассылки вместе (лимит Telegram ~30/с, остаток -
+# ответам курьерам), одновременных отправок, получателей в пачке между записями прогресса
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 20))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 8))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", 50))
+# Текст, который перед ежедневной очисткой рассылается стоящим в очереди (пусто - не рассылать)
+DAILY_CLEAR_NOTICE = os.getenv("DAILY_CLEAR_NOTICE", "")
+# Несколько процессов: WEB_WORKERS > 1 - супервизор запускает столько воркеров на одном
+# порту (SO_REUSEPORT). Каждый со своим пулом БД (DB_POOL_MAX на воркер!); воркеры
+# пересылают друг другу апдейты через unix-сокеты в WORKER_SOCKET_DIR
+WEB_WORKERS = max(1, int(os.getenv("WEB_WORKERS", 1)))
+WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", "/tmp")
+WORKER_INDEX = 0  # номер этого воркера; 0 - основной (задаётся при запуске воркера)
+# Запись трафика для проигрывания (traffic.py): файл, куда дописываются принятые апдейты
+# и вызовы API кассы, с обезличенными id. Пусто - не записывать. RECORD_SALT - соль
+# псевдонимов (без неё - случайная на каждый запуск)
+RECORD_PATH = os.getenv("RECORD_PATH", "")
+RECORD_SALT = os.getenv("RECORD_SALT", "").encode() or None
+# Сколько при остановке ждём завершения начатой работы (Railway шлёт SIGTERM перед SIGKILL)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", os.getenv("RAILWAY_DEPLOYMENT_DRAINING_SECONDS", 20)))
+
 # === БАЗА ===
-def get_db():
-    url = DATABASE_URL.replace("postgresql://", "postgres://")
+DB_POOL = None
+# Класс соединений пулов (None - обычный); traffic.py подставляет соединение, считающее запросы
+DB_CONNECTION_FACTORY = None
+
+def open_db_pool():
+    """Создаёт пул соединений (идемпотентно). Вызывается из потока на этапе старта."""
+    global DB_POOL
+    if DB_POOL is None:
+        url = DATABASE_URL.replace("postgresql://", "postgres://")
+        # С репликой соединения primary помечают транзакции с записью (см. note_write)
+        factory = write_tracking(DB_CONNECTION_FACTORY) if DATABASE_REPLICA_URL else DB_CONNECTION_FACTORY
+        DB_POOL = psycopg2.pool.ThreadedConnectionPool(
+            DB_POOL_MIN, DB_POOL_MAX, url, cursor_factory=RealDictCursor,
+            connection_factory=factory,
+            connect_timeout=DB_CONNECT_TIMEOUT, **db_session_options(),
+        )
+        logger.info("Пул соединений с БД открыт (%s..%s).", DB_POOL_MIN, DB_POOL_MAX)
+        REPLICA.open()
+    return DB_POOL
+
+def db_session_options():
+    """Параметры сессии для новых соединений пула: предел времени запроса."""
+    if not DB_STATEMENT_TIMEOUT:
+        return {}
+    return {"options": f"-c statement_timeout={int(DB_STATEMENT_TIMEOUT * 1000)}"}
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    """Предохранитель БД разомкнут: запрос не отправлялся. Наследует OperationalError,
+    поэтому везде обрабатывается как недоступность базы (см. DB_DOWN_ERRORS)."""
+
+def on_event_loop():
+    """Вызов идёт в потоке event loop (а не в asyncio.to_thread)."""
     try:
-        return psycopg2.connect(url, cursor_factory=RealDictCursor)
-    except Exception as e:
-        logger.error(f"Ошибка подключения к БД: {e}")
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def wait_for_conn(pool):
+    """pool.getconn(), который при исчерпанном пуле ждёт возврата соединения
+    до DB_POOL_WAIT секунд, а не отказывает сразу (PoolError - по истечении).
+    Ждёт только вне event loop: хендлеры, зовущие базу прямо из loop, получают
+    PoolError сразу - иначе ожидание остановило бы все апдейты, кассу и /health."""
+    if on_event_loop():
+        return pool.getconn()
+    deadline = time.monotonic() + DB_POOL_WAIT
+    delay = 0.005
+    while True:
+        try:
+            return pool.getconn()
+        except psycopg2.pool.PoolError:
+            if pool.closed or time.monotonic() >= deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+@contextmanager
+def get_db(long_running=False, probe=False):
+    """Берёт соединение из пула. Как и `with conn:` в psycopg2, по выходу делает
+    commit (или rollback при исключении), после чего возвращает соединение в пул.
+    Внутри @read_only-функций соединение по возможности берётся с реплики.
+
+    Вызовы primary проходят через предохранитель DB_BREAKER. long_running - для
+    фоновых задач и выгрузок: без предела времени запроса и мимо предохранителя
+    (их длительность ничего не говорит о здоровье базы). Разомкнутый предохранитель
+    пробует только probe_db (probe=True); остальные вызовы до замыкания сразу
+    получают DatabaseUnavailable."""
+    route = _READ_ROUTE.get()
+    conn = REPLICA.acquire(route) if route is not None else None
+    guarded = conn is None and not long_running
+    if conn is not None:
+        pool = REPLICA.pool
+    else:
+        if guarded and not DB_BREAKER.allow(trial=probe):
+            raise DatabaseUnavailable("предохранитель БД разомкнут")
+        started = time.monotonic()
+        try:
+            pool = DB_POOL or open_db_pool()
+            conn = wait_for_conn(pool)
+        except psycopg2.pool.PoolError as e:
+            METRICS.inc("db_pool_exhausted_total")
+            logger.warning("Пул БД исчерпан: %s", e)
+            raise
+        except Exception as e:
+            if guarded and isinstance(e, DB_DOWN_ERRORS):
+                DB_BREAKER.record(time.monotonic() - started, e, hard=True)
+            logger.error("Ошибка подключения к БД: %s", e)
+            raise
+    started, error = time.monotonic(), None
+    try:
+        with conn:
+            if long_running and DB_STATEMENT_TIMEOUT:
+                with conn.cursor() as cur:
+                    cur.execute("SET statement_timeout = 0")
+            yield conn
+        if route is None and getattr(conn, "wrote", False):
+            conn.wrote = False
+            if REPLICA.pool is not None:
+                REPLICA.note_write()
+    except DB_DOWN_ERRORS as e:
+        error = e
         raise
+    finally:
+        if long_running and DB_STATEMENT_TIMEOUT and not conn.closed:
+            try:
+                conn.reset()  # вернуть statement_timeout из параметров соединения
+            except psycopg2.Error:
+                pass
+        pool.putconn(conn, close=bool(conn.closed))
+        if guarded:
+            # Оборванное соединение - база недоступна, а не просто медленный запрос
+            DB_BREAKER.record(time.monotonic() - started, error, hard=error is not None and bool(conn.closed))
+
+# === РЕПЛИКА ДЛЯ ЧТЕНИЯ ===
+def parse_lsn(value):
+    """'16/B374D848' -> число, чтобы сравнивать позиции WAL в Python."""
+    if not value:
+        return 0
+    high, low = value.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+class ReadRoute:
+    """Маршрут одного вызова @read_only-функции: ходили ли на реплику."""
+    __slots__ = ("used_replica",)
+
+    def __init__(self):
+        self.used_replica = False
+
+_READ_ROUTE = contextvars.ContextVar("read_route", default=None)
+
+def is_write(query):
+    """Может ли запрос изменить данные: всё, кроме SELECT/SHOW/SET и CTE без
+    INSERT/UPDATE/DELETE. Сомнительное считается записью."""
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    if not isinstance(query, str):
+        return True
+    head = query.lstrip().upper()
+    if head.startswith(("SELECT", "SHOW", "SET ", "RESET", "LISTEN")):
+        return False
+    if head.startswith("WITH"):
+        return any(word in head for word in ("INSERT", "UPDATE", "DELETE"))
+    return True
+
+_write_tracking = {}
+
+def write_tracking(base=None):
+    """Класс соединений primary, курсоры которых отмечают conn.wrote = True при
+    запросе с записью: только после таких транзакций реплике нужно догонять primary.
+    base - DB_CONNECTION_FACTORY (например, считающее запросы соединение traffic.py)."""
+    base = base or psycopg2.extensions.connection
+    cls = _write_tracking.get(base)
+    if cls is None:
+        cursors = {}
+
+        def tracking_cursor(factory):
+            if factory not in cursors:
+                class TrackingCursor(factory):
+                    def execute(self, query, vars=None):
+                        if is_write(query):
+                            self.connection.wrote = True
+                        return super().execute(query, vars)
+
+                    def executemany(self, query, vars_list):
+                        if is_write(query):
+                            self.connection.wrote = True
+                        return super().executemany(query, vars_list)
+
+                    def copy_expert(self, sql, file, size=8192):
+                        if "FROM STDIN" in sql.upper():
+                            self.connection.wrote = True
+                        return super().copy_expert(sql, file, size)
+
+                cursors[factory] = TrackingCursor
+            return cursors[factory]
+
+        class WriteTrackingConnection(base):
+            wrote = False
+
+            def cursor(self, *args, **kwargs):
+                factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs["cursor_factory"] = tracking_cursor(factory)
+                return super().cursor(*args, **kwargs)
+
+        cls = _write_tracking[base] = WriteTrackingConnection
+    return cls
+
+class ReplicaRouter:
+    """Решает, можно ли отдать чтение реплике.
+
+    Read-your-writes: транзакция с записью на primary только ставит флаг
+    write_pending, а позицию WAL primary (written_lsn) запрашивает первое следующее
+    чтение с реплики - одним запросом за все записи с прошлого чтения, и ни одним,
+    если чтений с реплики нет. Реплика годится для чтения, только если уже проиграла
+    WAL до этой позиции, поэтому курьер, только что вставший в очередь, никогда не
+    увидит очередь без себя. Последняя известная позиция реплики кэшируется, и
+    пока она не отстаёт, проверка не стоит лишнего запроса.
+
+    Иначе, а также при отставании больше REPLICA_MAX_LAG, ошибке соединения или
+    если это вообще не реплика (не в recovery), чтение идёт на primary."""
+
+    def __init__(self, url, max_lag):
+        self.url = url
+        self.max_lag = max_lag
+        self.pool = None
+        self.ok = False            # результат последней пробы
+        self.lag = None            # секунды, по последней пробе
+        self.written_lsn = 0       # позиция primary после последней нашей записи
+        self.write_pending = False # были записи после того, как written_lsn запрошена
+        self.replayed_lsn = 0      # последняя известная позиция реплики
+
+    def open(self):
+        """Открывает пул (идемпотентно). Недоступная реплика старт не блокирует:
+        пул откроется на одной из следующих проб."""
+        if self.url and self.pool is None:
+            try:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, self.url.replace("postgresql://", "postgres://"),
+                    cursor_factory=RealDictCursor, connection_factory=DB_CONNECTION_FACTORY,
+                    connect_timeout=DB_CONNECT_TIMEOUT, **db_session_options(),
+                )
+            except Exception as e:
+                logger.warning("Не удалось подключиться к реплике: %s", e)
+                return None
+            logger.info("Пул соединений с репликой открыт (%s..%s).", DB_POOL_MIN, DB_POOL_MAX)
+            self.probe()
+        return self.pool
+
+    def note_write(self):
+        self.write_pending = True
+
+    def _refresh_written_lsn(self):
+        """Позиция WAL primary для записей, отмеченных note_write. Флаг снимаем до
+        запроса: запись, закоммиченная после него, снова его поставит. False - если
+        primary не ответил (читать тогда тоже с primary, флаг остаётся)."""
+        self.write_pending = False
+        try:
+            conn = DB_POOL.getconn()
+        except Exception:
+            self.write_pending = True
+            return False
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_current_wal_insert_lsn()::text AS lsn")
+                    lsn = parse_lsn(cur.fetchone()['lsn'])
+        except Exception:
+            self.write_pending = True
+            return False
+        finally:
+            DB_POOL.putconn(conn, close=bool(conn.closed))
+        if lsn > self.written_lsn:
+            self.written_lsn = lsn
+        return True
+
+    def mark_down(self, error):
+        if self.ok:
+            logger.warning("Реплика недоступна, чтение переключено на primary: %s", error)
+        self.ok = False
+
+    def acquire(self, route):
+        """Соединение с репликой или None, если читать нужно с primary."""
+        if not self.ok:
+            METRICS.inc("replica_reads_total", target="primary", reason="unavailable")
+            return None
+        if self.write_pending and not self._refresh_written_lsn():
+            METRICS.inc("replica_reads_total", target="primary", reason="primary_lsn")
+            return None
+        try:
+            conn = self.pool.getconn()
+        except psycopg2.pool.PoolError:
+            # Все соединения с репликой заняты - читаем с primary, реплика здорова
+            METRICS.inc("replica_reads_total", target="primary", reason="busy")
+            return None
+        except Exception as e:
+            self.mark_down(e)
+            METRICS.inc("replica_reads_total", target="primary", reason="error")
+            return None
+        if self.replayed_lsn < self.written_lsn:
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_last_wal_replay_lsn()::text AS lsn")
+                        self.replayed_lsn = max(self.replayed_lsn, parse_lsn(cur.fetchone()['lsn']))
+            except Exception as e:
+                self.pool.putconn(conn, close=True)
+                self.mark_down(e)
+                METRICS.inc("replica_reads_total", target="primary", reason="error")
+                return None
+            if self.replayed_lsn < self.written_lsn:
+                self.pool.putconn(conn)
+                METRICS.inc("replica_reads_total", target="primary", reason="behind")
+                return None
+        route.used_replica = True
+        METRICS.inc("replica_reads_total", target="replica", reason="ok")
+        return conn
+
+    def probe(self):
+        """Фоновая проба: жива ли реплика, в recovery ли она и насколько отстаёт."""
+        if self.pool is None:
+            return self.open() is not None and self.ok
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute("""
+                            SELECT pg_is_in_recovery() AS standby,
+                                   pg_last_wal_replay_lsn()::text AS replayed,
+                                   CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                        ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+                                   END AS lag
+                        """)
+                        row = cur.fetchone()
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+        except Exception as e:
+            self.mark_down(e)
+            return False
+        if not row['standby']:
+            if self.ok or self.lag is None:
+                logger.warning("DATABASE_REPLICA_URL указывает не на реплику (не в recovery), чтение идёт на primary.")
+            self.ok, self.lag = False, None
+            return False
+        self.lag = float(row['lag'] or 0)
+        self.replayed_lsn = max(self.replayed_lsn, parse_lsn(row['replayed']))
+        ok = self.lag <= self.max_lag
+        if ok != self.ok:
+            logger.info("Реплика %s (отставание %.1f с).", 'используется' if ok else 'отстаёт, чтение на primary', self.lag)
+        self.ok = ok
+        return ok
+
+    def snapshot(self):
+        if self.pool is None:
+            return None
+        return {"ok": self.ok, "lag": None if self.lag is None else round(self.lag, 2)}
+
+REPLICA = ReplicaRouter(DATABASE_REPLICA_URL, REPLICA_MAX_LAG)
+
+def read_only(func):
+    """Функция только читает: её запросы можно отправить на реплику. Если реплика
+    отвечает ошибкой соединения, функция повторяется на primary."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if REPLICA.pool is None or _READ_ROUTE.get() is not None:
+            return func(*args, **kwargs)
+        route = ReadRoute()
+        token = _READ_ROUTE.set(route)
+        try:
+            return func(*args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if not route.used_replica:
+                raise
+            REPLICA.mark_down(e)
+        finally:
+            _READ_ROUTE.reset(token)
+        METRICS.inc("replica_reads_total", target="primary", reason="retry")
+        return func(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def replica_reads():
+    """Как @read_only, но для блока кода и без повтора на primary: используется там,
+    где результат уже частично отдан клиенту (выгрузка)."""
+    if REPLICA.pool is None:
+        yield
+        return
+    token = _READ_ROUTE.set(ReadRoute())
+    try:
+        yield
+    finally:
+        _READ_ROUTE.reset(token)
+
+# Несколько воркеров стартуют одновременно - схему (и перевод таблиц на секции)
+# создаёт один, остальные ждут его коммита и находят всё готовым
+INIT_DB_LOCK_KEY = 0x6B6F736D6F73
+
 def init_db():
     try:
-        with get_db() as conn:
+        with get_db(long_running=True) as conn:
             with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (INIT_DB_LOCK_KEY,))
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS couriers (
                         tg_id BIGINT PRIMARY KEY,
@@ -72,6 +613,19 @@ def init_db():
                         FOREIGN KEY (tg_id) REFERENCES couriers(tg_id) ON DELETE CASCADE
                     )
                 """)
+                # Порядок очереди - по sort_key (queue_order.py); старые строки получают ключ FIFO
+                cur.execute("ALTER TABLE queue ADD COLUMN IF NOT EXISTS sort_key BIGINT")
+                cur.execute("""
+                    UPDATE queue SET sort_key = (extract(epoch FROM join_time) * 1000000)::bigint
+                    WHERE sort_key IS NULL
+                """)
+                cur.execute("""
+                    ALTER TABLE queue
+                    ALTER COLUMN sort_key SET DEFAULT (extract(epoch FROM NOW()) * 1000000)::bigint,
+                    ALTER COLUMN sort_key SET NOT NULL
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS queue_sort_key_idx ON queue (sort_key, tg_id)")
+                cur.execute("ALTER TABLE couriers ADD COLUMN IF NOT EXISTS queue_class TEXT")
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS orders (
                         id SERIAL PRIMARY KEY,
@@ -104,14 +658,486 @@ def init_db():
                     )
                 """)
                 # --- /НОВАЯ ТАБЛИЦА ---
+                # log_action пишет formatted_time, а в исходной схеме колонки не было
+                cur.execute("ALTER TABLE logs ADD COLUMN IF NOT EXISTS formatted_time TEXT")
+                # Индексы для истории курьера (keyset по времени) и выгрузки за период
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS logs_tg_id_timestamp_idx
+                    ON logs (tg_id, timestamp DESC, log_id DESC)
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS logs_timestamp_idx ON logs (timestamp)")
+                # logs и lunch_sessions - помесячные секции (старые базы переводятся один раз)
+                converted = retention.init_partitioning(cur, BUSINESS_TZ, PARTITIONS_AHEAD)
+                for table, rows in converted.items():
+                    logger.info("Таблица %s переведена на помесячные секции, перенесено строк: %s", table, rows)
+                # Место в очереди, с которого курьер ушёл на обед (после перевода на секции:
+                # перенос копирует только колонки из описания секционированной таблицы)
+                cur.execute("ALTER TABLE lunch_sessions ADD COLUMN IF NOT EXISTS return_key BIGINT")
+                # Сколько длился разрешённый обед на момент начала: перерасход в аналитике
+                # считается от него, а не от текущей LUNCH_DURATION (NULL у старых сессий)
+                cur.execute("ALTER TABLE lunch_sessions ADD COLUMN IF NOT EXISTS allowed_seconds INT")
+                # Журнал выходов из очереди и почасовые агрегаты для аналитики смены
+                analytics.init_schema(cur)
+                # Применённые записи локального журнала (идемпотентное проигрывание)
+                journal.init_schema(cur)
+                # Рассылки и их получатели (прогресс переживает рестарт)
+                broadcast.init_schema(cur)
+                # Текущее сообщение бота у курьера - его правим при авто-возврате и снятии кассой
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS courier_messages (
+                        tg_id BIGINT PRIMARY KEY,
+                        chat_id BIGINT NOT NULL,
+                        message_id BIGINT NOT NULL,
+                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                        FOREIGN KEY (tg_id) REFERENCES couriers(tg_id) ON DELETE CASCADE
+                    )
+                """)
                 conn.commit()
         logger.info("База данных инициализирована/проверена успешно.")
     except Exception as e:
-        logger.error(f"Ошибка инициализации БД: {e}")
+        logger.error("Ошибка инициализации БД: %s", e)
         raise
 
-# Инициализация БД при старте
-init_db()
+# === ОЦЕНКА ОЖИДАНИЯ ===
+class WaitEstimator:
+    """Оценка ожидания в очереди по темпу выходов из неё.
+
+    Модель - скользящее среднее (EWMA) интервала между выходами обслуженных
+    курьеров (analytics.SERVED_REASONS) отдельно для каждого часа дня в BUSINESS_TZ.
+    Интервал считается только пока очередь не пуста: от предыдущего выхода или от
+    момента, когда в пустую очередь кто-то встал. Модель обновляется на каждом
+    событии очереди за O(1); ответ "сколько ждать N-му" - тоже O(1): N интервалов.
+    История читается один раз при старте (seed), дальше - только события."""
+
+    ALPHA = 0.2                 # вес нового интервала
+    MIN_SAMPLES = 3             # меньше наблюдений за час дня - берём общее среднее
+    MAX_INTERVAL = 2 * 60 * 60  # более долгая пауза - простой, а не обслуживание
+
+    def __init__(self, tz):
+        self.tz = ZoneInfo(tz)
+        self.hourly = [None] * 24   # час дня -> EWMA интервала, секунды
+        self.samples = [0] * 24
+        self.overall = None
+        self.mark = None            # начало текущего интервала; None - очередь пуста
+        self.revision = 0           # растёт при каждом обновлении модели
+
+    def on_join(self, at, was_empty):
+        if was_empty:
+            self.mark = at
+
+    def on_exit(self, at, served, now_empty):
+        if served and self.mark is not None:
+            gap = (at - self.mark).total_seconds()
+            if 0 < gap <= self.MAX_INTERVAL:
+                self._update(at, gap)
+        if now_empty:
+            self.mark = None
+        elif served:
+            self.mark = at
+
+    def on_clear(self):
+        self.mark = None
+
+    def _update(self, at, gap):
+        hour = at.astimezone(self.tz).hour
+        old = self.hourly[hour]
+        self.hourly[hour] = gap if old is None else old + self.ALPHA * (gap - old)
+        self.samples[hour] += 1
+        self.overall = gap if self.overall is None else self.overall + self.ALPHA * (gap - self.overall)
+        self.revision += 1
+
+    def interval(self, at=None):
+        hour = (at or datetime.now(timezone.utc)).astimezone(self.tz).hour
+        if self.samples[hour] >= self.MIN_SAMPLES:
+            return self.hourly[hour]
+        return self.overall
+
+    def estimate(self, position, at=None):
+        """Ожидаемое ожидание в секундах для позиции position (с 1) или None."""
+        interval = self.interval(at)
+        if interval is None or position < 1:
+            return None
+        return int(position * interval)
+
+    def key(self):
+        """Меняется, когда могли измениться оценки: модель обновилась или сменился час."""
+        return (self.revision, datetime.now(self.tz).hour)
+
+    def seed(self, events):
+        """Прогоняет через модель исторические события [(время, 'join'|'exit', reason)]."""
+        length = 0
+        for at, kind, reason in events:
+            if kind == "join":
+                self.on_join(at, length == 0)
+                length += 1
+            else:
+                length = max(length - 1, 0)
+                self.on_exit(at, reason in analytics.SERVED_REASONS, length == 0)
+        logger.info("Модель ожидания: %s интервалов, среднее %s с", sum(self.samples), self.overall and round(self.overall))
+
+    def snapshot(self):
+        return {
+            "overall_seconds": self.overall and round(self.overall, 1),
+            "hourly_seconds": {hour: round(value, 1) for hour, value in enumerate(self.hourly) if value is not None},
+        }
+
+ETA = WaitEstimator(BUSINESS_TZ)
+
+def format_eta(seconds):
+    """'≈ 7 мин' для ответа курьеру; пустая строка, если оценки нет."""
+    if seconds is None:
+        return ""
+    return f"≈ {max(1, round(seconds / 60))} мин"
+
+# === ПРАВИЛА ОБЕДА ===
+# Обедов за текущую смену по курьерам: проверка лимита - без запроса к базе
+LUNCH_COUNTERS = lunch_policy.LunchCounters(LUNCH_POLICY)
+
+def load_lunch_counters():
+    """Заполняет счётчики обедами текущей смены из базы (при старте)."""
+    now = datetime.now(timezone.utc)
+    with get_db() as conn:
+        with tuple_cursor(conn) as cur:
+            # Условие по start_time - и граница смены, и отсечение старых секций
+            cur.execute("""
+                SELECT tg_id, COUNT(*) FROM lunch_sessions
+                WHERE start_time >= %s
+                GROUP BY tg_id
+            """, (LUNCH_POLICY.shift_started_at(now),))
+            LUNCH_COUNTERS.load(dict(cur.fetchall()), now)
+    logger.info("Счётчики обедов смены %s: %s курьеров", LUNCH_COUNTERS.day, len(LUNCH_COUNTERS))
+
+# === РАБОТА ПРИ НЕДОСТУПНОЙ БАЗЕ ===
+# Ошибки соединения: по ним база считается недоступной (в отличие от ошибок в запросе)
+DB_DOWN_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+class OfflineState:
+    """Зеркало очереди, обедов и имён курьеров в памяти и локальный журнал изменений.
+
+    Пока база доступна, изменения применяются к базе и к зеркалу, а зеркало
+    заново заполняется из каждого свежего снимка очереди. Когда база недоступна,
+    функции, помеченные @offline_fallback, работают с зеркалом и дописывают
+    изменения в журнал (journal.py) - курьер получает ответ так же быстро, как
+    обычно. Когда проба БД снова проходит, recover() проигрывает журнал по
+    порядку и только после этого возвращает работу в базу.
+
+    Лимит обедов за смену без базы проверяется так же, как с ней: счётчики
+    LUNCH_COUNTERS живут в памяти и учитывают обеды, начатые и без базы."""
+
+    def __init__(self, journal_path):
+        self.journal = journal.Journal(journal_path)
+        self.active = False
+        self.since = None
+        # Запись в журнал и выход из автономного режима не должны перемежаться
+        self.lock = threading.Lock()
+        self.names = {}            # tg_id -> имя
+        self.queue = {}            # tg_id -> join_time
+        self.order = queue_order.QueueIndex()  # порядок очереди по sort_key
+        self.classes = {}          # tg_id -> класс в очереди (QUEUE_CLASSES)
+        self.lunch = {}            # tg_id -> LunchSession
+        self._next_session_id = 0  # временные id обедов без базы - отрицательные
+
+    def enter(self, error):
+        if not self.active:
+            self.active = True
+            self.since = time.monotonic()
+            METRICS.inc("offline_entered_total")
+            logger.error("База недоступна, изменения пишутся в локальный журнал: %s", error)
+
+    def run(self, offline, online, args, kwargs):
+        with self.lock:
+            if self.active:
+                METRICS.inc("offline_calls_total", func=online.__name__)
+                return offline(*args, **kwargs)
+        return online(*args, **kwargs)
+
+    # --- зеркало ---
+    def seed(self, queue, lunch):
+        """Заполняет зеркало из снимка get_queue_and_lunching."""
+        self.names.update((entry.tg_id, entry.name) for entry in queue)
+        self.names.update((session.tg_id, session.name) for session in lunch)
+        self.queue = {entry.tg_id: entry.join_time for entry in queue}
+        self.order.clear()
+        for entry in queue:
+            self.order.insert(entry.tg_id, entry.sort_key or queue_order.time_key(entry.join_time))
+        self.lunch = {session.tg_id: session for session in lunch}
+
+    def load_names(self):
+        with get_db() as conn:
+            with tuple_cursor(conn) as cur:
+                cur.execute("SELECT tg_id, name FROM couriers")
+                self.names.update(cur.fetchall())
+                cur.execute("SELECT tg_id, queue_class FROM couriers WHERE queue_class IS NOT NULL")
+                self.classes.update(cur.fetchall())
+
+    def on_join(self, tg_id, at=None, sort_key=None):
+        if tg_id not in self.queue:
+            at = at or datetime.now(timezone.utc)
+            ETA.on_join(at, not self.queue)
+            self.queue[tg_id] = at
+            self.order.insert(tg_id, sort_key or queue_order.time_key(at))
+
+    def on_leave(self, tg_id, reason=None, at=None):
+        if self.queue.pop(tg_id, None) is not None:
+            self.order.remove(tg_id)
+            ETA.on_exit(at or datetime.now(timezone.utc), reason in analytics.SERVED_REASONS, not self.queue)
+
+    def on_clear(self):
+        self.queue.clear()
+        self.order.clear()
+        ETA.on_clear()
+
+    def on_lunch_start(self, tg_id, session_id, at=None, return_key=None):
+        now = datetime.now(timezone.utc)
+        self.lunch[tg_id] = LunchSession(session_id, tg_id, at or now, None, return_key, self.names.get(tg_id))
+        LUNCH_COUNTERS.note(tg_id, at or now, now)
+
+    def on_lunch_end(self, tg_id):
+        self.lunch.pop(tg_id, None)
+
+    # --- чтение без базы ---
+    def get_queue_and_lunching(self):
+        lunch = sorted(self.lunch.values(), key=lambda session: session.start_time)
+        return (
+            [QueueEntry(tg_id, self.names.get(tg_id, str(tg_id)), self.queue[tg_id], self.order.key(tg_id))
+             for tg_id in self.order],
+            [session._replace(name=self.names.get(session.tg_id, str(session.tg_id))) for session in lunch],
+        )
+
+    def get_courier_name(self, tg_id):
+        return self.names.get(tg_id)
+
+    def set_class(self, tg_id, queue_class):
+        if queue_class is None:
+            self.classes.pop(tg_id, None)
+        else:
+            self.classes[tg_id] = queue_class
+
+    def is_in_queue(self, tg_id):
+        return tg_id in self.queue
+
+    def get_queue_position(self, tg_id):
+        return self.order.rank(tg_id)
+
+    def get_current_lunch_session(self, tg_id):
+        return self.lunch.get(tg_id)
+
+    # --- изменения без базы ---
+    def add_to_queue(self, tg_id, slot=None):
+        at = datetime.now(timezone.utc)
+        sort_key = QUEUE_DISCIPLINE.key(at, self.classes.get(tg_id), slot)
+        self.journal.append("join", tg_id, at, sort_key=sort_key)
+        self.on_join(tg_id, at, sort_key)
+        bump_queue_version()
+
+    def take_from_queue(self, tg_id, reason):
+        if tg_id not in self.queue:
+            return None
+        sort_key = self.order.key(tg_id)
+        self.journal.append("leave", tg_id, datetime.now(timezone.utc), reason=reason)
+        self.on_leave(tg_id, reason)
+        bump_queue_version()
+        return sort_key
+
+    def clear_queue(self):
+        affected = len(self.queue)
+        self.journal.append("clear", None, datetime.now(timezone.utc))
+        for tg_id in list(self.queue):
+            self.log_action(tg_id, self.names.get(tg_id, ""), "Ежедневная очистка очереди")
+        self.on_clear()
+        bump_queue_version()
+        logger.info("Очередь очищена без базы. Удалено %s записей.", affected)
+        return affected
+
+    def start_lunch_session(self, tg_id, courier_name, return_key=None):
+        at = datetime.now(timezone.utc)
+        today = at.astimezone(ZoneInfo(BUSINESS_TZ)).date()
+        self._next_session_id -= 1
+        session_id = self._next_session_id
+        self.journal.append("lunch_start", tg_id, at, session_id=session_id, date=today.isoformat(),
+                            return_key=return_key, allowed_seconds=LUNCH_POLICY.duration)
+        self.on_lunch_start(tg_id, session_id, at, return_key)
+        bump_queue_version()
+        logger.info("Курьер %s (ID: %s) начал обед без базы (временный ID сессии: %s).", courier_name, tg_id, session_id)
+        self.log_action(tg_id, courier_name, "started_lunch")
+        return session_id
+
+    def end_lunch_session(self, session_id, tg_id, courier_name):
+        current = self.lunch.get(tg_id)
+        if not current or current.session_id != session_id:
+            return False
+        self.journal.append("lunch_end", tg_id, datetime.now(timezone.utc))
+        self.on_lunch_end(tg_id)
+        bump_queue_version()
+        self.log_action(tg_id, courier_name, "ended_lunch")
+        return True
+
+    def log_action(self, tg_id, courier_name, action):
+        at = datetime.now(timezone.utc)
+        formatted_time = at.astimezone(ZoneInfo(BUSINESS_TZ)).strftime("%H:%M %d.%m.%Y")
+        self.journal.append("log", tg_id, at, courier_name=courier_name, action=action, formatted_time=formatted_time)
+
+    # --- возврат к базе ---
+    def recover(self):
+        """Проигрывает журнал в базу (вызывается из потока). Когда журнал пуст,
+        снимает автономный режим. Возвращает [(временный, настоящий) session_id]."""
+        remapped = []
+        oldest = None  # самое раннее время проигранных изменений - для пересчёта аналитики
+        while True:
+            entries = self.journal.pending()
+            if not entries:
+                with self.lock:
+                    if self.journal.count_pending():
+                        continue
+                    was_active, self.active = self.active, False
+                break
+            for entry in entries:
+                with get_db() as conn:
+                    with conn.cursor() as cur:
+                        remap = journal.apply_entry(cur, entry)
+                    conn.commit()
+                self.journal.mark_applied(entry.seq)
+                METRICS.inc("journal_replayed_total", op=entry.op)
+                if remap:
+                    remapped.append(remap)
+                if entry.op != "log" and (oldest is None or entry.at < oldest):
+                    oldest = entry.at
+        self.journal.compact()
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                journal.prune_applied(cur)
+        if oldest is not None:
+            # Выходы и обеды легли задним числом, за водяные знаки агрегатов
+            with get_db(long_running=True) as conn:
+                with conn.cursor() as cur:
+                    analytics.reaggregate(cur, oldest, LUNCH_POLICY.duration)
+        if was_active:
+            logger.info("База снова доступна после %.1f с, журнал проигран.", time.monotonic() - self.since)
+        return remapped
+
+    def use_journal(self, path):
+        """Файл журнала этого воркера; вызывается при запуске, до первой записи."""
+        self.journal.close()
+        self.journal = journal.Journal(path)
+
+    def close(self):
+        self.journal.close()
+
+    def snapshot(self):
+        return {"active": self.active, "pending": self.journal.count_pending()}
+
+OFFLINE = OfflineState(JOURNAL_PATH)
+
+def offline_fallback(offline):
+    """Запасной путь функции на время недоступности базы: пока она недоступна,
+    или если соединение оборвалось во время вызова, вызывается offline.
+    Единичный таймаут запроса, пока предохранитель БД замкнут, отдаётся вызывающему.
+    Незамкнутый предохранитель - сразу в журнал: пробует базу только probe_db_loop."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not OFFLINE.active and DB_BREAKER.state != CircuitBreaker.CLOSED:
+                OFFLINE.enter(DB_BREAKER.last_failure or "предохранитель БД разомкнут")
+            if not OFFLINE.active:
+                try:
+                    return func(*args, **kwargs)
+                except DB_DOWN_ERRORS as e:
+                    if DB_BREAKER.state == CircuitBreaker.CLOSED:
+                        raise
+                    OFFLINE.enter(e)
+            return OFFLINE.run(offline, func, args, kwargs)
+        return wrapper
+    return decorate
+
+# === НЕСКОЛЬКО ПРОЦЕССОВ ===
+# Кто за что отвечает при WEB_WORKERS > 1:
+#   - апдейты курьера обрабатывает его воркер (owner_of): там его FSM, лимит нажатий,
+#     таймер обеда и текущее сообщение; чужие апдейты пересылаются владельцу;
+#   - вебхук, cron (очистка, архив), аналитика и рассылки - только основной (0);
+#   - HTTP API и касса - любой воркер, какой достался соединению.
+# Зеркала очереди и модели ожидания каждого воркера получают чужие изменения
+# через LISTEN/NOTIFY (PeerEvents); без базы каждый воркер живёт своим зеркалом.
+def is_primary():
+    return WORKER_INDEX == 0
+
+def owner_of(key):
+    return key % WEB_WORKERS
+
+def worker_socket(index):
+    return os.path.join(WORKER_SOCKET_DIR, f"kosmos-bot-{os.getenv('PORT', 8080)}-{index}.sock")
+
+class PeerEvents:
+    """Изменения очереди и обедов между воркерами. Функция, изменившая базу,
+    публикует событие pg_notify в той же транзакции - остальные воркеры получают
+    его после коммита и применяют к своему зеркалу (OfflineState) и модели
+    ожидания. Версию очереди сообщать не нужно - она в общей памяти.
+    Слушает отдельное соединение в потоке; при одном воркере ничего не делает."""
+
+    CHANNEL = "kosmos_queue_events"
+
+    def __init__(self):
+        self.enabled = False
+        self.loop = None
+
+    def start(self, loop):
+        if WEB_WORKERS < 2 or self.enabled:
+            return
+        self.enabled = True
+        self.loop = loop
+        threading.Thread(target=self._listen, name="peer-events", daemon=True).start()
+
+    def publish(self, cur, op, tg_id=None, **data):
+        if not self.enabled:
+            return
+        event = {"worker": WORKER_INDEX, "op": op, "tg_id": tg_id,
+                 "at": datetime.now(timezone.utc).isoformat(), **data}
+        cur.execute("SELECT pg_notify(%s, %s)", (self.CHANNEL, json.dumps(event, ensure_ascii=False)))
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.CHANNEL}")
+                while True:
+                    select.select([conn], [], [], 30)
+                    conn.poll()
+                    while conn.notifies:
+                        self.loop.call_soon_threadsafe(self.apply, conn.notifies.pop(0).payload)
+            except Exception as e:
+                # Пропущенные события зеркало наверстает по следующему снимку очереди
+                logger.warning("Подписка на события других воркеров прервалась: %s", e)
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def apply(self, payload):
+        event = json.loads(payload)
+        if event["worker"] == WORKER_INDEX:
+            return
+        op, tg_id, at = event["op"], event["tg_id"], datetime.fromisoformat(event["at"])
+        if op == "join":
+            OFFLINE.on_join(tg_id, at, event.get("sort_key"))
+        elif op == "leave":
+            OFFLINE.on_leave(tg_id, event["reason"], at)
+        elif op == "clear":
+            OFFLINE.on_clear()
+        elif op == "lunch_start":
+            OFFLINE.on_lunch_start(tg_id, event["session_id"], at, event.get("return_key"))
+        elif op == "lunch_end":
+            OFFLINE.on_lunch_end(tg_id)
+        elif op == "name":
+            OFFLINE.names[tg_id] = event["name"]
+        elif op == "queue_class":
+            OFFLINE.set_class(tg_id, event["queue_class"])
+        elif op == "log_level":
+            logsetup.set_level(event["logger"], event["level"])
+        METRICS.inc("peer_events_total", op=op)
+
+PEERS = PeerEvents()
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 def format_time_for_display(seconds):
@@ -120,52 +1146,86 @@ def format_time_for_display(seconds):
     secs = seconds % 60
     return f"{mins:02}:{secs:02}"
 
-def add_to_queue(tg_id):
+# Версия состояния очереди: растёт при любом изменении очереди, обедов или имён.
+# По ней кэш отрисовки (QUEUE_RENDER) понимает, что снимок устарел. Лежит в общей
+# памяти, созданной до запуска воркеров: у каждого воркера свой счётчик (пишет
+# только он, без блокировок), версия - их сумма, так что изменение в любом
+# воркере сразу видно кэшам остальных.
+QUEUE_VERSIONS = multiprocessing.RawArray("q", WEB_WORKERS)
+
+def queue_version():
+    return sum(QUEUE_VERSIONS)
+
+def bump_queue_version():
+    QUEUE_VERSIONS[WORKER_INDEX] += 1
+
+@offline_fallback(OFFLINE.add_to_queue)
+def add_to_queue(tg_id, slot=None):
+    """Ставит курьера в очередь. Место задаёт QUEUE_DISCIPLINE: по классу и времени,
+    а при return_slot и переданном slot (ключ до обеда) - прежнее место."""
+    sort_key = QUEUE_DISCIPLINE.key(datetime.now(timezone.utc), OFFLINE.classes.get(tg_id), slot)
     with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO queue (tg_id) VALUES (%s) ON CONFLICT DO NOTHING",
-                (tg_id,)
+                "INSERT INTO queue (tg_id, sort_key) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                (tg_id, sort_key)
             )
+            PEERS.publish(cur, "join", tg_id, sort_key=sort_key)
             conn.commit()
-
-def remove_from_queue(tg_id):
+    OFFLINE.on_join(tg_id, sort_key=sort_key)
+    bump_queue_version()
+
+@offline_fallback(OFFLINE.take_from_queue)
+def take_from_queue(tg_id, reason):
+    """Убирает курьера из очереди; выход с причиной (reason) пишется в queue_exits
+    тем же запросом - по нему считается время ожидания и длина очереди.
+    Возвращает sort_key, с которым курьер стоял (None - его не было в очереди)."""
     with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM queue WHERE tg_id = %s", (tg_id,))
-            # Получаем rowcount ДО commit
-            affected = cur.rowcount
+            cur.execute("""
+                WITH gone AS (DELETE FROM queue WHERE tg_id = %s RETURNING tg_id, join_time, sort_key),
+                     exits AS (
+                         INSERT INTO queue_exits (tg_id, join_time, reason)
+                         SELECT tg_id, join_time, %s FROM gone
+                     )
+                SELECT sort_key FROM gone
+            """, (tg_id, reason))
+            row = cur.fetchone()
+            if row:
+                PEERS.publish(cur, "leave", tg_id, reason=reason)
             conn.commit()
-            # Возвращаем значение rowcount
-            return affected
-
-def get_courier_logs(tg_id, limit=50):
-    """Получить последние N логов для курьера с отформатированным временем."""
+            OFFLINE.on_leave(tg_id, reason)
+            if row:
+                bump_queue_version()
+            return row['sort_key'] if row else None
+
+def remove_from_queue(tg_id, reason):
+    """То же, что take_from_queue; возвращает число удалённых записей (0 или 1)."""
+    return int(take_from_queue(tg_id, reason) is not None)
+
+@read_only
+def get_courier_logs(tg_id, limit=50, after=None):
+    """Получить N логов курьера, от новых к старым, с отформатированным временем.
+    after=(timestamp, log_id) последней полученной записи - следующая страница (keyset).
+    Время форматирует сам Postgres, строки сразу читаются в LogEntry."""
+    where = "tg_id = %s"
+    params = [BUSINESS_TZ, tg_id]
+    if after is not None:
+        where += " AND (timestamp, log_id) < (%s, %s)"
+        params += list(after)
     with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT action, timestamp
+        with tuple_cursor(conn) as cur:
+            cur.execute(f"""
+                SELECT log_id, action, timestamp,
+                       to_char(timestamp AT TIME ZONE %s, 'HH24:MI DD.MM.YYYY') AS formatted_timestamp
                 FROM logs
-                WHERE tg_id = %s
-                ORDER BY timestamp DESC
+                WHERE {where}
+                ORDER BY timestamp DESC, log_id DESC
                 LIMIT %s
-            """, (tg_id, limit))
-            rows = cur.fetchall()
-
-    # Преобразуем timestamp в нужный формат
-    formatted_rows = []
-    tz = ZoneInfo("Europe/Moscow") # Укажите нужный часовой пояс
-    for row in rows:
-        # Преобразуем timestamp (в UTC) в Moscow time и форматируем
-        local_dt = row['timestamp'].astimezone(tz)
-        formatted_time = local_dt.strftime("%H:%M %d.%m.%Y")
-        # Добавляем отформатированное время в строку результата
-        formatted_row = dict(row) # Создаем копию строки
-        formatted_row['formatted_timestamp'] = formatted_time
-        formatted_rows.append(formatted_row)
-
-    return formatted_rows
+            """, (*params, limit))
+            return fetch_all(cur, LogEntry)
 
+@offline_fallback(OFFLINE.get_courier_name)
 def get_courier_name(tg_id):
     """Получить имя курьера по его tg_id."""
     with get_db() as conn:
@@ -173,89 +1233,129 @@ def get_courier_name(tg_id):
             cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
             row = cur.fetchone()
             if row:
+                OFFLINE.names[tg_id] = row['name']
                 return row['name']
             else:
                 return None
 
+@offline_fallback(OFFLINE.is_in_queue)
+def is_in_queue(tg_id):
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM queue WHERE tg_id = %s", (tg_id,))
+            return cur.fetchone() is not None
+
+@offline_fallback(OFFLINE.clear_queue)
 def clear_queue():
     """Функция для очистки всей очереди."""
     with get_db() as conn:
-        with conn.cursor() as cur:
+        with tuple_cursor(conn) as cur:
             # Сначала получим всех, кто был в очереди, вместе с именами
             cur.execute("""
                 SELECT q.tg_id, c.name
                 FROM queue q
                 JOIN couriers c ON q.tg_id = c.tg_id;
             """)
-            queued_couriers = cur.fetchall()
+            queued_couriers = fetch_all(cur, Courier)
             
-            # Удалим всех
-            cur.execute("DELETE FROM queue;")
+            # Удалим всех, сохранив выходы для аналитики
+            cur.execute("""
+                WITH gone AS (DELETE FROM queue RETURNING tg_id, join_time)
+                INSERT INTO queue_exits (tg_id, join_time, reason)
+                SELECT tg_id, join_time, 'daily_clear' FROM gone
+            """)
             affected = cur.rowcount
             
             # Залогируем для каждого из них
-            for courier_row in queued_couriers:
-                log_action(courier_row['tg_id'], courier_row['name'], "Ежедневная очистка очереди") # Передаём name
+            for courier in queued_couriers:
+                write_log(cur, courier.tg_id, courier.name, "Ежедневная очистка очереди") # Передаём name
             
+            PEERS.publish(cur, "clear")
             conn.commit()
-            logger.info(f"Очередь очищена. Удалено {affected} записей. Залогированы участники.")
+            OFFLINE.on_clear()
+            bump_queue_version()
+            logger.info("Очередь очищена. Удалено %s записей. Залогированы участники.", affected)
             return affected
 
+@offline_fallback(OFFLINE.get_queue_and_lunching)
+@read_only
 def get_queue_and_lunching():
-    """Получает очередь и курьеров на обеде."""
+    """Получает очередь и курьеров на обеде одним запросом по одному соединению.
+    Возвращает ([QueueEntry] по порядку очереди, [LunchSession] по времени начала обеда)."""
     with get_db() as conn:
-        with conn.cursor() as cur:
-            # Основная очередь
+        with tuple_cursor(conn) as cur:
             cur.execute("""
-                SELECT c.name, c.tg_id, q.join_time as time_info, 'queue' as source
+                SELECT c.tg_id, c.name, q.join_time AS time_info, 'queue' AS source, NULL::int AS session_id,
+                       q.sort_key AS slot, q.sort_key AS ord
                 FROM queue q
                 JOIN couriers c ON q.tg_id = c.tg_id
-                ORDER BY q.join_time ASC
+                UNION ALL
+                SELECT ls.tg_id, c.name, ls.start_time, 'lunch', ls.session_id,
+                       ls.return_key, (extract(epoch FROM ls.start_time) * 1000000)::bigint
+                FROM lunch_sessions ls
+                JOIN couriers c ON ls.tg_id = c.tg_id
+                WHERE ls.end_time IS NULL
+                -- 'queue' > 'lunch': очередь первой, по sort_key; обеды - по времени начала
+                ORDER BY source DESC, ord, tg_id
             """)
-            queue_rows = cur.fetchall()
-
-            # Курьеры на обеде (уже с 'time_info' и 'source' благодаря изменению в get_lunching_couriers)
-            lunching_rows = get_lunching_couriers() # <-- Теперь возвращает {'name', 'tg_id', 'time_info', 'source'}
-
-    # Объединяем и сортируем: сначала очередь, потом обедающие
-    all_rows = queue_rows + lunching_rows # <-- lunching_rows уже содержит 'time_info' и 'source'
-    # Сортировка: сначала очередь ('queue' == False, 'lunch' == True), потом обедающие по времени начала обеда
-    all_rows.sort(key=lambda x: (x['source'] == 'lunch', x['time_info']))
-    return all_rows
-
+            queue, lunch = [], []
+            for tg_id, name, time_info, source, session_id, slot, _ in cur.fetchall():
+                if source == 'queue':
+                    queue.append(QueueEntry(tg_id, name, time_info, slot))
+                else:
+                    lunch.append(LunchSession(session_id, tg_id, time_info, None, slot, name))
+            return queue, lunch
+
+@read_only
 def get_queue():
-    """Получает только курьеров, находящихся в очереди."""
+    """Получает только курьеров, находящихся в очереди: [QueueEntry] по порядку."""
     with get_db() as conn:
-        with conn.cursor() as cur:
+        with tuple_cursor(conn) as cur:
             cur.execute("""
-                SELECT c.name, c.tg_id
+                SELECT q.tg_id, c.name, q.join_time, q.sort_key
                 FROM queue q
                 JOIN couriers c ON q.tg_id = c.tg_id
-                ORDER BY q.join_time
+                ORDER BY q.sort_key, q.tg_id
             """)
-            return cur.fetchall()
+            return fetch_all(cur, QueueEntry)
 
-def get_queue_with_details():
-    with get_db() as conn:
+# Прежнее имя: get_queue теперь тоже отдаёт время входа
+get_queue_with_details = get_queue
+
+@read_only
+def get_queue_events(days):
+    """События очереди за последние days дней по времени: (время, 'join'|'exit', причина).
+    Нужны один раз при старте, чтобы модель ожидания не начинала с нуля."""
+    with get_db(long_running=True) as conn:
         with conn.cursor() as cur:
             cur.execute("""
-                SELECT c.name, q.tg_id, q.join_time
-                FROM queue q
-                JOIN couriers c ON q.tg_id = c.tg_id
-                ORDER BY q.join_time
-            """)
-            return cur.fetchall()
-
+                SELECT t, kind, reason FROM (
+                    SELECT join_time AS t, 'join' AS kind, NULL AS reason FROM queue_exits
+                    WHERE join_time >= NOW() - %(days)s * INTERVAL '1 day'
+                    UNION ALL
+                    SELECT exit_time, 'exit', reason FROM queue_exits
+                    WHERE exit_time >= NOW() - %(days)s * INTERVAL '1 day'
+                    UNION ALL
+                    SELECT join_time, 'join', NULL FROM queue
+                    WHERE join_time >= NOW() - %(days)s * INTERVAL '1 day'
+                ) events
+                ORDER BY t, kind DESC -- при равном времени вход раньше выхода
+            """, {"days": days})
+            return [(row['t'], row['kind'], row['reason']) for row in cur.fetchall()]
+
+@offline_fallback(OFFLINE.get_queue_position)
+@read_only
 def get_queue_position(tg_id):
     with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute("""
                 SELECT COUNT(*) FROM queue
-                WHERE join_time <= (SELECT join_time FROM queue WHERE tg_id = %s)
+                WHERE (sort_key, tg_id) <= (SELECT sort_key, tg_id FROM queue WHERE tg_id = %s)
             """, (tg_id,))
             res = cur.fetchone()
             return res["count"] if res else 1
 
+@read_only
 def get_stats():
     with get_db() as conn:
         with conn.cursor() as cur:
@@ -271,65 +1371,64 @@ def get_stats():
             """, (today,))
             return cur.fetchall()
             
+@offline_fallback(OFFLINE.log_action)
 def log_action(tg_id, courier_name, action):
     """Записывает действие курьера в базу данных."""
-    tz = ZoneInfo("Asia/Yekaterinburg") # Укажите нужный часовой пояс
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            write_log(cur, tg_id, courier_name, action)
+            conn.commit()
+
+def write_log(cur, tg_id, courier_name, action):
+    """Запись в logs на уже взятом курсоре - в той же транзакции, без второго
+    соединения из пула. Коммит - за вызывающим."""
+    tz = ZoneInfo(BUSINESS_TZ)
 
     # Получаем текущее время в нужном часовом поясе и форматируем его
     current_time_local = datetime.now(tz)
     formatted_time_str = current_time_local.strftime("%H:%M %d.%m.%Y")
 
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            # Вставляем как tg_id, courier_name, action, так и отформатированное время
-            cur.execute(
-                "INSERT INTO logs (tg_id, courier_name, action, formatted_time) VALUES (%s, %s, %s, %s)",
-                (tg_id, courier_name, action, formatted_time_str)
-            )
-            conn.commit()
-        logger.info(f"Лог: Курьер {courier_name} (ID: {tg_id}) {action} в {formatted_time_str}.")
+    # Вставляем как tg_id, courier_name, action, так и отформатированное время
+    cur.execute(
+        "INSERT INTO logs (tg_id, courier_name, action, formatted_time) VALUES (%s, %s, %s, %s)",
+        (tg_id, courier_name, action, formatted_time_str)
+    )
+    logger.info("Лог: Курьер %s (ID: %s) %s в %s.", courier_name, tg_id, action, formatted_time_str)
 
 #Функция обеда
+@offline_fallback(OFFLINE.get_current_lunch_session)
 def get_current_lunch_session(tg_id):
-    """Проверяет, находится ли курьер на обеде, и возвращает сессию, если да."""
+    """Проверяет, находится ли курьер на обеде, и возвращает LunchSession, если да."""
     with get_db() as conn:
-        with conn.cursor() as cur:
+        with tuple_cursor(conn) as cur:
             cur.execute("""
-                SELECT session_id, start_time, end_time
+                SELECT session_id, tg_id, start_time, end_time, return_key
                 FROM lunch_sessions
                 WHERE tg_id = %s AND end_time IS NULL
                 ORDER BY start_time DESC
                 LIMIT 1
             """, (tg_id,))
-            return cur.fetchone()
+            return fetch_one(cur, LunchSession)
 
-def get_lunch_count_today(tg_id):
-    """Возвращает количество сеансов обеда за сегодня."""
-    today = datetime.now().date()
+@offline_fallback(OFFLINE.start_lunch_session)
+def start_lunch_session(tg_id, courier_name, return_key=None):
+    """Создаёт новую сессию обеда. return_key - sort_key курьера в очереди до обеда."""
     with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute("""
-                SELECT COUNT(*) as count
-                FROM lunch_sessions
-                WHERE tg_id = %s AND date = %s
-            """, (tg_id, today))
-            res = cur.fetchone()
-            return res['count'] if res else 0
-
-def start_lunch_session(tg_id, courier_name):
-    """Создаёт новую сессию обеда."""
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO lunch_sessions (tg_id) VALUES (%s)
+                INSERT INTO lunch_sessions (tg_id, return_key, allowed_seconds) VALUES (%s, %s, %s)
                 RETURNING session_id
-            """, (tg_id,))
+            """, (tg_id, return_key, LUNCH_POLICY.duration))
             session_id = cur.fetchone()['session_id']
+            PEERS.publish(cur, "lunch_start", tg_id, session_id=session_id, return_key=return_key)
+            write_log(cur, tg_id, courier_name, "started_lunch")
             conn.commit()
-            logger.info(f"Курьер {courier_name} (ID: {tg_id}) начал обед (ID сессии: {session_id}).")
-            log_action(tg_id, courier_name, "started_lunch")
+            OFFLINE.on_lunch_start(tg_id, session_id, return_key=return_key)
+            bump_queue_version()
+            logger.info("Курьер %s (ID: %s) начал обед (ID сессии: %s).", courier_name, tg_id, session_id)
             return session_id
 
+@offline_fallback(OFFLINE.end_lunch_session)
 def end_lunch_session(session_id, tg_id, courier_name):
     """Завершает сессию обеда."""
     with get_db() as conn:
@@ -340,39 +1439,134 @@ def end_lunch_session(session_id, tg_id, courier_name):
                 WHERE session_id = %s AND tg_id = %s AND end_time IS NULL
             """, (session_id, tg_id))
             updated = cur.rowcount
+            if updated:
+                PEERS.publish(cur, "lunch_end", tg_id)
+                write_log(cur, tg_id, courier_name, "ended_lunch")
             conn.commit()
             if updated > 0:
-                logger.info(f"Курьер {courier_name} (ID: {tg_id}) закончил обед (ID сессии: {session_id}).")
-                log_action(tg_id, courier_name, "ended_lunch")
+                OFFLINE.on_lunch_end(tg_id)
+                bump_queue_version()
+                logger.info("Курьер %s (ID: %s) закончил обед (ID сессии: %s).", courier_name, tg_id, session_id)
                 return True
             else:
-                logger.warning(f"Попытка завершить несуществующую или уже завершённую сессию обеда {session_id} для курьера {tg_id}.")
+                logger.warning("Попытка завершить несуществующую или уже завершённую сессию обеда %s для курьера %s.", session_id, tg_id)
                 return False
 
 def get_lunching_couriers():
-    """Получает список курьеров, находящихся на обеде."""
+    """Получает список курьеров, находящихся на обеде: [LunchSession] с именами."""
     with get_db() as conn:
-        with conn.cursor() as cur:
+        with tuple_cursor(conn) as cur:
             cur.execute("""
-                SELECT c.name, ls.tg_id, ls.start_time
+                SELECT ls.session_id, ls.tg_id, ls.start_time, ls.end_time, ls.return_key, c.name
                 FROM lunch_sessions ls
                 JOIN couriers c ON ls.tg_id = c.tg_id
                 WHERE ls.end_time IS NULL
                 ORDER BY ls.start_time ASC -- Сортировка по времени начала
             """)
-            rows = cur.fetchall()
-            # Преобразуем результат, чтобы ключ start_time был под ключом time_info
-            # Это нужно, чтобы соответствовать структуре queue_rows в get_queue_and_lunching
-            formatted_rows = []
-            for row in rows:
-                formatted_row = {
-                    'name': row['name'],
-                    'tg_id': row['tg_id'],
-                    'time_info': row['start_time'], # <-- Вот тут
-                    'source': 'lunch'
-                }
-                formatted_rows.append(formatted_row)
-            return formatted_rows
+            return fetch_all(cur, LunchSession)
+
+# === КЭШ ОТРИСОВКИ ОЧЕРЕДИ ===
+class SingleFlight:
+    """Склейка одновременных загрузок: пока по ключу идёт загрузка, остальные
+    вызывающие ждут её результат, а не запускают свою."""
+
+    def __init__(self, name):
+        self.name = name
+        self.flights = {}  # ключ -> asyncio.Task
+
+    async def do(self, key, func):
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.flights[key] = task
+            task.add_done_callback(lambda t: self.flights.pop(key, None))
+            METRICS.inc("singleflight_loads_total", flight=self.name)
+        else:
+            METRICS.inc("singleflight_shared_total", flight=self.name)
+        # shield: отмена одного ждущего не должна отменять загрузку для остальных
+        return await asyncio.shield(task)
+
+QUEUE_READS = SingleFlight("queue")
+
+class QueueRenderCache:
+    """Снимок очереди и обедов, привязанный к версии очереди, и готовые представления:
+    JSON-байты для /api/queue и Markdown-текст для show_queue. Пока версия не менялась,
+    чтение не делает ни запросов, ни сборки списков, ни json.dumps. Остаток обеда
+    зависит от времени, поэтому при наличии обедающих представления живут одну секунду.
+
+    Перед чтением представлений вызывается ensure(): устаревший снимок загружается
+    через SingleFlight, так что одновременные читатели делят один запрос к БД."""
+
+    def __init__(self):
+        self.version = None
+        self.fetched_at = 0.0
+        self.queue = []      # [QueueEntry] в порядке очереди
+        self.lunch = []      # [LunchSession] по времени начала обеда
+        self._api = None     # (ключ, bytes)
+        self._text = None    # (ключ, str)
+
+    async def ensure(self, max_age=0):
+        """Обновляет снимок, если версия изменилась. max_age > 0 разрешает отдать снимок
+        чуть старше текущей версии, если ему меньше max_age секунд: при потоке изменений
+        чтения ограничены временем, а не числом смотрящих."""
+        if self.version == queue_version():
+            return
+        if max_age and time.monotonic() - self.fetched_at < max_age:
+            METRICS.inc("queue_reads_stale_total")
+            return
+        # Ключ с версией: кто пришёл после изменения, не подхватит загрузку, начатую до него
+        await QUEUE_READS.do(queue_version(), self._load)
+
+    async def _load(self):
+        version = queue_version()  # берём до запроса: изменение во время чтения даст новый промах
+        queue, lunch = await asyncio.to_thread(get_queue_and_lunching)
+        if version == queue_version() and not OFFLINE.active:
+            OFFLINE.seed(queue, lunch)  # снимок не старше последнего изменения - зеркало по нему
+        self.queue, self.lunch = queue, lunch
+        self.version = version
+        self.fetched_at = time.monotonic()
+        self._api = self._text = None
+
+    def _key(self):
+        # Без обедающих представление от времени не зависит (кроме оценки ожидания)
+        return (self.version, ETA.key(), int(time.time()) if self.lunch else None)
+
+    def api_json(self):
+        key = self._key()
+        if self._api is None or self._api[0] != key:
+            now = datetime.now(timezone.utc)
+            items = [{"name": entry.name, "tg_id": entry.tg_id, "source": "queue", "eta_seconds": ETA.estimate(i + 1, now)}
+                     for i, entry in enumerate(self.queue)]
+            for session in self.lunch:
+                items.append({
+                    "name": session.name, "tg_id": session.tg_id, "source": "lunch",
+                    "remaining_seconds": LUNCH_POLICY.remaining(session.start_time, now),
+                    "lunch_ends_at": int(LUNCH_POLICY.ends_at(session.start_time).timestamp()),
+                })
+            self._api = (key, json.dumps(items, ensure_ascii=False).encode())
+        return self._api[1]
+
+    def bot_text(self):
+        key = self._key()
+        if self._text is None or self._text[0] != key:
+            now = datetime.now(timezone.utc)
+            # Формируем строки для очереди
+            lines = []
+            for i, entry in enumerate(self.queue):
+                eta = format_eta(ETA.estimate(i + 1, now))
+                lines.append(f"{i+1}. {entry.name} ({eta})" if eta else f"{i+1}. {entry.name}")
+            # Формируем строки для обедающих
+            for session in self.lunch:
+                formatted_time = format_time_for_display(LUNCH_POLICY.remaining(session.start_time, now))
+                lines.append(f"- {session.name} (обед, осталось {formatted_time})")
+            if lines:
+                text = "📋 *Текущая очередь и обед:* \n" + "\n".join(lines)
+            else:
+                text = "Очередь пуста."
+            self._text = (key, text)
+        return self._text[1]
+
+QUEUE_RENDER = QueueRenderCache()
 
 # === HTML шаблон для кассы ===
 CASHIER_HTML = """
@@ -628,6 +1822,33 @@ CASHIER_HTML = """
         background: var(--danger-hover);
     }
 
+    /* Строка фиксированной высоты: по ней считается виртуализация длинного списка */
+    .queue-item {
+        height: 76px;
+        contain: layout style;
+    }
+
+    .queue-item:not(.lunching) .lunch-badge {
+        display: none;
+    }
+
+    .name {
+        min-width: 0;
+        white-space: nowrap;
+        overflow: hidden;
+        text-overflow: ellipsis;
+        margin-right: 8px;
+    }
+
+    .spacer {
+        list-style: none;
+    }
+
+    .last-update.offline {
+        color: var(--danger);
+        font-weight: 600;
+    }
+
     .empty {
         text-align: center;
         color: var(--text-secondary);
@@ -656,6 +1877,9 @@ CASHIER_HTML = """
         .btn-group {
             flex-wrap: wrap;
         }
+        .queue-item {
+            height: 100px;
+        }
     }
     </style>
 </head>
@@ -677,15 +1901,40 @@ CASHIER_HTML = """
 </header>
 
         <ul class="queue-list" id="queue-list">
-            <!-- Сюда подгрузится очередь -->
+            <!-- Сюда подгрузится очередь: строки создаются по tg_id и дальше только правятся -->
         </ul>
+        <div class="empty" id="queue-empty" hidden>Очередь пуста</div>
 
-        <div class="last-update">
+        <div class="last-update" id="last-update">
             Обновлено: <span id="update-time">—</span>
         </div>
     </div>
 
     <script>
+        // Версия страницы (хэш разметки): сервер отдаёт свою в X-Cashier-Version к /api/queue
+        const CASHIER_VERSION = "__CASHIER_VERSION__";
+        // С какого числа строк рисуем только видимые (+ запас сверху и снизу)
+        const VIRTUAL_FROM = 60;
+        const OVERSCAN = 8;
+        const QUEUE_TIMEOUT_MS = 4000;
+
+        const list = document.getElementById('queue-list');
+        const emptyEl = document.getElementById('queue-empty');
+        const lastUpdateEl = document.getElementById('last-update');
+        const updateTimeEl = document.getElementById('update-time');
+        // Пустые строки-распорки: держат высоту списка вместо невидимых строк
+        const topSpacer = document.createElement('li');
+        const bottomSpacer = document.createElement('li');
+        topSpacer.className = bottomSpacer.className = 'spacer';
+        list.append(topSpacer, bottomSpacer);
+
+        let items = [];            // последний снимок: очередь по порядку, затем обедающие
+        const rows = new Map();    // "source:tg_id" -> <li>, только нарисованные
+        let rowStep = 0;           // высота строки с отступом, меряется по первой строке
+        let clockOffset = 0;       // поправка часов планшета к часам сервера, мс
+        let loading = false;
+        let renderFrame = 0;
+
         function updateTime() {
     const now = new Date();
     
@@ -707,86 +1956,217 @@ CASHIER_HTML = """
             const secs = seconds % 60;
             return `${mins.toString().padStart(2, '0')}:${secs.toString().padStart(2, '0')}`;
         }
-        
+
+        function lunchSecondsLeft(item) {
+            return Math.max(0, Math.round((item.lunch_ends_at * 1000 + clockOffset - Date.now()) / 1000));
+        }
+
+        // --- Строки списка ---
+        function createRow() {
+            // Шаблон без данных: имя и числа вписываются через textContent (без HTML-инъекций)
+            const li = document.createElement('li');
+            li.className = 'queue-item';
+            li.innerHTML =
+                '<div class="number"></div>' +
+                '<div class="name"></div>' +
+                '<div class="lunch-badge"><span>Обед</span><span class="lunch-timer"></span></div>' +
+                '<div class="btn-group">' +
+                    '<button class="btn btn-call" data-action="call"></button>' +
+                    '<button class="btn btn-remove" data-action="remove"></button>' +
+                '</div>';
+            li._number = li.querySelector('.number');
+            li._name = li.querySelector('.name');
+            li._timer = li.querySelector('.lunch-timer');
+            li._call = li.querySelector('.btn-call');
+            li._remove = li.querySelector('.btn-remove');
+            li._view = {};
+            return li;
+        }
+
+        function setText(li, field, el, value) {
+            // Пишем в DOM только изменившееся: без лишних перерисовок и потери фокуса
+            if (li._view[field] !== value) {
+                li._view[field] = value;
+                el.textContent = value;
+            }
+        }
+
+        function patchRow(li, item, index) {
+            const lunching = item.source === 'lunch';
+            li._item = item;
+            li.dataset.tgId = item.tg_id;
+            if (li._view.lunching !== lunching) {
+                li._view.lunching = lunching;
+                li.classList.toggle('lunching', lunching);
+                li._call.textContent = lunching ? '🐾' : 'Позвать';
+                li._remove.textContent = lunching ? '🗑️' : 'Удалить';
+            }
+            setText(li, 'number', li._number, lunching ? '-' : String(index + 1));
+            setText(li, 'name', li._name, item.name);
+            if (lunching) {
+                setText(li, 'timer', li._timer, formatTime(lunchSecondsLeft(item)));
+            }
+        }
+
+        function visibleRange() {
+            if (items.length < VIRTUAL_FROM) {
+                return [0, items.length];
+            }
+            if (!rowStep) {
+                return [0, Math.min(items.length, OVERSCAN)];  // сначала меряем строку
+            }
+            const listTop = list.getBoundingClientRect().top + window.scrollY;
+            const first = Math.floor((window.scrollY - listTop) / rowStep);
+            const count = Math.ceil(window.innerHeight / rowStep);
+            const start = Math.min(items.length, Math.max(0, first - OVERSCAN));
+            const end = Math.min(items.length, Math.max(start, first + count + OVERSCAN));
+            return [start, end];
+        }
+
+        function render() {
+            renderFrame = 0;
+            emptyEl.hidden = items.length > 0;
+            const [start, end] = visibleRange();
+            const wanted = new Map();
+            for (let i = start; i < end; i++) {
+                wanted.set(items[i].source + ':' + items[i].tg_id, i);
+            }
+            // Сначала убираем ушедшие строки, чтобы остальные не пришлось переставлять
+            for (const [key, li] of rows) {
+                if (!wanted.has(key)) {
+                    li.remove();
+                    rows.delete(key);
+                }
+            }
+            let prev = topSpacer;
+            for (const [key, i] of wanted) {
+                let li = rows.get(key);
+                if (!li) {
+                    li = createRow();
+                    rows.set(key, li);
+                }
+                patchRow(li, items[i], i);
+                if (prev.nextSibling !== li) {
+                    list.insertBefore(li, prev.nextSibling);
+                }
+                prev = li;
+            }
+            if (!rowStep && prev !== topSpacer) {
+                rowStep = prev.offsetHeight + parseFloat(getComputedStyle(prev).marginBottom);
+                if (items.length >= VIRTUAL_FROM) {
+                    scheduleRender();  // теперь известна высота строки - рисуем только видимые
+                }
+            }
+            topSpacer.style.height = (start * rowStep) + 'px';
+            bottomSpacer.style.height = ((items.length - end) * rowStep) + 'px';
+        }
+
+        function scheduleRender() {
+            if (!renderFrame) {
+                renderFrame = requestAnimationFrame(render);
+            }
+        }
+
+        window.addEventListener('scroll', () => {
+            if (items.length >= VIRTUAL_FROM) scheduleRender();
+        }, { passive: true });
+        window.addEventListener('resize', () => {
+            rowStep = 0;
+            scheduleRender();
+        });
+
+        // Таймеры обеда считаются на месте по lunch_ends_at, без запросов к серверу
+        function updateLunchTimers() {
+            for (const li of rows.values()) {
+                if (li._view.lunching) {
+                    setText(li, 'timer', li._timer, formatTime(lunchSecondsLeft(li._item)));
+                }
+            }
+        }
+
+        // --- Загрузка очереди ---
+        function showUpdated(offline) {
+            const time = (offline ? new Date(offline) : new Date()).toLocaleTimeString('ru-RU', {
+                hour: '2-digit',
+                minute: '2-digit',
+                second: '2-digit'
+            });
+            lastUpdateEl.classList.toggle('offline', Boolean(offline));
+            lastUpdateEl.firstChild.textContent = offline ? '⚠️ Нет связи с сервером, данные на ' : 'Обновлено: ';
+            updateTimeEl.textContent = time;
+        }
+
+        let lastSuccess = null;
+
+        function checkVersion(response) {
+            // Новая версия страницы на сервере: перезагружаемся один раз на версию
+            const version = response.headers.get('X-Cashier-Version');
+            if (version && version !== CASHIER_VERSION && sessionStorage.getItem('cashier_reload') !== version) {
+                sessionStorage.setItem('cashier_reload', version);
+                location.reload();
+            }
+        }
+
         function updateQueue() {
-            fetch('/api/queue')
+            if (loading) return;  // медленный ответ не копит запросы
+            loading = true;
+            const controller = new AbortController();
+            const timeout = setTimeout(() => controller.abort(), QUEUE_TIMEOUT_MS);
+            let fromCache = false;
+            let cachedAt = null;
+            fetch('/api/queue', { signal: controller.signal, cache: 'no-store' })
                 .then(response => {
                     if (!response.ok) throw new Error('HTTP ' + response.status);
+                    // X-From-Cache ставит service worker, когда сети нет
+                    fromCache = response.headers.get('X-From-Cache') === '1';
+                    if (fromCache) {
+                        cachedAt = Date.parse(response.headers.get('Date')) || null;
+                    } else {
+                        checkVersion(response);
+                    }
                     return response.json();
                 })
                 .then(data => {
-                    const list = document.getElementById('queue-list');
-                    const updateTimeEl = document.getElementById('update-time');
-                    
-                    if (data.length === 0) {
-                        list.innerHTML = '<li class="empty">Очередь пуста</li>';
-                    } else {
-                        // Разделяем очередь и обедающих
-                        const queueItems = data.filter(item => item.source === 'queue');
-                        const lunchItems = data.filter(item => item.source === 'lunch');
-
-                       // Генерируем HTML для очереди (с кнопками)
-                    const queueHtml = queueItems.map((item, index) => 
-                            `<li class="queue-item">
-                                <div class="number">${index + 1}</div>
-                                <div class="name">${item.name}</div>
-                                <div class="btn-group">
-                                    <button class="btn btn-call" onclick="callCourier(${item.tg_id})">Позвать</button>
-                                    <button class="btn btn-remove" onclick="removeCourier(${item.tg_id})">Удалить</button>
-                                </div>
-                            </li>`
-                        ).join('');
-
-                        // Генерируем HTML для обедающих (с кнопками)
-                        const lunchHtml = lunchItems.map(item => 
-                    `<li class="queue-item lunching">
-                        <div class="number">-</div>
-                        <div class="name">${item.name}</div>
-                        <div class="lunch-badge">
-                            <span>Обед</span>
-                            <span class="lunch-timer" data-tg-id="${item.tg_id}">${formatTime(item.remaining_seconds)}</span>
-                        </div>
-                        <div class="btn-group">
-                            <button class="btn btn-call" onclick="callCourier(${item.tg_id})">🐾</button>
-                            <button class="btn btn-remove" onclick="removeCourier(${item.tg_id})">🗑️</button>
-                        </div>
-                    </li>`
-                ).join('');
-
-                        list.innerHTML = queueHtml + lunchHtml;
+                    const receivedAt = Date.now();
+                    // Очередь сначала, потом обедающие - так отдаёт сервер
+                    items = data;
+                    if (!fromCache) {
+                        const lunch = data.find(item => item.source === 'lunch');
+                        if (lunch) {
+                            clockOffset = receivedAt + lunch.remaining_seconds * 1000 - lunch.lunch_ends_at * 1000;
+                        }
+                        lastSuccess = receivedAt;
                     }
-
-                    const now = new Date();
-                    updateTimeEl.textContent = now.toLocaleTimeString('ru-RU', { 
-                        hour: '2-digit', 
-                        minute: '2-digit',
-                        second: '2-digit'
-                    });
+                    render();
+                    showUpdated(fromCache ? (cachedAt || lastSuccess || receivedAt) : null);
                 })
                 .catch(err => {
+                    // Остаёмся на последнем снимке: список не стираем, таймеры идут дальше
                     console.error('Ошибка загрузки очереди:', err);
-                    document.getElementById('queue-list').innerHTML = 
-                        '<li class="empty">⚠️ Ошибка загрузки, напишите Алексею))</li>';
+                    if (lastSuccess) {
+                        showUpdated(lastSuccess);
+                    } else {
+                        lastUpdateEl.classList.add('offline');
+                        lastUpdateEl.firstChild.textContent = '⚠️ Ошибка загрузки, напишите Алексею)) ';
+                    }
+                })
+                .finally(() => {
+                    clearTimeout(timeout);
+                    loading = false;
                 });
         }
 
-        // Функция для обновления таймеров обеда
-        function updateLunchTimers() {
-            document.querySelectorAll('.lunch-timer').forEach(timerElement => {
-                const tgId = timerElement.getAttribute('data-tg-id');
-                // Найдем соответствующий элемент данных в последнем обновлении
-                // (Это менее эффективно, чем хранить данные в JS, но проще для начальной реализации)
-                fetch('/api/queue')
-                    .then(response => response.json())
-                    .then(data => {
-                        const item = data.find(d => d.tg_id == tgId && d.source === 'lunch');
-                        if (item) {
-                            timerElement.textContent = formatTime(item.remaining_seconds);
-                        }
-                    })
-                    .catch(console.error);
-            });
-        }
+        // Одна подписка на весь список вместо onclick в каждой строке
+        list.addEventListener('click', event => {
+            const button = event.target.closest('button[data-action]');
+            if (!button) return;
+            const tgId = Number(button.closest('.queue-item').dataset.tgId);
+            if (button.dataset.action === 'call') {
+                callCourier(tgId);
+            } else {
+                removeCourier(tgId);
+            }
+        });
         
         function removeCourier(tgId) {
             // Убрано подтверждение
@@ -851,9 +2231,14 @@ CASHIER_HTML = """
         // Автообновление
         setInterval(updateTime, 1000);
         setInterval(updateQueue, 5000);
-        // Обновляем таймеры обеда чаще
         setInterval(updateLunchTimers, 1000);
 
+        // Оболочка страницы и последний снимок очереди - в кэше service worker:
+        // страница открывается и без сети (нужен https или localhost)
+        if ('serviceWorker' in navigator) {
+            navigator.serviceWorker.register('/cashier-sw.js').catch(err => console.error('Service worker:', err));
+        }
+
         // --- Тема ---
 document.addEventListener('DOMContentLoaded', () => {
     const body = document.body;
@@ -873,27 +2258,483 @@ document.addEventListener('DOMContentLoaded', () => {
         toggleBtn.textContent = newTheme === 'dark' ? '☀️' : '🌙';
     });
 });
-
-    
-         
-         // Обнова
-    const CURRENT_VERSION = "3.6";
-    const savedVersion = localStorage.getItem('cashier_version');
-
-    if (savedVersion !== CURRENT_VERSION) {
-        localStorage.setItem('cashier_version', CURRENT_VERSION);
-        // Перезагрузка только при первом запуске новой версии
-        location.reload();
-    }
     </script>
 </body>
 </html>
 """
+# Версия кассы - хэш разметки: меняется с каждой правкой страницы
+CASHIER_VERSION = hashlib.sha1(CASHIER_HTML.encode()).hexdigest()[:12]
+CASHIER_HTML = CASHIER_HTML.replace("__CASHIER_VERSION__", CASHIER_VERSION)
+
+# Service worker кассы. Оболочка (/ и /cashier) и /api/queue - сначала сеть, при
+# её отсутствии - кэш; снимок очереди из кэша помечается заголовком X-From-Cache.
+# Кэш привязан к версии кассы, старые версии удаляются при активации
+CASHIER_SW_JS = """
+const CACHE = 'cashier-__CASHIER_VERSION__';
+const SHELL = ['/cashier'];
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(SHELL)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key.startsWith('cashier-') && key !== CACHE).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+function networkFirst(request, cacheKey, markCached) {
+    return fetch(request)
+        .then(response => {
+            if (response.ok) {
+                const copy = response.clone();
+                caches.open(CACHE).then(cache => cache.put(cacheKey, copy));
+            }
+            return response;
+        })
+        .catch(() => caches.match(cacheKey).then(cached => {
+            if (!cached) return Response.error();
+            if (!markCached) return cached;
+            const headers = new Headers(cached.headers);
+            headers.set('X-From-Cache', '1');
+            return cached.blob().then(body => new Response(body, { status: 200, headers: headers }));
+        }));
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;  // действия кассы не кэшируются
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+    if (url.pathname === '/api/queue') {
+        event.respondWith(networkFirst(request, '/api/queue', true));
+    } else if (request.mode === 'navigate' && (url.pathname === '/' || url.pathname === '/cashier')) {
+        event.respondWith(networkFirst(request, '/cashier', false));
+    }
+});
+""".replace("__CASHIER_VERSION__", CASHIER_VERSION)
 
 # === Aiogram бот ===
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_BASE:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(
+        api=TelegramAPIServer.from_base(TELEGRAM_API_BASE), timeout=TELEGRAM_REQUEST_TIMEOUT))
+    logger.info("Bot API: %s", TELEGRAM_API_BASE)
+else:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(timeout=TELEGRAM_REQUEST_TIMEOUT))
 dp = Dispatcher()
 
+# === МЕТРИКИ ===
+class Metrics:
+    """Счётчики и гейджи в памяти; /metrics отдаёт их в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.counters = defaultdict(float)  # (имя, метки) -> значение
+        self.gauges = {}                    # (имя, метки) -> функция без аргументов
+        self.const_labels = ()              # метки всех рядов (номер воркера)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        """Сумма и количество наблюдений (как summary без квантилей)."""
+        self.counters[self._key(name + "_sum", labels)] += seconds
+        self.counters[self._key(name + "_count", labels)] += 1
+
+    def gauge(self, name, func, **labels):
+        self.gauges[self._key(name, labels)] = func
+
+    def render(self):
+        lines = []
+        items = list(self.counters.items()) + [(k, f()) for k, f in self.gauges.items()]
+        for (name, labels), value in sorted(items):
+            labels = self.const_labels + labels
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.gauge("log_queue_depth", logsetup.queue_depth)
+for _name in logsetup.SAMPLER.rates:
+    METRICS.gauge("log_records_sampled_out", lambda name=_name: logsetup.SAMPLER.dropped[name], logger=_name)
+
+# === ПРЕДОХРАНИТЕЛИ ===
+class CircuitBreaker:
+    """Предохранитель вокруг внешней зависимости (Postgres, Bot API).
+
+    Замкнут: вызовы идут, исходы копятся в окне из window посекундных корзин.
+    Если в окне не меньше min_calls вызовов и доля неудачных - ошибка или вызов
+    дольше slow_call - не меньше failure_rate, размыкается (hard-ошибка вроде
+    отказа в соединении размыкает сразу). Разомкнут: allow() сразу отвечает False,
+    вызывающий отдаёт запасной ответ, не дожидаясь своего таймаута. Через
+    open_seconds - полуразомкнут: пропускает до HALF_OPEN_CALLS пробных вызовов;
+    удачная проба замыкает, неудачная снова размыкает. Вызов с allow(trial=False)
+    проходит только через замкнутый предохранитель и пробой не становится - так
+    хендлеры не ждут таймаута соединения, пока базу проверяет фоновая проба.
+
+    Вызывается и из event loop, и из потоков (get_db), поэтому под замком."""
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    HALF_OPEN_CALLS = 3  # вложенный get_db в пробном вызове - тоже проба
+
+    def __init__(self, name, failure_rate, min_calls, window, open_seconds, slow_call):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.slow_call = slow_call
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trials = 0
+        self.buckets = deque()  # [секунда, вызовов, неудачных]
+        self.last_failure = None
+        self._lock = threading.Lock()
+        METRICS.gauge("circuit_state", lambda: self.STATE_CODES[self.state], breaker=name)
+
+    def _set(self, state, reason=None):
+        self.state = state
+        METRICS.inc("circuit_transitions_total", breaker=self.name, state=state)
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            self.trials = 0
+            logger.warning("Предохранитель %s разомкнут: %s", self.name, reason)
+        elif state == self.CLOSED:
+            self.buckets.clear()
+            logger.info("Предохранитель %s замкнут", self.name)
+
+    def allow(self, trial=True):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if not trial:
+                METRICS.inc("circuit_rejected_total", breaker=self.name)
+                return False
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    METRICS.inc("circuit_rejected_total", breaker=self.name)
+                    return False
+                self._set(self.HALF_OPEN)
+            if self.trials >= self.HALF_OPEN_CALLS:
+                METRICS.inc("circuit_rejected_total", breaker=self.name)
+                return False
+            self.trials += 1
+            return True
+
+    def record(self, elapsed, error=None, hard=False):
+        """Исход вызова, пропущенного allow(): error - исключение зависимости или None."""
+        failed = error is not None or elapsed > self.slow_call
+        if failed:
+            self.last_failure = str(error).strip() if error is not None else f"вызов {elapsed:.1f} с"
+            METRICS.inc("circuit_failures_total", breaker=self.name)
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trials = max(0, self.trials - 1)
+                if failed:
+                    self._set(self.OPEN, f"проба не прошла ({self.last_failure})")
+                else:
+                    self._set(self.CLOSED)
+                return
+            if self.state == self.OPEN:
+                return  # вызов начался до размыкания
+            if failed and hard:
+                self._set(self.OPEN, self.last_failure)
+                return
+            second = int(time.monotonic())
+            if self.buckets and self.buckets[-1][0] == second:
+                bucket = self.buckets[-1]
+            else:
+                bucket = [second, 0, 0]
+                self.buckets.append(bucket)
+                while self.buckets[0][0] <= second - self.window:
+                    self.buckets.popleft()
+            bucket[1] += 1
+            bucket[2] += failed
+            if failed:
+                calls = sum(b[1] for b in self.buckets)
+                failures = sum(b[2] for b in self.buckets)
+                if calls >= self.min_calls and failures >= self.failure_rate * calls:
+                    self._set(self.OPEN, f"{failures} из {calls} вызовов неудачны, последний: {self.last_failure}")
+
+    def retry_in(self):
+        """Через сколько секунд разомкнутый предохранитель пропустит пробу."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self.opened_at))
+
+    def snapshot(self):
+        calls = sum(b[1] for b in self.buckets)
+        failures = sum(b[2] for b in self.buckets)
+        return {"state": self.state, "calls": calls, "failures": failures,
+                "retry_in": round(self.retry_in(), 1), "last_failure": self.last_failure}
+
+DB_BREAKER = CircuitBreaker("db", CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW,
+                            CIRCUIT_OPEN_SECONDS, DB_SLOW_CALL)
+TELEGRAM_BREAKER = CircuitBreaker("telegram", CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW,
+                                  CIRCUIT_OPEN_SECONDS, TELEGRAM_SLOW_CALL)
+
+class TelegramUnavailable(TelegramNetworkError):
+    """Предохранитель Bot API разомкнут: запрос не отправлялся. Обрабатывается
+    везде как сетевая ошибка."""
+
+# === УЧЁТ НЕЗАВЕРШЁННОЙ РАБОТЫ ===
+class InflightTracker:
+    """Счётчики начатой, но не завершённой работы по видам: апдейты, HTTP-запросы,
+    вызовы Bot API, срабатывающие таймеры. По ним завершение ждёт, пока всё доделается."""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @contextmanager
+    def track(self, kind):
+        self.counts[kind] += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.counts[kind] -= 1
+            if not any(self.counts.values()):
+                self._idle.set()
+
+    async def wait_idle(self, timeout):
+        """True, если всё завершилось до таймаута."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+INFLIGHT = InflightTracker()
+
+@dp.update.outer_middleware()
+async def track_updates_middleware(handler, event, data):
+    with INFLIGHT.track("updates"):
+        return await handler(event, data)
+
+@bot.session.middleware()
+async def track_bot_requests_middleware(make_request, bot, method):
+    with INFLIGHT.track("telegram"):
+        return await make_request(bot, method)
+
+@bot.session.middleware()
+async def telegram_circuit_middleware(make_request, bot, method):
+    if not TELEGRAM_BREAKER.allow():
+        raise TelegramUnavailable(method, "Bot API недоступен (предохранитель разомкнут)")
+    started, error = time.monotonic(), None
+    try:
+        return await make_request(bot, method)
+    except (TelegramNetworkError, TelegramServerError) as e:
+        error = e
+        raise
+    finally:
+        TELEGRAM_BREAKER.record(time.monotonic() - started, error)
+
+# === ОБРАБОТКА ВЕБХУКОВ ===
+class UpdateScheduler:
+    """Раскладывает апдейты по фиксированному числу дорожек по from_user.id.
+    В каждой дорожке один обработчик, поэтому апдейты одного курьера выполняются
+    строго по порядку, а одновременно работает не больше UPDATE_LANES хендлеров
+    (одновременно - между await: синхронные запросы к БД идут по одному, в loop).
+    Если очередь дорожки полна, ждём место UPDATE_ENQUEUE_WAIT секунд, потом
+    отказываем (503) - Telegram доставит апдейт повторно позже."""
+
+    def __init__(self, lanes, capacity):
+        self.lanes = [asyncio.Queue(maxsize=capacity) for _ in range(lanes)]
+        self.workers = []
+        METRICS.gauge("updates_queued", lambda: sum(q.qsize() for q in self.lanes))
+        METRICS.gauge("updates_lane_depth_max", lambda: max(q.qsize() for q in self.lanes))
+
+    @staticmethod
+    def shard_key(update: Update):
+        event = update.event
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(event, "chat", None)
+        return chat.id if chat is not None else update.update_id
+
+    async def submit(self, update: Update):
+        """Ставит апдейт в дорожку. False - места нет, апдейт не принят."""
+        # Воркеру достаются ключи с одним остатком от деления на WEB_WORKERS - делим
+        # на него, иначе часть дорожек пустовала бы
+        lane = self.lanes[self.shard_key(update) // WEB_WORKERS % len(self.lanes)]
+        item = (update, time.monotonic())
+        try:
+            lane.put_nowait(item)
+        except asyncio.QueueFull:
+            METRICS.inc("updates_delayed_total")
+            try:
+                await asyncio.wait_for(lane.put(item), UPDATE_ENQUEUE_WAIT)
+            except asyncio.TimeoutError:
+                METRICS.inc("updates_shed_total")
+                logger.warning("Дорожка переполнена, апдейт %s отклонён", update.update_id)
+                return False
+        METRICS.inc("updates_enqueued_total")
+        return True
+
+    async def _worker(self, lane: asyncio.Queue):
+        while True:
+            update, enqueued_at = await lane.get()
+            started = time.monotonic()
+            METRICS.observe("updates_wait_seconds", started - enqueued_at)
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                METRICS.inc("updates_failed_total")
+                logger.error("Ошибка обработки апдейта %s: %s", update.update_id, e)
+            finally:
+                METRICS.observe("updates_handle_seconds", time.monotonic() - started)
+                lane.task_done()
+
+    async def start(self, app=None):
+        self.workers = [asyncio.create_task(self._worker(lane)) for lane in self.lanes]
+
+    async def drain(self, timeout):
+        """Ждёт, пока все принятые апдейты будут обработаны. True - успели."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(lane.join() for lane in self.lanes)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+UPDATES = UpdateScheduler(UPDATE_LANES, UPDATE_LANE_CAPACITY)
+
+class RecentIds:
+    """Ограниченное множество последних id: при переполнении забываются самые старые."""
+    __slots__ = ("size", "_ids", "_order")
+
+    def __init__(self, size):
+        self.size = size
+        self._ids = set()
+        self._order = deque()
+
+    def __contains__(self, item):
+        return item in self._ids
+
+    def add(self, item):
+        if item in self._ids:
+            return
+        if len(self._order) >= self.size:
+            self._ids.discard(self._order.popleft())
+        self._order.append(item)
+        self._ids.add(item)
+
+    def discard(self, item):
+        # Редкий случай (апдейт отклонён), поэтому линейный поиск по очереди допустим
+        if item in self._ids:
+            self._ids.discard(item)
+            self._order.remove(item)
+
+SEEN_UPDATES = RecentIds(WEBHOOK_DEDUP_SIZE)
+
+def raw_shard_key(data):
+    """UpdateScheduler.shard_key по сырому JSON - чтобы выбрать воркер, не разбирая апдейт."""
+    for key, event in data.items():
+        if key != "update_id" and isinstance(event, dict):
+            user = event.get("from") or event.get("chat")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+    return data.get("update_id", 0)
+
+class WorkerForwarder:
+    """Пересылает апдейт воркеру-владельцу курьера через его unix-сокет и
+    возвращает Telegram ответ владельца (503 владельца Telegram повторит)."""
+
+    def __init__(self):
+        self.sessions = {}  # номер воркера -> ClientSession на его сокет
+
+    async def forward(self, index, body):
+        session = self.sessions.get(index)
+        if session is None:
+            session = ClientSession(connector=UnixConnector(path=worker_socket(index)))
+            self.sessions[index] = session
+        try:
+            async with session.post(
+                f"http://worker-{index}{WEBHOOK_PATH}", data=body,
+                headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET, "Content-Type": "application/json"},
+                timeout=ClientTimeout(total=UPDATE_ENQUEUE_WAIT + 5),
+            ) as resp:
+                METRICS.inc("updates_forwarded_total")
+                return web.Response(status=resp.status, body=await resp.read(), content_type="application/json")
+        except (ClientError, asyncio.TimeoutError) as e:
+            METRICS.inc("updates_forward_failed_total")
+            logger.warning("Не удалось переслать апдейт воркеру %s: %s", index, e)
+            return web.json_response({"error": "Worker unavailable"}, status=503)
+
+    async def close(self, app=None):
+        for session in self.sessions.values():
+            await session.close()
+
+FORWARDER = WorkerForwarder()
+RECORDER = traffic.Recorder(RECORD_SALT)  # соль общая для воркеров: создаётся до fork
+
+async def handle_webhook(request: Request) -> Response:
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401, text="Unauthorized")
+    try:
+        body = await request.read()
+        data = json.loads(body)
+        owner = owner_of(raw_shard_key(data))
+    except Exception as e:
+        logger.error("Некорректный апдейт в вебхуке: %s", e)
+        return web.json_response({"error": "Invalid update"}, status=400)
+    # Апдейты курьера обрабатывает один воркер: его FSM, лимиты и таймеры живут там
+    if owner != WORKER_INDEX:
+        return await FORWARDER.forward(owner, body)
+    try:
+        # Повторная доставка (Telegram не дождался ответа) - отвечаем 200 и ничего не делаем
+        if data.get("update_id") in SEEN_UPDATES:
+            METRICS.inc("updates_duplicate_total")
+            return web.json_response({})
+        update = Update.model_validate(data, context={"bot": bot})
+    except Exception as e:
+        logger.error("Некорректный апдейт в вебхуке: %s", e)
+        return web.json_response({"error": "Invalid update"}, status=400)
+    # Запоминаем до ожидания места в дорожке, иначе повтор, пришедший за это время,
+    # тоже будет принят; отклонённый (503) апдейт забываем - Telegram пришлёт его снова
+    SEEN_UPDATES.add(update.update_id)
+    if not await UPDATES.submit(update):
+        SEEN_UPDATES.discard(update.update_id)
+        return web.json_response({"error": "Too busy"}, status=503)
+    if RECORDER.enabled:
+        RECORDER.update(data)
+    return web.json_response({})
+
+# === КЛАВИАТУРЫ ===
+# Собираются один раз при импорте и дальше только читаются - общие для всех хендлеров
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
+    [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
+    [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")],
+    [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
+])
+BACK_TO_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
+])
+LUNCH_CONFIRM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Да, уйти на обед", callback_data="lunch_confirm_yes")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="lunch_confirm_no")]
+])
+LUNCH_END_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⬅️ С обеда", callback_data="lunch_end")]
+])
+
+def menu_text(name):
+    return f"Привет, {name}! 👋\nВыбери действие:"
+
 # === FSM ===
 class Register(StatesGroup):
     waiting_for_name = State()
@@ -902,6 +2743,333 @@ class Register(StatesGroup):
 class ConfirmLunch(StatesGroup):
     waiting_for_confirmation = State()
 
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ НАЖАТИЙ ===
+def parse_rate_limits(spec):
+    """"join=3/10,*=10/10" -> {"join": (3.0, 10.0), "*": (10.0, 10.0)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            kind, rule = item.split("=", 1)
+            burst, per = rule.split("/", 1)
+            burst, per = float(burst), float(per)
+        except ValueError:
+            raise RuntimeError(f"❌ Неверное правило CALLBACK_RATE_LIMITS: {item!r}")
+        if burst < 1 or per <= 0:
+            raise RuntimeError(f"❌ Неверное правило CALLBACK_RATE_LIMITS: {item!r}")
+        limits[kind.strip()] = (burst, per)
+    return limits
+
+class CallbackRateLimiter:
+    """Token bucket на каждую пару (курьер, вид кнопки): burst нажатий сразу, дальше
+    по одному каждые per/burst секунд. Виды без своего правила делят общее "*".
+
+    Корзины лежат в OrderedDict по времени последнего нажатия. Корзина, простоявшая
+    дольше полного восполнения, ничем не отличается от новой - такие снимаются с
+    головы словаря при каждом нажатии, так что таблица держит только активных
+    курьеров, а проверка и очистка стоят O(1) в среднем."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = OrderedDict()  # (tg_id, вид) -> [токены, время последнего нажатия]
+
+    def kind(self, data):
+        return data if data in self.limits else "*"
+
+    def _evict(self, now):
+        while self.buckets:
+            (_, kind), (_, last) = next(iter(self.buckets.items()))
+            if now - last < self.limits[kind][1]:
+                break
+            self.buckets.popitem(last=False)
+
+    def take(self, tg_id, data):
+        """(вид, 0) если нажатие пропускаем, иначе (вид, сколько секунд ждать)."""
+        kind = self.kind(data)
+        rule = self.limits.get(kind)
+        if rule is None:
+            return kind, 0
+        burst, per = rule
+        now = time.monotonic()
+        self._evict(now)
+        key = (tg_id, kind)
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * burst / per)
+            bucket[1] = now
+        self.buckets[key] = bucket
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return kind, 0
+        return kind, (1 - bucket[0]) * per / burst
+
+RATE_LIMITER = CallbackRateLimiter(parse_rate_limits(CALLBACK_RATE_LIMITS))
+METRICS.gauge("callback_rate_buckets", lambda: len(RATE_LIMITER.buckets))
+
+@dp.callback_query.outer_middleware()
+async def rate_limit_callbacks_middleware(handler, event: CallbackQuery, data):
+    # Раньше фильтров, FSM и остальных middleware: отклонённое нажатие не трогает базу
+    kind, wait = RATE_LIMITER.take(event.from_user.id, event.data)
+    if not wait:
+        return await handler(event, data)
+    METRICS.inc("callbacks_throttled_total", kind=kind)
+    try:
+        await event.answer(f"⏳ Слишком часто! Попробуй через {max(1, round(wait))} с.")
+    except Exception as e:
+        logger.warning("Не удалось ответить на отклонённое нажатие %s: %s", event.from_user.id, e)
+
+# === СООБЩЕНИЯ КУРЬЕРОВ ===
+class CourierMessages:
+    """Текущее сообщение бота у каждого курьера (меню, очередь или "Вы на обеде").
+    Когда состояние курьера меняется без его нажатия (обед кончился по таймеру,
+    касса сняла), бот редактирует это сообщение на месте: один вызов Telegram, и
+    у курьера не остаётся живой устаревшей клавиатуры. Новое сообщение
+    отправляется, только если редактировать нечего.
+
+    Хранится в courier_messages (переживает рестарт, нужен таймерам обеда) и в
+    памяти: в базу пишем только когда id сообщения меняется, читаем один раз."""
+
+    def __init__(self):
+        self.cache = {}  # tg_id -> (chat_id, message_id) или None, если в базе нет
+
+    def get(self, tg_id):
+        # Сообщение меняют апдейты курьера, а они идут его воркеру: кэшу верим только там
+        if tg_id in self.cache and owner_of(tg_id) == WORKER_INDEX:
+            return self.cache[tg_id]
+        try:
+            with get_db() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT chat_id, message_id FROM courier_messages WHERE tg_id = %s", (tg_id,))
+                    row = cur.fetchone()
+        except DB_DOWN_ERRORS as e:
+            logger.warning("Не удалось прочитать сообщение курьера %s: %s", tg_id, e)
+            return None
+        self.cache[tg_id] = (row['chat_id'], row['message_id']) if row else None
+        return self.cache[tg_id]
+
+    def remember(self, tg_id, message):
+        ref = (message.chat.id, message.message_id)
+        if self.cache.get(tg_id) == ref:
+            return
+        self.cache[tg_id] = ref
+        try:
+            with get_db() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO courier_messages (tg_id, chat_id, message_id) VALUES (%s, %s, %s)
+                        ON CONFLICT (tg_id) DO UPDATE
+                        SET chat_id = EXCLUDED.chat_id, message_id = EXCLUDED.message_id, updated_at = NOW()
+                    """, (tg_id, *ref))
+                    conn.commit()
+        except psycopg2.Error as e:
+            # В памяти id уже есть - до рестарта этого достаточно
+            logger.warning("Не удалось сохранить сообщение курьера %s: %s", tg_id, e)
+
+    async def show(self, tg_id, text, reply_markup):
+        """Показывает курьеру text: правит его текущее сообщение, а если его нет или
+        оно больше не редактируется - отправляет новое и запоминает его."""
+        ref = self.get(tg_id)
+        if ref is not None:
+            try:
+                await bot.edit_message_text(chat_id=ref[0], message_id=ref[1], text=text, reply_markup=reply_markup)
+                METRICS.inc("courier_messages_total", result="edited")
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" in e.message:
+                    return
+                logger.info("Сообщение курьера %s не редактируется (%s), отправляем новое", tg_id, e.message)
+            except Exception as e:
+                # Сетевая ошибка: не знаем, дошла ли правка, - повторной отправкой не дублируем
+                logger.warning("Не удалось отредактировать сообщение курьера %s: %s", tg_id, e)
+                METRICS.inc("courier_messages_total", result="failed")
+                return
+        try:
+            message = await bot.send_message(chat_id=tg_id, text=text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error("Не удалось отправить сообщение курьеру %s: %s", tg_id, e)
+            METRICS.inc("courier_messages_total", result="failed")
+            return
+        METRICS.inc("courier_messages_total", result="sent")
+        self.remember(tg_id, message)
+
+COURIER_MESSAGES = CourierMessages()
+
+@dp.callback_query.middleware()
+async def remember_courier_message_middleware(handler, event: CallbackQuery, data):
+    # Кнопки курьера живут на сообщении, которое хендлер сейчас отредактирует, -
+    # оно и становится текущим. Хендлеры, отправляющие новое, запоминают его сами.
+    message = event.message
+    if isinstance(message, Message) and message.chat.id == event.from_user.id:
+        COURIER_MESSAGES.remember(event.from_user.id, message)
+    return await handler(event, data)
+
+# === РАССЫЛКИ ===
+def create_broadcast(target, text, created_by=None):
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            result = broadcast.create(cur, target, text, created_by)
+            conn.commit()
+            return result
+
+def broadcast_db(func, *args):
+    """Вызывает функцию broadcast.* в отдельной транзакции (из потока)."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            result = func(cur, *args)
+            conn.commit()
+            return result
+
+class BroadcastSender:
+    """Отправляет рассылки в фоне, не мешая ответам курьерам.
+
+    Все рассылки делят один темп (BROADCAST_RATE сообщений в секунду) и не больше
+    BROADCAST_CONCURRENCY одновременных запросов к Bot API - остальная часть
+    лимита Telegram и пула соединений остаётся хендлерам. Получатели берутся из
+    базы пачками по BROADCAST_BATCH, результаты пачки записываются одним запросом;
+    на время пачки работа учтена в INFLIGHT, так что при остановке пачка
+    дописывается, а следующая уже не начинается. RetryAfter от Telegram
+    приостанавливает все отправки на указанное время, недоступность базы -
+    только шаги рассылки, которым нужна база (см. _db)."""
+
+    MAX_ATTEMPTS = 3  # попыток на получателя при сетевых ошибках
+    DB_RETRY_MAX = 30  # предел паузы между попытками достучаться до базы, секунды
+
+    def __init__(self, rate, concurrency, batch):
+        self.interval = 1 / rate
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch = batch
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.tasks = {}  # id рассылки -> asyncio.Task
+
+    def start(self, broadcast_id):
+        # Отправляет только основной воркер (общий темп); созданные в других он
+        # подхватит в poll_broadcasts_loop
+        if broadcast_id in self.tasks or not is_primary():
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self.tasks[broadcast_id] = task
+        task.add_done_callback(lambda t: self.tasks.pop(broadcast_id, None))
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные прошлой остановкой."""
+        for broadcast_id in await asyncio.to_thread(broadcast_db, broadcast.unfinished):
+            if broadcast_id not in self.tasks:
+                logger.info("Продолжаем рассылку #%s", broadcast_id)
+                self.start(broadcast_id)
+
+    async def _pace(self):
+        now = time.monotonic()
+        slot = max(self.next_slot, self.paused_until, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, tg_id, text):
+        """(tg_id, статус, ошибка) для broadcast.record."""
+        attempts, error = 0, None
+        async with self.semaphore:
+            while attempts < self.MAX_ATTEMPTS:
+                await self._pace()
+                try:
+                    await bot.send_message(chat_id=tg_id, text=text)
+                    return tg_id, broadcast.DELIVERED, None
+                except TelegramRetryAfter as e:
+                    METRICS.inc("broadcast_retry_after_total")
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                except TelegramUnavailable:
+                    # Попытку не тратим: ждём, пока предохранитель пропустит пробу
+                    await asyncio.sleep(max(TELEGRAM_BREAKER.retry_in(), 0.5))
+                except TelegramForbiddenError as e:
+                    return tg_id, broadcast.BLOCKED, e.message
+                except TelegramBadRequest as e:
+                    return tg_id, broadcast.FAILED, e.message
+                except Exception as e:
+                    attempts, error = attempts + 1, str(e)
+                    await asyncio.sleep(attempts)
+        return tg_id, broadcast.FAILED, error
+
+    async def _db(self, func, *args):
+        """broadcast_db в потоке. Пока база недоступна (работаем по журналу или
+        соединение не удалось), ждём с удвоением паузы до DB_RETRY_MAX, а не бросаем
+        рассылку: иначе уже отправленная пачка осталась бы незаписанной. При
+        остановке ошибка отдаётся - рассылку продолжит следующий старт."""
+        delay = 1
+        while True:
+            error = None
+            if not OFFLINE.active:
+                try:
+                    return await asyncio.to_thread(broadcast_db, func, *args)
+                except DB_DOWN_ERRORS as e:
+                    error = e
+            if SHUTDOWN.draining:
+                raise error or DatabaseUnavailable("база недоступна")
+            METRICS.inc("broadcast_db_retries_total")
+            logger.warning("Рассылка ждёт базу %s с (%s): %s", delay, func.__name__,
+                           error or "работаем по журналу")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.DB_RETRY_MAX)
+
+    async def _run(self, broadcast_id):
+        try:
+            info = await self._db(broadcast.get, broadcast_id)
+            while True:
+                if SHUTDOWN.draining:
+                    logger.info("Рассылка #%s прервана остановкой, продолжится после старта", broadcast_id)
+                    return
+                with INFLIGHT.track("broadcasts"):
+                    recipients = await self._db(broadcast.pending, broadcast_id, self.batch)
+                    if not recipients:
+                        break
+                    results = await asyncio.gather(*(self._send(tg_id, info['text']) for tg_id in recipients))
+                    await self._db(broadcast.record, broadcast_id, results)
+                for _, status, _ in results:
+                    METRICS.inc("broadcast_messages_total", status=status)
+            await self._db(broadcast.finish, broadcast_id)
+            counts = await self._db(broadcast.report, broadcast_id)
+        except Exception as e:
+            logger.error("Рассылка #%s остановлена ошибкой: %s", broadcast_id, e)
+            return
+        logger.info("Рассылка #%s завершена: %s", broadcast_id, counts)
+        if info['created_by']:
+            try:
+                await bot.send_message(chat_id=info['created_by'], text=format_broadcast_report(broadcast_id, counts))
+            except Exception as e:
+                logger.warning("Не удалось отправить итог рассылки #%s: %s", broadcast_id, e)
+
+BROADCASTS = BroadcastSender(BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH)
+METRICS.gauge("broadcasts_running", lambda: len(BROADCASTS.tasks))
+
+async def poll_broadcasts_loop(interval=5):
+    """Основной воркер: подхватывает рассылки, созданные другими воркерами, и
+    перезапускает остановленные ошибкой (их задача уже завершилась)."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await BROADCASTS.resume()
+        except Exception as e:
+            logger.warning("Не удалось проверить новые рассылки: %s", e)
+
+def format_broadcast_report(broadcast_id, counts):
+    return (f"📣 Рассылка #{broadcast_id} завершена.\n"
+            f"✅ Доставлено: {counts[broadcast.DELIVERED]}\n"
+            f"🚫 Заблокировали бота: {counts[broadcast.BLOCKED]}\n"
+            f"❌ Ошибки: {counts[broadcast.FAILED]}")
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(m: Message, command: CommandObject):
+    """/broadcast all|queue|lunch текст - рассылка всем курьерам, стоящим в очереди или на обеде."""
+    if m.from_user.id not in ADMIN_IDS:
+        return
+    target, _, text = (command.args or "").partition(" ")
+    if target not in broadcast.TARGETS or not text.strip():
+        await m.answer("Формат: /broadcast all|queue|lunch текст")
+        return
+    broadcast_id, recipients = create_broadcast(target, text.strip(), m.from_user.id)
+    BROADCASTS.start(broadcast_id)
+    await m.answer(f"📣 Рассылка #{broadcast_id} запущена, получателей: {recipients}. Пришлю итог, когда закончится.")
+
 # === ХЕНДЛЕРЫ БОТА ===
 router = Router() # Создайте роутер или используйте dp
 
@@ -909,12 +3077,9 @@ router = Router() # Создайте роутер или используйте
 @router.callback_query(F.data == "refresh_main_menu") # Или кнопку "refresh_main_menu"
 async def send_refreshed_menu(event: Union[Message, CallbackQuery], state: FSMContext):
     # Получаем информацию о пользователе
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (event.from_user.id,))
-            user = cur.fetchone()
+    courier_name = get_courier_name(event.from_user.id)
 
-    if not user:
+    if not courier_name:
         # Если пользователь не найден, возможно, нужно сбросить состояние и попросить регистрацию
         await state.clear()
         await event.message.answer("👋 Добро пожаловать!\nПожалуйста, укажи своё *имя и фамилию*:", parse_mode="Markdown")
@@ -922,22 +3087,18 @@ async def send_refreshed_menu(event: Union[Message, CallbackQuery], state: FSMCo
         return
 
     # Создаём обновлённое меню
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-        [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-        [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")], # <-- Новая кнопка
-        [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-    ])
+    kb = MAIN_MENU_KB
 
     # Проверяем, какое событие вызвало функцию
     if isinstance(event, Message):
         # Если это команда, отправляем новое сообщение
-        await event.answer(f"Привет, {user['name']}! 👋\nВыбери действие:", reply_markup=kb)
+        sent = await event.answer(menu_text(courier_name), reply_markup=kb)
     elif isinstance(event, CallbackQuery):
         # Если это нажатие кнопки, сначала отвечаем на callback
         await event.answer()
         # Затем отправляем новое сообщение с меню
-        await event.message.answer(f"Привет, {user['name']}! 👋\nВыбери действие:", reply_markup=kb)
+        sent = await event.message.answer(menu_text(courier_name), reply_markup=kb)
+    COURIER_MESSAGES.remember(event.from_user.id, sent)
 
 # Не забудьте зарегистрировать роутер в диспетчере
 # dp.include_router(router) # Раскомментируйте, если используете роутеры
@@ -948,21 +3109,14 @@ dp.callback_query(F.data == "refresh_main_menu")(send_refreshed_menu)
 @dp.message(Command("start"))
 async def start(m: Message, state: FSMContext):
     await state.clear()
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (m.from_user.id,))
-            user = cur.fetchone()
+    courier_name = get_courier_name(m.from_user.id)
 
-    if user:
+    if courier_name:
         # КНОПКА ОБЕД ДОБАВЛЕНА СЮДА
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-            [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-            [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")], # <-- Новая кнопка
-            [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-        ])
+        kb = MAIN_MENU_KB
         # Отправляем НОВОЕ сообщение с обновлённой клавиатурой
-        await m.answer(f"Привет, {user['name']}! 👋\nВыбери действие:", reply_markup=kb)
+        sent = await m.answer(menu_text(courier_name), reply_markup=kb)
+        COURIER_MESSAGES.remember(m.from_user.id, sent)
     else:
         await m.answer("👋 Добро пожаловать!\nПожалуйста, укажи своё *имя и фамилию*:", parse_mode="Markdown")
         await state.set_state(Register.waiting_for_name)
@@ -982,144 +3136,97 @@ async def process_name(m: Message, state: FSMContext):
                     "ON CONFLICT (tg_id) DO UPDATE SET name = %s",
                     (m.from_user.id, name, name)
                 )
+                PEERS.publish(cur, "name", m.from_user.id, name=name)
                 conn.commit()
+        OFFLINE.names[m.from_user.id] = name
+        bump_queue_version() # имя могло измениться - снимок очереди устарел
         await m.answer(f"✅ Привет, *{name}*! Теперь ты в системе.", parse_mode="Markdown")
         await start(m, state)
     except Exception as e:
         await m.answer("❌ Ошибка регистрации. Попробуй ещё раз.")
-        logger.error(f"Ошибка регистрации пользователя {m.from_user.id}: {e}")
+        logger.error("Ошибка регистрации пользователя %s: %s", m.from_user.id, e)
 
 @dp.callback_query(F.data == "join")
 async def join_btn(c: CallbackQuery, state: FSMContext): # Добавляем state
     tg_id = c.from_user.id
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
-            user = cur.fetchone()
-            if not user:
-                await c.answer("⛔ Сначала зарегистрируйся", show_alert=True)
-                return
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+        await c.answer("⛔ Сначала зарегистрируйся", show_alert=True)
+        return
 
-            cur.execute("SELECT 1 FROM queue WHERE tg_id = %s", (tg_id,))
-            if cur.fetchone():
-                await c.answer("✅ Ты уже в очереди! Сначала выйди через 🚪 Выйти", show_alert=True)
-                return
+    if is_in_queue(tg_id):
+        await c.answer("✅ Ты уже в очереди! Сначала выйди через 🚪 Выйти", show_alert=True)
+        return
 
     add_to_queue(tg_id)
     pos = get_queue_position(tg_id)
-    log_action(tg_id, user['name'], "Встал в очередь")
-    await c.answer(f"✅ Ты №{pos} в очереди!", show_alert=True)
+    log_action(tg_id, courier_name, "Встал в очередь")
+    eta = format_eta(ETA.estimate(pos))
+    await c.answer(f"✅ Ты №{pos} в очереди!" + (f"\n⏳ Ожидание {eta}" if eta else ""), show_alert=True)
 
     # --- НОВОЕ: Отправляем обновлённое меню ---
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-        [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-        [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")], # <-- Новая кнопка
-        [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-    ])
+    kb = MAIN_MENU_KB
     try:
         await bot.edit_message_text(
             chat_id=c.from_user.id,
             message_id=c.message.message_id,
-            text=f"Привет, {user['name']}! 👋\nВыбери действие:", # Используем имя из запроса выше
+            text=menu_text(courier_name), # Используем имя из запроса выше
             reply_markup=kb,
             parse_mode="Markdown"
         )
     except TelegramBadRequest as e:
         if "message is not modified" in e.message:
             # Сообщение не изменилось, это не ошибка, просто логируем
-            logger.info(f"Сообщение для пользователя {tg_id} не изменилось при попытке редактирования в join_btn.")
+            logger.debug("Сообщение для пользователя %s не изменилось при попытке редактирования в join_btn.", tg_id)
         else:
             # Другая ошибка TelegramBadRequest
-            logger.error(f"Ошибка Telegram при редактировании сообщения в join_btn для {tg_id}: {e}")
+            logger.error("Ошибка Telegram при редактировании сообщения в join_btn для %s: %s", tg_id, e)
 
 @dp.callback_query(F.data == "leave")
 async def leave_btn(c: CallbackQuery, state: FSMContext):
     tg_id = c.from_user.id
     # Получаем имя курьера заранее, чтобы использовать в логе
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
-            user = cur.fetchone()
-            if not user:
-                await c.answer("❌ Произошла ошибка при выходе из очереди.", show_alert=True)
-                logger.error(f"Курьер {tg_id} не найден в таблице couriers при попытке выйти из очереди.")
-                return
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+        await c.answer("❌ Произошла ошибка при выходе из очереди.", show_alert=True)
+        logger.error("Курьер %s не найден в таблице couriers при попытке выйти из очереди.", tg_id)
+        return
 
     # Логируем попытку выйти из очереди
-    was_in_queue = False
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM queue WHERE tg_id = %s", (tg_id,))
-            if cur.fetchone():
-                was_in_queue = True
+    was_in_queue = is_in_queue(tg_id)
 
-    changed = remove_from_queue(tg_id)
+    changed = remove_from_queue(tg_id, "left")
 
     # Логируем действие "ушел из очереди", только если он реально был в очереди
     if was_in_queue:
-        log_action(tg_id, user['name'], "Вышел из очереди") # Передаём user['name']
+        log_action(tg_id, courier_name, "Вышел из очереди") # Передаём courier_name
 
     await c.answer("Ты вышел из очереди." if changed else "Тебя не было в очереди.", show_alert=True)
 
     # --- НОВОЕ: Отправляем обновлённое меню ---
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-        [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-        [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")],
-        [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-    ])
+    kb = MAIN_MENU_KB
     try:
         await bot.edit_message_text(
             chat_id=c.from_user.id,
             message_id=c.message.message_id,
-            text=f"Привет, {user['name']}! 👋\nВыбери действие:", # Используем имя из запроса выше
+            text=menu_text(courier_name), # Используем имя из запроса выше
             reply_markup=kb,
             parse_mode="Markdown"
         )
     except TelegramBadRequest as e:
         if "message is not modified" in e.message:
-            logger.info(f"Сообщение для пользователя {tg_id} не изменилось при попытке редактирования в leave_btn.")
+            logger.debug("Сообщение для пользователя %s не изменилось при попытке редактирования в leave_btn.", tg_id)
         else:
-            logger.error(f"Ошибка Telegram при редактировании сообщения в leave_btn для {tg_id}: {e}")
+            logger.error("Ошибка Telegram при редактировании сообщения в leave_btn для %s: %s", tg_id, e)
 
 # --- ИЗМЕНЕННЫЙ ХЕНДЛЕР show_queue (редактирует текущее сообщение) ---
 @dp.callback_query(F.data == "show_queue")
 async def show_queue(c: CallbackQuery):
-    # Вместо get_queue(), используем get_queue_and_lunching()
-    all_rows = get_queue_and_lunching()
+    # Текст берём из кэша отрисовки: при неизменной очереди запросов к БД нет
+    await QUEUE_RENDER.ensure(QUEUE_READ_TTL_BOT)
+    text = QUEUE_RENDER.bot_text()
 
-    if not all_rows:
-        text = "Очередь пуста."
-    else:
-        # Разделяем очередь и обедающих
-        queue_items = [row for row in all_rows if row['source'] == 'queue']
-        lunch_items = [row for row in all_rows if row['source'] == 'lunch']
-
-        # Формируем строки для очереди
-        queue_lines = [f"{i+1}. {row['name']}" for i, row in enumerate(queue_items)]
-
-        # Формируем строки для обедающих
-        # Рассчитаем оставшееся время для обедающих вручную, как в api_queue
-        lunch_lines = []
-        for row in lunch_items:
-            start_time = row["time_info"]
-            elapsed = (datetime.now(start_time.tzinfo) - start_time).total_seconds()
-            remaining_seconds = max(0, 20 * 60 - elapsed) # 20 минут = 1200 секунд
-            formatted_time = format_time_for_display(int(remaining_seconds))
-            lunch_lines.append(f"- {row['name']} (обед, осталось {formatted_time})")
-
-        # Объединяем списки
-        all_lines = queue_lines + lunch_lines
-
-        if all_lines:
-            text = "📋 *Текущая очередь и обед:* \n" + "\n".join(all_lines)
-        else:
-            text = "Очередь пуста."
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
-    ])
+    kb = BACK_TO_MENU_KB
 
     # Редактируем текущее сообщение (из которого нажали кнопку "Список")
     try:
@@ -1132,43 +3239,36 @@ async def show_queue(c: CallbackQuery):
         )
     except Exception as e:
         # Если не удалось отредактировать (например, сообщение слишком старое), отправим новое
-        logger.warning(f"Не удалось отредактировать сообщение с очередью: {e}")
-        await c.message.answer(text, parse_mode="Markdown", reply_markup=kb)
+        logger.warning("Не удалось отредактировать сообщение с очередью: %s", e)
+        sent = await c.message.answer(text, parse_mode="Markdown", reply_markup=kb)
+        COURIER_MESSAGES.remember(c.from_user.id, sent)
     await c.answer() # Ответим на callback
 
 # --- ИЗМЕНЕННЫЙ ХЕНДЛЕР back_to_menu (редактирует текущее сообщение) ---
 @dp.callback_query(F.data == "back_to_menu")
 async def back_to_menu(c: CallbackQuery, state: FSMContext):
     # Повторяем логику start, но для редактирования текущего сообщения
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (c.from_user.id,))
-            user = cur.fetchone()
+    courier_name = get_courier_name(c.from_user.id)
 
-    if user:
+    if courier_name:
         # КНОПКА ОБЕД ДОБАВЛЕНА СЮДА
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-            [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-            [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")], # <-- Новая кнопка
-            [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-        ])
+        kb = MAIN_MENU_KB
         # Редактируем текущее сообщение (из которого нажали кнопку "Назад")
         try:
             await bot.edit_message_text(
                 chat_id=c.from_user.id,
                 message_id=c.message.message_id, # ID текущего сообщения
-                text=f"Привет, {user['name']}! 👋\nВыбери действие:",
+                text=menu_text(courier_name),
                 reply_markup=kb,
                 parse_mode="Markdown"
             )
         except TelegramBadRequest as e:
             if "message is not modified" in e.message:
-                logger.info(f"Сообщение для пользователя {c.from_user.id} не изменилось при попытке редактирования в back_to_menu.")
+                logger.debug("Сообщение для пользователя %s не изменилось при попытке редактирования в back_to_menu.", c.from_user.id)
             else:
-                logger.error(f"Ошибка Telegram при редактировании сообщения в back_to_menu для {c.from_user.id}: {e}")
+                logger.error("Ошибка Telegram при редактировании сообщения в back_to_menu для %s: %s", c.from_user.id, e)
                 # Если редактирование не удалось, отправим новое сообщение
-                await c.message.edit_text(f"Привет, {user['name']}! 👋\nВыбери действие:", reply_markup=kb, parse_mode="Markdown")
+                await c.message.edit_text(menu_text(courier_name), reply_markup=kb, parse_mode="Markdown")
     else:
         await c.message.edit_text("👋 Добро пожаловать!\nПожалуйста, укажи своё *имя и фамилию*:", parse_mode="Markdown")
         await state.set_state(Register.waiting_for_name)
@@ -1179,42 +3279,29 @@ async def back_to_menu(c: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "lunch_start")
 async def lunch_start_request(c: CallbackQuery, state: FSMContext):
     tg_id = c.from_user.id
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
-            user = cur.fetchone()
-            if not user:
-                await c.answer("❌ Произошла ошибка.", show_alert=True)
-                return
-            courier_name = user['name']
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+        await c.answer("❌ Произошла ошибка.", show_alert=True)
+        return
 
     # Проверяем, не на обеде ли уже
     if get_current_lunch_session(tg_id):
         await c.answer("❌ Вы уже на обеде!", show_alert=True)
         return
-    # Проверяем лимит обедов за день (2)
-    lunch_count = get_lunch_count_today(tg_id)
-    if lunch_count >= 2:
-        await c.answer("❌ Вы уже уходили на обеды сегодня (2 раза).", show_alert=True)
+    # Проверяем лимит обедов за смену (счётчик в памяти, без запроса)
+    if not LUNCH_COUNTERS.allowed(tg_id, datetime.now(timezone.utc)):
+        await c.answer(f"❌ Вы уже уходили на обед в эту смену ({LUNCH_POLICY.max_per_shift} раз).", show_alert=True)
         return
     # Проверяем, в очереди ли курьер
-    is_in_queue = False
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM queue WHERE tg_id = %s", (tg_id,))
-            if cur.fetchone():
-                is_in_queue = True
+    in_queue = is_in_queue(tg_id)
     # Отправляем предупреждение и спрашиваем подтверждение
     confirmation_message = f"🍽️ Вы хотите уйти на обед?\n\n"
-    if is_in_queue:
+    if in_queue:
         confirmation_message += "⚠️ Вы покинете очередь.\n"
-    confirmation_message += "⏱️ Обед длится 20 минут. После этого вы автоматически встанете в очередь\n"
-    confirmation_message += "📌 За смену можно уходить на обед не более 2-х раз\n\n"
+    confirmation_message += f"⏱️ Обед длится {LUNCH_POLICY.duration_minutes} минут. После этого вы автоматически встанете в очередь\n"
+    confirmation_message += f"📌 За смену можно уходить на обед не более {LUNCH_POLICY.max_per_shift} раз\n\n"
     confirmation_message += "Нажмите 'Да, уйти на обед' для подтверждения."
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Да, уйти на обед", callback_data="lunch_confirm_yes")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="lunch_confirm_no")]
-    ])
+    kb = LUNCH_CONFIRM_KB
     await c.message.edit_text(confirmation_message, reply_markup=kb)
     await state.set_state(ConfirmLunch.waiting_for_confirmation)
     await c.answer()
@@ -1222,31 +3309,31 @@ async def lunch_start_request(c: CallbackQuery, state: FSMContext):
 @dp.callback_query(StateFilter(ConfirmLunch.waiting_for_confirmation), F.data == "lunch_confirm_yes")
 async def lunch_start_confirm(c: CallbackQuery, state: FSMContext):
     tg_id = c.from_user.id
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
-            user = cur.fetchone()
-            if not user:
-                await c.answer("❌ Произошла ошибка.", show_alert=True)
-                await state.clear()
-                return
-            courier_name = user['name']
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+        await c.answer("❌ Произошла ошибка.", show_alert=True)
+        await state.clear()
+        return
     # Проверяем, не на обеде ли уже (на всякий случай)
     if get_current_lunch_session(tg_id):
         await c.answer("❌ Вы уже на обеде!", show_alert=True)
         await state.clear()
         return
-    # Удаляем из очереди (если был)
-    was_in_queue = remove_from_queue(tg_id)
+    # Лимит мог исчерпаться, пока висело подтверждение (другое окно, смена сменилась)
+    if not LUNCH_COUNTERS.allowed(tg_id, datetime.now(timezone.utc)):
+        await c.answer(f"❌ Вы уже уходили на обед в эту смену ({LUNCH_POLICY.max_per_shift} раз).", show_alert=True)
+        await state.clear()
+        return
+    # Удаляем из очереди (если был); ключ места - из самого DELETE, при
+    # QUEUE_POLICY=return_slot курьер на это место вернётся
+    slot = take_from_queue(tg_id, "lunch")
     # Создаём сессию обеда
-    session_id = start_lunch_session(tg_id, courier_name)
+    session_id = start_lunch_session(tg_id, courier_name, slot)
     # Отредактируем сообщение: только кнопка "С обеда"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ С обеда", callback_data="lunch_end")]
-    ])
-    await c.message.edit_text(f"🍽️ Вы на обеде, осталось 20 минут!", reply_markup=kb)
-    # Запускаем задачу на 20 минут
-    asyncio.create_task(auto_return_from_lunch(session_id, tg_id, courier_name))
+    kb = LUNCH_END_KB
+    await c.message.edit_text(f"🍽️ Вы на обеде, осталось {LUNCH_POLICY.duration_minutes} минут!", reply_markup=kb)
+    # Запускаем таймер на длительность обеда
+    schedule_lunch_return(session_id, tg_id, courier_name)
     await state.clear()
     await c.answer()
 
@@ -1259,14 +3346,10 @@ async def lunch_start_cancel(c: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "lunch_end")
 async def lunch_end_manual(c: CallbackQuery):
     tg_id = c.from_user.id
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
-            user = cur.fetchone()
-            if not user:
-                await c.answer("❌ Произошла ошибка.", show_alert=True)
-                return
-            courier_name = user['name']
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+        await c.answer("❌ Произошла ошибка.", show_alert=True)
+        return
 
     session_info = get_current_lunch_session(tg_id)
     if not session_info:
@@ -1275,38 +3358,28 @@ async def lunch_end_manual(c: CallbackQuery):
         await c.answer("Вы уже не на обеде!", show_alert=True) # Уведомление
 
         # Создаём обновлённое меню
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-            [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-            [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")], # Возвращаем кнопку обеда
-            [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-        ])
+        kb = MAIN_MENU_KB
         # Редактируем *текущее* сообщение (в котором была нажата кнопка "С обеда")
         await bot.edit_message_text(
             chat_id=c.from_user.id,
             message_id=c.message.message_id,
-            text=f"Привет, {courier_name}! 👋\nВыбери действие:",
+            text=menu_text(courier_name),
             reply_markup=kb,
             parse_mode="Markdown"
         )
         return # Завершаем выполнение функции здесь
 
     # --- Старая логика для ручного завершения сессии ---
-    session_id = session_info['session_id']
+    session_id = session_info.session_id
     ended = end_lunch_session(session_id, tg_id, courier_name)
 
     if ended:
         # Возвращаем в очередь
-        add_to_queue(tg_id)
+        add_to_queue(tg_id, session_info.return_key)
         pos = get_queue_position(tg_id)
 
         # Отредактируем сообщение: обычные кнопки
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-            [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-            [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")], # Возвращаем кнопку обеда
-            [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-        ])
+        kb = MAIN_MENU_KB
         await c.message.edit_text(f"✅ Вы вернулись с обеда и встали в очередь. Ваша позиция: {pos}", reply_markup=kb)
     else:
         # Сессия уже была завершена (например, автоматически) - это случай, который теперь обрабатывается в `if not session_info:`
@@ -1315,213 +3388,984 @@ async def lunch_end_manual(c: CallbackQuery):
 
     await c.answer()
 
-async def auto_return_from_lunch(session_id, tg_id, courier_name):
-    """Фоновая задача, которая возвращает курьера в очередь через 20 минут."""
-    await asyncio.sleep(20 * 60) # 20 минут в секундах
+# Активные таймеры обеда: session_id -> asyncio.Task
+LUNCH_TIMERS = {}
+
+def schedule_lunch_return(session_id, tg_id, courier_name, delay=LUNCH_POLICY.duration):
+    """Запускает таймер авто-возврата с обеда и запоминает его в LUNCH_TIMERS."""
+    task = asyncio.create_task(auto_return_from_lunch(session_id, tg_id, courier_name, delay))
+    LUNCH_TIMERS[session_id] = task
+    task.add_done_callback(lambda t: LUNCH_TIMERS.pop(session_id, None))
+    return task
 
+def get_active_lunch_sessions():
+    """Все незавершённые сессии обеда с именами курьеров (для восстановления таймеров)."""
+    with get_db() as conn:
+        with tuple_cursor(conn) as cur:
+            cur.execute("""
+                SELECT ls.session_id, ls.tg_id, ls.start_time, ls.end_time, ls.return_key, c.name
+                FROM lunch_sessions ls
+                JOIN couriers c ON ls.tg_id = c.tg_id
+                WHERE ls.end_time IS NULL
+            """)
+            return fetch_all(cur, LunchSession)
+
+async def restore_lunch_timers():
+    """После рестарта заново ставит таймеры для тех, кто ещё на обеде."""
+    sessions = await asyncio.to_thread(get_active_lunch_sessions)
+    # Таймер курьера живёт у воркера-владельца - там же, где его апдейты
+    sessions = [session for session in sessions if owner_of(session.tg_id) == WORKER_INDEX]
+    for session in sessions:
+        if session.session_id in LUNCH_TIMERS:
+            continue
+        now = datetime.now(session.start_time.tzinfo)
+        schedule_lunch_return(session.session_id, session.tg_id, session.name, LUNCH_POLICY.remaining(session.start_time, now))
+    logger.info("Восстановлено таймеров обеда: %s", len(sessions))
+
+async def auto_return_from_lunch(session_id, tg_id, courier_name, delay=LUNCH_POLICY.duration):
+    """Фоновая задача, которая возвращает курьера в очередь по окончании обеда."""
+    await asyncio.sleep(delay) # по умолчанию - вся длительность обеда, в секундах
+    # Дальше работа уже начата: снимаем таймер из LUNCH_TIMERS, чтобы остановка
+    # не отменила его на середине, а дождалась через INFLIGHT
+    LUNCH_TIMERS.pop(session_id, None)
+    with INFLIGHT.track("timers"):
+        await _finish_lunch_by_timer(session_id, tg_id, courier_name)
+
+async def _finish_lunch_by_timer(session_id, tg_id, courier_name):
+    """Завершает обед по таймеру и возвращает курьера в очередь."""
     # Проверяем, не завершена ли сессия вручную
     session_info = get_current_lunch_session(tg_id)
-    if session_info and session_info['session_id'] == session_id:
+    if session_info and session_info.session_id == session_id:
         # Сессия всё ещё активна, завершаем её автоматически
         ended = end_lunch_session(session_id, tg_id, courier_name)
         if ended:
             # Возвращаем в очередь
-            add_to_queue(tg_id)
+            add_to_queue(tg_id, session_info.return_key)
             pos = get_queue_position(tg_id)
-            logger.info(f"Курьер {courier_name} (ID: {tg_id}) автоматически вернулся в очередь после обеда. Позиция: {pos}.")
+            logger.info("Курьер %s (ID: %s) автоматически вернулся в очередь после обеда. Позиция: %s.", courier_name, tg_id, pos)
 
-            # Отправляем сообщение курьеру (опционально)
-            try:
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Встать в очередь", callback_data="join")],
-                    [InlineKeyboardButton(text="🚪 Выйти из очереди", callback_data="leave")],
-                    [InlineKeyboardButton(text="🍽️ Обед", callback_data="lunch_start")],
-                    [InlineKeyboardButton(text="📋 Список", callback_data="show_queue")]
-                ])
-                await bot.edit_message_text(
-                    chat_id=tg_id,
-                    message_id=..., # Нужно хранить ID сообщения об обеде, чтобы его отредактировать
-                    text=f"⏱️ Обед закончился! Вы автоматически встали в очередь. Ваша позиция: {pos}",
-                    reply_markup=kb
-                )
-            except Exception as e:
-                logger.warning(f"Не удалось отредактировать сообщение после авто-возврата из обеда для {tg_id}: {e}")
-                # Альтернатива: отправить новое сообщение
-                try:
-                    await bot.send_message(
-                        chat_id=tg_id,
-                        text=f"⏱️ Обед закончился! Вы автоматически встали в очередь. Ваша позиция: {pos}"
-                    )
-                except Exception as e2:
-                    logger.error(f"Не удалось отправить сообщение после авто-возврата из обеда для {tg_id}: {e2}")
+            # Меняем "Вы на обеде" на меню прямо в сообщении об обеде
+            await COURIER_MESSAGES.show(
+                tg_id,
+                f"⏱️ Обед закончился! Вы автоматически встали в очередь. Ваша позиция: {pos}",
+                MAIN_MENU_KB,
+            )
 
 # === AIOHTTP маршруты ===
 async def api_queue(request: Request) -> Response:
     try:
-        rows = get_queue_and_lunching()
-        # Возвращаем список объектов с name, tg_id и source
-        response_data = []
-        for row in rows:
-            item = {"name": row["name"], "tg_id": row["tg_id"], "source": row["source"]}
-            if row["source"] == 'lunch':
-                # Добавляем признак обеда и оставшееся время (в секундах)
-                # row["time_info"] доступен благодаря изменению в get_lunching_couriers
-                start_time = row["time_info"]
-                elapsed = (datetime.now(start_time.tzinfo) - start_time).total_seconds()
-                remaining_seconds = max(0, 20 * 60 - elapsed) # 20 минут = 1200 секунд
-                item["remaining_seconds"] = int(remaining_seconds)
-            # Не добавляем remaining_seconds для 'queue'
-            response_data.append(item)
-
-        return web.json_response(response_data)
+        # Готовые JSON-байты из кэша отрисовки: name, tg_id, source, а для обеда
+        # ещё remaining_seconds и lunch_ends_at (unix-время конца обеда)
+        headers = {"X-Cashier-Version": CASHIER_VERSION}
+        if QUEUE_RENDER.version is None:
+            await QUEUE_RENDER.ensure(QUEUE_READ_TTL_API)
+        else:
+            # Медленная база не должна держать кассу: после QUEUE_READ_DEADLINE отдаём
+            # предыдущий снимок, а загрузка продолжается для следующих запросов
+            refresh = asyncio.ensure_future(QUEUE_RENDER.ensure(QUEUE_READ_TTL_API))
+            try:
+                await asyncio.wait_for(asyncio.shield(refresh), QUEUE_READ_DEADLINE)
+            except asyncio.TimeoutError:
+                refresh.add_done_callback(lambda t: t.cancelled() or t.exception())
+                METRICS.inc("queue_reads_deadline_total")
+                headers["X-Queue-Stale"] = "1"
+        return web.Response(body=QUEUE_RENDER.api_json(), content_type="application/json", headers=headers)
     except Exception as e:
-        logger.error(f"Ошибка в /api/queue: {e}")
+        logger.error("Ошибка в /api/queue: %s", e)
         return web.json_response({"error": "Internal Server Error"}, status=500)
 
-# --- МАРШРУТ ДЛЯ ВЫЗОВА КУРЬЕРА ---
-async def api_call_courier(request: Request) -> Response:
-    try:
-        # Попробуем получить JSON, но обернем в try-except
+# --- ЗАЩИТА ОТ ДВОЙНЫХ НАЖАТИЙ В КАССЕ ---
+class IdempotencyCache:
+    """Недавние результаты операций кассы по ключу. Повтор с тем же ключом, пока запись
+    жива, получает сохранённый ответ (а одновременный повтор - дожидается первого),
+    не доходя ни до БД, ни до Telegram. Ответы 5xx не кэшируются."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # ключ -> (истекает_в, future с (payload, status))
+
+    def _evict(self, now):
+        while self.entries:
+            key, (expires_at, fut) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+
+    async def run(self, key, ttl, func):
+        """Возвращает (payload, status, повтор_ли)."""
+        now = time.monotonic()
+        self._evict(now)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            METRICS.inc("cashier_duplicates_total", action=key.split(":", 1)[0])
+            payload, status = await asyncio.shield(entry[1])
+            return payload, status, True
+
+        fut = asyncio.get_running_loop().create_future()
+        self.entries[key] = (now + ttl, fut)
         try:
-            data = await request.json()
-        except Exception as e:
-            logger.error(f"Ошибка парсинга JSON в /api/call_courier: {e}")
-            return web.json_response({"error": f"Invalid JSON format: {str(e)}"}, status=400)
-
-        tg_id = data.get("tg_id")
+            payload, status = await func()
+        except BaseException as e:
+            self.entries.pop(key, None)
+            fut.set_exception(e)
+            fut.exception()  # помечаем как полученное, чтобы не было предупреждений
+            raise
+        if status >= 500:
+            self.entries.pop(key, None)
+        fut.set_result((payload, status))
+        return payload, status, False
+
+CASHIER_IDEMPOTENCY = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE)
+
+async def run_idempotent(request: Request, action, tg_id, func) -> Response:
+    """Ключ - заголовок Idempotency-Key (живёт IDEMPOTENCY_KEY_TTL), а без него -
+    пара (действие, tg_id) в коротком окне CASHIER_DEDUP_WINDOW."""
+    header_key = request.headers.get("Idempotency-Key")
+    if header_key:
+        key, ttl = f"{action}:key:{header_key}", IDEMPOTENCY_KEY_TTL
+    else:
+        key, ttl = f"{action}:{tg_id}", CASHIER_DEDUP_WINDOW
+    payload, status, replayed = await CASHIER_IDEMPOTENCY.run(key, ttl, func)
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return web.json_response(payload, status=status, headers=headers)
+
+async def read_tg_id(request: Request, route):
+    """Достаёт tg_id из JSON тела запроса кассы. Возвращает (tg_id, ответ_с_ошибкой)."""
+    # Попробуем получить JSON, но обернем в try-except
+    try:
+        data = await request.json()
+    except Exception as e:
+        logger.error("Ошибка парсинга JSON в %s: %s", route, e)
+        return None, web.json_response({"error": f"Invalid JSON format: {str(e)}"}, status=400)
 
-        if tg_id is None: # Проверяем на None, а не на пустое значение
-            return web.json_response({"error": "Missing tg_id"}, status=400)
+    tg_id = data.get("tg_id")
+    if tg_id is None: # Проверяем на None, а не на пустое значение
+        return None, web.json_response({"error": "Missing tg_id"}, status=400)
 
-        # Проверяем, что tg_id - число
-        try:
-            tg_id = int(tg_id)
-        except ValueError:
-            return web.json_response({"error": "Invalid tg_id format, must be an integer"}, status=400)
+    # Проверяем, что tg_id - число
+    try:
+        return int(tg_id), None
+    except (TypeError, ValueError):
+        return None, web.json_response({"error": "Invalid tg_id format, must be an integer"}, status=400)
 
-        # Получаем имя курьера из базы
-        courier_name = get_courier_name(tg_id)
-        if not courier_name:
-             logger.warning(f"Попытка вызвать курьера с несуществующим ID {tg_id}")
-             return web.json_response({"error": "Courier not found"}, status=404)
+# --- МАРШРУТ ДЛЯ ВЫЗОВА КУРЬЕРА ---
+async def api_call_courier(request: Request) -> Response:
+    try:
+        tg_id, error = await read_tg_id(request, "/api/call_courier")
+        if error is not None:
+            return error
+        return await run_idempotent(request, "call", tg_id, lambda: call_courier(tg_id))
+    except Exception as e:
+        logger.error("Неожиданная ошибка в /api/call_courier: %s", e)
+        return web.json_response({"error": "Internal Server Error"}, status=500)
 
-        # Пытаемся получить username через бота
-        try:
-            user_info = await bot.get_chat(tg_id)
-            username = user_info.username # Может быть None
-        except Exception as e:
-            logger.warning(f"Не удалось получить информацию о пользователе {tg_id}: {e}")
-            username = None
+async def call_courier(tg_id):
+    """Зовёт курьера в чат CALL_CHAT_ID. Возвращает (payload, status)."""
+    # Получаем имя курьера из базы
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+         logger.warning("Попытка вызвать курьера с несуществующим ID %s", tg_id)
+         return {"error": "Courier not found"}, 404
 
-        # Формируем сообщение
-        if username:
-            message_to_send = f"{courier_name} @{username}"
-        else:
-            # Если username не удалось получить, отправляем только имя
-            message_to_send = courier_name
+    # Пытаемся получить username через бота
+    try:
+        user_info = await bot.get_chat(tg_id)
+        username = user_info.username # Может быть None
+    except Exception as e:
+        logger.warning("Не удалось получить информацию о пользователе %s: %s", tg_id, e)
+        username = None
 
-        # Отправляем сообщение в чат
-        try:
-            await bot.send_message(chat_id=CALL_CHAT_ID, text=message_to_send)
-            logger.info(f"Отправлено сообщение '{message_to_send}' в чат {CALL_CHAT_ID} для вызова курьера {tg_id}")
-            return web.json_response({"status": "success", "message": f"Called {message_to_send}"})
-        except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения в чат {CALL_CHAT_ID}: {e}")
-            return web.json_response({"error": f"Failed to send message: {str(e)}"}, status=500)
+    # Формируем сообщение
+    if username:
+        message_to_send = f"{courier_name} @{username}"
+    else:
+        # Если username не удалось получить, отправляем только имя
+        message_to_send = courier_name
 
+    # Отправляем сообщение в чат
+    try:
+        await bot.send_message(chat_id=CALL_CHAT_ID, text=message_to_send)
+        logger.info("Отправлено сообщение '%s' в чат %s для вызова курьера %s", message_to_send, CALL_CHAT_ID, tg_id)
+        return {"status": "success", "message": f"Called {message_to_send}"}, 200
     except Exception as e:
-        logger.error(f"Неожиданная ошибка в /api/call_courier: {e}")
-        return web.json_response({"error": "Internal Server Error"}, status=500)
+        logger.error("Ошибка при отправке сообщения в чат %s: %s", CALL_CHAT_ID, e)
+        return {"error": f"Failed to send message: {str(e)}"}, 500
 
 # --- /МАРШРУТ ---
 
 # --- МАРШРУТ ДЛЯ УДАЛЕНИЯ ЧЕРЕЗ САЙТ ---
 async def api_remove_courier(request: Request) -> Response:
     try:
-        try:
-            data = await request.json()
-        except Exception as e:
-            logger.error(f"Ошибка парсинга JSON в /api/remove_courier: {e}")
-            return web.json_response({"error": f"Invalid JSON format: {str(e)}"}, status=400)
+        tg_id, error = await read_tg_id(request, "/api/remove_courier")
+        if error is not None:
+            return error
+        return await run_idempotent(request, "remove", tg_id, lambda: remove_courier(tg_id))
+    except Exception as e:
+        logger.error("Неожиданная ошибка в /api/remove_courier: %s", e)
+        return web.json_response({"error": "Internal Server Error"}, status=500)
 
-        tg_id = data.get("tg_id")
-        if tg_id is None:
-            return web.json_response({"error": "Missing tg_id"}, status=400)
-        try:
-            tg_id = int(tg_id)
-        except ValueError:
-            return web.json_response({"error": "Invalid tg_id format, must be an integer"}, status=400)
+async def remove_courier(tg_id):
+    """Снимает курьера с обеда и/или из очереди по команде кассы. Возвращает (payload, status)."""
+    courier_name = get_courier_name(tg_id)
+    if not courier_name:
+        return {"error": "Courier not found"}, 404
 
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT name FROM couriers WHERE tg_id = %s", (tg_id,))
-                user = cur.fetchone()
-                if not user:
-                    return web.json_response({"error": "Courier not found"}, status=404)
-        courier_name = user['name']
-
-        # --- НОВАЯ ЛОГИКА: Проверяем, на обеде ли курьер ---
-        session_info = get_current_lunch_session(tg_id)
-        was_on_lunch = False
-        if session_info:
-            # Завершаем сессию обеда
-            ended = end_lunch_session(session_info['session_id'], tg_id, courier_name)
-            if ended:
-                was_on_lunch = True
-                logger.info(f"Курьер {courier_name} (ID: {tg_id}) был на обеде и сессия завершена.")
-
-        # --- Удаляем из очереди (если есть) ---
-        was_in_queue = False
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1 FROM queue WHERE tg_id = %s", (tg_id,))
-                if cur.fetchone():
-                    was_in_queue = True
-
-        removed = remove_from_queue(tg_id)
-
-        # --- Логируем действие ---
-        if was_on_lunch and was_in_queue:
-            log_action(tg_id, courier_name, "Удалён с обеда и из очереди")
-        elif was_on_lunch:
-            log_action(tg_id, courier_name, "Удалён с обеда")
-        elif was_in_queue:
-            log_action(tg_id, courier_name, "Удалён из очереди")
+    # --- НОВАЯ ЛОГИКА: Проверяем, на обеде ли курьер ---
+    session_info = get_current_lunch_session(tg_id)
+    was_on_lunch = False
+    if session_info:
+        # Завершаем сессию обеда
+        ended = end_lunch_session(session_info.session_id, tg_id, courier_name)
+        if ended:
+            was_on_lunch = True
+            logger.info("Курьер %s (ID: %s) был на обеде и сессия завершена.", courier_name, tg_id)
+
+    # --- Удаляем из очереди (если есть) ---
+    was_in_queue = is_in_queue(tg_id)
+
+    removed = remove_from_queue(tg_id, "removed")
+
+    # --- Логируем действие ---
+    if was_on_lunch and was_in_queue:
+        log_action(tg_id, courier_name, "Удалён с обеда и из очереди")
+    elif was_on_lunch:
+        log_action(tg_id, courier_name, "Удалён с обеда")
+    elif was_in_queue:
+        log_action(tg_id, courier_name, "Удалён из очереди")
+    else:
+        log_action(tg_id, courier_name, "Попытка удаления: не в очереди и не на обеде")
+
+    # Убираем у курьера устаревшие кнопки ("С обеда") и сообщаем, что произошло
+    if was_on_lunch or removed:
+        if was_on_lunch:
+            notice = "🚫 Касса завершила ваш обед."
         else:
-            log_action(tg_id, courier_name, "Попытка удаления: не в очереди и не на обеде")
+            notice = "🚫 Касса убрала вас из очереди."
+        await COURIER_MESSAGES.show(tg_id, f"{notice}\n\n{menu_text(courier_name)}", MAIN_MENU_KB)
+
+    # Возвращаем результат
+    if removed > 0 or was_on_lunch:
+        return {"status": "success", "removed": removed, "was_on_lunch": was_on_lunch}, 200
+    else:
+        return {"status": "success", "removed": 0, "was_on_lunch": False}, 200
+
 
-        # Возвращаем результат
-        if removed > 0 or was_on_lunch:
-            return web.json_response({"status": "success", "removed": removed, "was_on_lunch": was_on_lunch})
+# --- /МАРШРУТ ---
+
+# --- ИСТОРИЯ И ВЫГРУЗКА ЛОГОВ ---
+def check_admin(request: Request):
+    """None, если доступ есть, иначе ответ 401. Без ADMIN_TOKEN проверка выключена."""
+    if not ADMIN_TOKEN:
+        return None
+    token = request.headers.get("X-Admin-Token") or request.query.get("token")
+    if token != ADMIN_TOKEN:
+        return web.json_response({"error": "Unauthorized"}, status=401)
+    return None
+
+def encode_logs_cursor(entry):
+    raw = f"{entry.timestamp.isoformat()}|{entry.log_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_logs_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    timestamp, log_id = raw.rsplit("|", 1)
+    return datetime.fromisoformat(timestamp), int(log_id)
+
+async def api_courier_logs(request: Request) -> Response:
+    """GET /api/couriers/{tg_id}/logs?limit=50&cursor=... - история курьера страницами.
+    cursor берётся из next_cursor предыдущего ответа; null - страниц больше нет."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    try:
+        tg_id = int(request.match_info["tg_id"])
+        limit = min(max(int(request.query.get("limit", 50)), 1), 200)
+        cursor = request.query.get("cursor")
+        after = decode_logs_cursor(cursor) if cursor else None
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return web.json_response({"error": "Invalid tg_id, limit or cursor"}, status=400)
+    try:
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        rows = await asyncio.to_thread(get_courier_logs, tg_id, limit + 1, after)
+    except Exception as e:
+        logger.error("Ошибка в /api/couriers/%s/logs: %s", tg_id, e)
+        return web.json_response({"error": "Internal Server Error"}, status=500)
+    next_cursor = encode_logs_cursor(rows[limit - 1]) if len(rows) > limit else None
+    items = [{
+        "log_id": entry.log_id,
+        "action": entry.action,
+        "timestamp": entry.timestamp.isoformat(),
+        "formatted_timestamp": entry.formatted_timestamp,
+    } for entry in rows[:limit]]
+    return web.json_response({"items": items, "next_cursor": next_cursor})
+
+def parse_date_range(request: Request):
+    """Период ?from=YYYY-MM-DD&to=YYYY-MM-DD (включительно). KeyError/ValueError при ошибке."""
+    date_from = datetime.strptime(request.query["from"], "%Y-%m-%d").date()
+    date_to = datetime.strptime(request.query["to"], "%Y-%m-%d").date()
+    if date_to < date_from:
+        raise ValueError("'to' is before 'from'")
+    return date_from, date_to
+
+EXPORT_SLOTS = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+
+async def api_logs_export(request: Request) -> Response:
+    """GET /api/logs/export?from=YYYY-MM-DD&to=YYYY-MM-DD[&tg_id=...] - логи за период
+    (даты включительно, по BUSINESS_TZ) в CSV. Строки читаются серверным курсором
+    пачками по EXPORT_CHUNK_ROWS и сразу уходят клиенту chunked-ответом, поэтому
+    память не зависит от размера периода."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    try:
+        date_from, date_to = parse_date_range(request)
+        tg_id = int(request.query["tg_id"]) if request.query.get("tg_id") else None
+    except (KeyError, ValueError):
+        return web.json_response({"error": "Use from=YYYY-MM-DD&to=YYYY-MM-DD[&tg_id=N], from <= to"}, status=400)
+
+    where = "timestamp >= (%s::date)::timestamp AT TIME ZONE %s AND timestamp < (%s::date + 1)::timestamp AT TIME ZONE %s"
+    params = [BUSINESS_TZ, date_from, BUSINESS_TZ, date_to, BUSINESS_TZ]
+    if tg_id is not None:
+        where += " AND tg_id = %s"
+        params.append(tg_id)
+    query = f"""
+        SELECT log_id, tg_id, courier_name, action, timestamp,
+               to_char(timestamp AT TIME ZONE %s, 'YYYY-MM-DD HH24:MI:SS') AS local_time
+        FROM logs
+        WHERE {where}
+        ORDER BY timestamp, log_id
+    """
+
+    async with EXPORT_SLOTS:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/csv; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="logs_{date_from}_{date_to}.csv"',
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        total = await asyncio.to_thread(export_logs, ResponseBodyWriter(response, asyncio.get_running_loop()), query, params)
+        await response.write_eof()
+        logger.info("Выгрузка логов %s..%s: %s строк", date_from, date_to, total)
+        return response
+
+def export_logs(target, query, params):
+    """Выгрузка логов в потоке: соединение, серверный курсор и CSV - вне event loop."""
+    # BOM - чтобы Excel сразу открыл кириллицу в UTF-8
+    buf = io.StringIO("\ufeff")
+    buf.seek(0, io.SEEK_END)
+    writer = csv.writer(buf)
+    writer.writerow(["log_id", "tg_id", "courier_name", "action", "timestamp_utc", f"local_time ({BUSINESS_TZ})"])
+    total = 0
+    with replica_reads(), get_db(long_running=True) as conn:
+        # Именованный курсор - серверный: Postgres отдаёт строки пачками по fetchmany
+        with conn.cursor(name="logs_export", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                for log_id, row_tg_id, name, action, ts, local_time in rows:
+                    writer.writerow([log_id, row_tg_id, name, action, ts.astimezone(timezone.utc).isoformat(), local_time])
+                total += len(rows)
+                target.write(buf.getvalue().encode())
+                buf.seek(0)
+                buf.truncate()
+    target.write(buf.getvalue().encode())
+    target.flush()
+    return total
+
+# --- СПИСОК КУРЬЕРОВ (CSV) ---
+class RequestBodyReader:
+    """Файловый объект для COPY FROM STDIN в потоке: каждый read() дочитывает
+    следующий кусок тела запроса в event loop - файл целиком в памяти не бывает."""
+
+    def __init__(self, request, loop):
+        self.content = request.content
+        self.loop = loop
+
+    def read(self, size=-1):
+        return asyncio.run_coroutine_threadsafe(self.content.read(size), self.loop).result()
+
+class ResponseBodyWriter:
+    """Файловый объект для COPY TO STDOUT в потоке: копит строки до flush_bytes и
+    отправляет их chunked-ответом, дожидаясь отправки - темп задаёт клиент."""
+
+    def __init__(self, response, loop, flush_bytes=64 * 1024):
+        self.response = response
+        self.loop = loop
+        self.flush_bytes = flush_bytes
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            chunk, self.buffer = bytes(self.buffer), bytearray()
+            asyncio.run_coroutine_threadsafe(self.response.write(chunk), self.loop).result()
+
+def import_roster(source, strict, dry_run):
+    with get_db(long_running=True) as conn:
+        with conn.cursor() as cur:
+            report = roster.import_csv(cur, source, strict=strict, dry_run=dry_run)
+        if report["applied"]:
+            conn.commit()
         else:
-            return web.json_response({"status": "success", "removed": 0, "was_on_lunch": False})
+            conn.rollback()
+    return report
+
+def export_roster(target):
+    with replica_reads(), get_db(long_running=True) as conn:
+        with conn.cursor() as cur:
+            rows = roster.export_csv(cur, target)
+        conn.rollback()
+    target.flush()
+    return rows
+
+async def api_couriers_import(request: Request) -> Response:
+    """POST /api/couriers/import[?strict=1][&dry_run=1], тело - CSV tg_id,name.
+    Отчёт: сколько строк, добавлено/обновлено/без изменений, дубликаты и
+    некорректные строки (первые roster.ERROR_SAMPLE с номерами строк файла)."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    strict = request.query.get("strict") in ("1", "true")
+    dry_run = request.query.get("dry_run") in ("1", "true")
+    source = RequestBodyReader(request, asyncio.get_running_loop())
+    async with EXPORT_SLOTS:
+        try:
+            report = await asyncio.to_thread(import_roster, source, strict, dry_run)
+        except ValueError as e:
+            return web.json_response({"error": f"Invalid CSV: {e}"}, status=400)
+        except Exception as e:
+            logger.error("Ошибка в /api/couriers/import: %s", e)
+            return web.json_response({"error": "Internal Server Error"}, status=500)
+    if report["applied"] and (report["inserted"] or report["updated"]):
+        await asyncio.to_thread(OFFLINE.load_names)
+        bump_queue_version() # имена могли измениться - снимок очереди устарел
+    logger.info("Загрузка списка курьеров: %s", {k: v for k, v in report.items() if k != 'errors'})
+    return web.json_response(report, status=200 if report["applied"] or dry_run else 422)
+
+async def api_couriers_export(request: Request) -> Response:
+    """GET /api/couriers/export - список курьеров в CSV (tg_id,name) потоком через COPY."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    async with EXPORT_SLOTS:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/csv; charset=utf-8",
+            "Content-Disposition": 'attachment; filename="couriers.csv"',
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        rows = await asyncio.to_thread(export_roster, ResponseBodyWriter(response, asyncio.get_running_loop()))
+        await response.write_eof()
+        logger.info("Выгрузка списка курьеров: %s строк", rows)
+        return response
+
+# --- АНАЛИТИКА СМЕНЫ ---
+def refresh_analytics():
+    with get_db(long_running=True) as conn:
+        with conn.cursor() as cur:
+            changed = analytics.refresh_rollups(cur, LUNCH_POLICY.duration)
+        conn.commit()
+    return changed
+
+async def analytics_refresh_loop():
+    """Фоново дополняет почасовые агрегаты. Каждый прогон обрабатывает только
+    события после водяного знака, поэтому стоит столько, сколько накопилось."""
+    while True:
+        started = time.monotonic()
+        try:
+            changed = await asyncio.to_thread(refresh_analytics)
+            METRICS.observe("analytics_refresh_seconds", time.monotonic() - started)
+            if changed:
+                logger.info("Аналитика обновлена: %s", changed)
+        except Exception as e:
+            METRICS.inc("analytics_refresh_failed_total")
+            logger.error("Ошибка обновления аналитики: %s", e)
+        await asyncio.sleep(ANALYTICS_REFRESH_INTERVAL)
 
+@read_only
+def read_analytics(report, date_from, date_to):
+    with get_db(long_running=True) as conn:
+        with conn.cursor() as cur:
+            return report(cur, date_from, date_to, BUSINESS_TZ)
+
+async def api_broadcast(request: Request) -> Response:
+    """POST {"target": "all"|"queue"|"lunch", "text": "..."} - запускает рассылку.
+    Ответ 202 с id; ход и итог - GET /api/broadcast/{id}."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    try:
+        data = await request.json()
+        target, text = data["target"], data["text"].strip()
+    except Exception:
+        return web.json_response({"error": "Expected JSON with target and text"}, status=400)
+    if target not in broadcast.TARGETS or not text:
+        return web.json_response({"error": f"target must be one of {sorted(broadcast.TARGETS)}, text non-empty"}, status=400)
+    try:
+        broadcast_id, recipients = await asyncio.to_thread(create_broadcast, target, text)
     except Exception as e:
-        logger.error(f"Неожиданная ошибка в /api/remove_courier: {e}")
+        logger.error("Ошибка в /api/broadcast: %s", e)
         return web.json_response({"error": "Internal Server Error"}, status=500)
+    BROADCASTS.start(broadcast_id)
+    return web.json_response({"id": broadcast_id, "recipients": recipients}, status=202)
 
+async def api_broadcast_status(request: Request) -> Response:
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    try:
+        broadcast_id = int(request.match_info["id"])
+    except ValueError:
+        return web.json_response({"error": "Invalid id"}, status=400)
+    try:
+        info = await asyncio.to_thread(broadcast_db, broadcast.get, broadcast_id)
+        counts = await asyncio.to_thread(broadcast_db, broadcast.report, broadcast_id) if info else None
+    except Exception as e:
+        logger.error("Ошибка в /api/broadcast/%s: %s", broadcast_id, e)
+        return web.json_response({"error": "Internal Server Error"}, status=500)
+    if info is None:
+        return web.json_response({"error": "Broadcast not found"}, status=404)
+    return web.json_response({
+        "id": broadcast_id,
+        "target": info['target'],
+        "created_at": info['created_at'].isoformat(),
+        "finished_at": info['finished_at'].isoformat() if info['finished_at'] else None,
+        "running": broadcast_id in BROADCASTS.tasks,
+        "counts": counts,
+    })
+
+def publish_log_level(name, level):
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            PEERS.publish(cur, "log_level", logger=name, level=level)
+        conn.commit()
+
+async def api_log_level(request: Request) -> Response:
+    """GET - текущие уровни логгеров и сколько записей отброшено выборкой.
+    POST {"logger": "aiogram.event", "level": "DEBUG"} - меняет уровень на лету во
+    всех воркерах ("root" - корневой логгер). До рестарта: LOG_LEVEL не меняется."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    if request.method == "POST":
+        try:
+            data = await request.json()
+            name, level = data.get("logger", "root"), str(data["level"]).upper()
+            logsetup.set_level(name, level)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return web.json_response({"error": "Expected JSON with logger and a valid level"}, status=400)
+        logger.warning("Уровень логгера %s изменён на %s", name, level)
+        if PEERS.enabled:
+            try:
+                await asyncio.to_thread(publish_log_level, name, level)
+            except Exception as e:
+                logger.error("Не удалось передать уровень логгера другим воркерам: %s", e)
+                return web.json_response({"error": "Level changed only on this worker"}, status=502)
+    return web.json_response({
+        "levels": logsetup.levels(),
+        "sampling": logsetup.SAMPLER.rates,
+        "sampled_out": dict(logsetup.SAMPLER.dropped),
+        "queue_depth": logsetup.queue_depth(),
+    })
+
+def set_queue_class(tg_id, queue_class):
+    """Назначает курьеру класс очереди (None - без класса). False - курьера нет."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE couriers SET queue_class = %s WHERE tg_id = %s", (queue_class, tg_id))
+            if not cur.rowcount:
+                return False
+            PEERS.publish(cur, "queue_class", tg_id, queue_class=queue_class)
+        conn.commit()
+    OFFLINE.set_class(tg_id, queue_class)
+    return True
+
+async def api_queue_class(request: Request) -> Response:
+    """POST {"queue_class": "car"} (null - без класса) - класс курьера из QUEUE_CLASSES.
+    Действует со следующей постановки в очередь: стоящего сейчас не переставляет."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    try:
+        tg_id = int(request.match_info["tg_id"])
+        queue_class = (await request.json())["queue_class"]
+    except (ValueError, KeyError, TypeError):
+        return web.json_response({"error": "Expected JSON with queue_class"}, status=400)
+    if queue_class is not None and queue_class not in QUEUE_DISCIPLINE.classes:
+        return web.json_response({"error": f"Unknown queue class, expected one of {QUEUE_DISCIPLINE.classes}"}, status=400)
+    try:
+        found = await asyncio.to_thread(set_queue_class, tg_id, queue_class)
+    except Exception as e:
+        logger.error("Ошибка назначения класса очереди курьеру %s: %s", tg_id, e)
+        return web.json_response({"error": "Internal Server Error"}, status=500)
+    if not found:
+        return web.json_response({"error": "Courier not found"}, status=404)
+    logger.info("Курьеру %s назначен класс очереди %s", tg_id, queue_class)
+    return web.json_response({"tg_id": tg_id, "queue_class": queue_class})
+
+def analytics_handler(report):
+    """GET ?from=YYYY-MM-DD&to=YYYY-MM-DD - отчёт из почасовых агрегатов за период."""
+    async def handler(request: Request) -> Response:
+        denied = check_admin(request)
+        if denied is not None:
+            return denied
+        try:
+            date_from, date_to = parse_date_range(request)
+        except (KeyError, ValueError):
+            return web.json_response({"error": "Use from=YYYY-MM-DD&to=YYYY-MM-DD, from <= to"}, status=400)
+        try:
+            data = await asyncio.to_thread(read_analytics, report, date_from, date_to)
+        except Exception as e:
+            logger.error("Ошибка в %s: %s", request.path, e)
+            return web.json_response({"error": "Internal Server Error"}, status=500)
+        return web.json_response({"from": str(date_from), "to": str(date_to), "tz": BUSINESS_TZ, "data": data})
+    return handler
 
-# --- /МАРШРУТ ---
 async def root_handler(request: Request) -> Response:
     return web.Response(text=CASHIER_HTML, content_type="text/html")
 
 async def cashier(request: Request) -> Response:
     return web.Response(text=CASHIER_HTML, content_type="text/html")
 
-async def healthcheck(request: Request) -> Response:
-    return web.json_response({"status": "ok", "bot": "running"})
+async def cashier_service_worker(request: Request) -> Response:
+    # no-cache: браузер сверяет воркер при каждой загрузке и сразу видит новую версию
+    return web.Response(text=CASHIER_SW_JS, content_type="application/javascript",
+                        headers={"Cache-Control": "no-cache"})
+
+# === СТАРТ И ПРОВЕРКИ ГОТОВНОСТИ ===
+class StartupState:
+    """Состояние поэтапного старта. /health/ready читает только закэшированные
+    результаты (этапы и последнюю фоновую пробу БД), сам ничего не проверяет."""
+
+    # Этапы, без которых инстанс не считается готовым
+    REQUIRED = ("db", "webhook", "timers")
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.required = self.REQUIRED
+        self.stages = {}            # имя -> "pending" | "ok" | "error: ..."
+        self.db_ready = asyncio.Event()
+        self.db_ok = False          # результат последней пробы БД
+        self.db_checked_at = None
+        self.cron = None
+        self.retention_cron = None
+
+    async def run(self, name, func, retry_delay=None):
+        """Выполняет этап; при retry_delay повторяет его с нарастающей паузой до успеха."""
+        self.stages[name] = "pending"
+        delay = retry_delay
+        while True:
+            started = time.monotonic()
+            try:
+                await func()
+            except Exception as e:
+                self.stages[name] = f"error: {e}"
+                logger.error("Этап старта '%s' завершился ошибкой: %s", name, e)
+                if delay is None:
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            self.stages[name] = "ok"
+            logger.info("Этап старта '%s' готов за %.2f с", name, time.monotonic() - started)
+            return True
+
+    def is_ready(self):
+        return self.db_ok and all(self.stages.get(name) == "ok" for name in self.required)
+
+    def snapshot(self):
+        return {
+            "stages": dict(self.stages),
+            "db": {
+                "ok": self.db_ok,
+                "checked_ago": None if self.db_checked_at is None
+                else round(time.monotonic() - self.db_checked_at, 1),
+            },
+            "replica": REPLICA.snapshot(),
+            "offline": OFFLINE.snapshot(),
+            "circuits": {"db": DB_BREAKER.snapshot(), "telegram": TELEGRAM_BREAKER.snapshot()},
+            "uptime": round(time.monotonic() - self.started_at, 1),
+            "worker": WORKER_INDEX,
+        }
+
+STARTUP = StartupState()
+
+def probe_db():
+    try:
+        with get_db(probe=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+        return True
+    except DatabaseUnavailable:
+        return False  # предохранитель ещё не пропускает пробу
+    except psycopg2.pool.PoolError:
+        # Все соединения заняты - база отвечает, просто загружена: не авария
+        METRICS.inc("db_probe_busy_total")
+        return True
+    except Exception as e:
+        logger.warning("Проба БД не прошла: %s", e)
+        return False
+
+async def probe_db_loop():
+    """Фоновая проба БД: результат кэшируется и отдаётся /health/ready. Она же -
+    единственный пробный вызов разомкнутого предохранителя БД, поэтому, пока он
+    не замкнут, проверяем чаще: как только он готов пропустить пробу."""
+    while True:
+        STARTUP.db_ok = await asyncio.to_thread(probe_db)
+        STARTUP.db_checked_at = time.monotonic()
+        if not STARTUP.db_ok:
+            OFFLINE.enter("проба БД не прошла")
+        elif OFFLINE.active:
+            await recover_from_outage()
+        if REPLICA.url:
+            await asyncio.to_thread(REPLICA.probe)
+        if DB_BREAKER.state == CircuitBreaker.CLOSED:
+            await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+        else:
+            await asyncio.sleep(min(HEALTH_PROBE_INTERVAL, max(DB_BREAKER.retry_in(), 0.5)))
+
+async def recover_from_outage():
+    """Проигрывает журнал и возвращает работу в базу. Таймеры обедов, начатых без
+    базы, висят на временных id - ставим их заново по настоящим сессиям."""
+    try:
+        remapped = await asyncio.to_thread(OFFLINE.recover)
+    except DB_DOWN_ERRORS as e:
+        logger.warning("Проигрывание журнала прервано, повторим на следующей пробе: %s", e)
+        return
+    for temporary_id, session_id in remapped:
+        task = LUNCH_TIMERS.pop(temporary_id, None)
+        if task:
+            task.cancel()
+    if remapped:
+        await restore_lunch_timers()
+    bump_queue_version()
+
+async def start_db():
+    await asyncio.to_thread(open_db_pool)
+    if REPLICA.url:
+        METRICS.gauge("replica_ok", lambda: int(REPLICA.ok))
+        METRICS.gauge("replica_lag_seconds", lambda: REPLICA.lag or 0)
+    await asyncio.to_thread(init_db)
+    # Журнал, оставшийся от прошлого запуска без базы, проигрываем до первых апдейтов
+    await recover_from_outage()
+    # Счётчики обедов - после журнала и до первых апдейтов: лимит проверяется только по ним
+    await asyncio.to_thread(load_lunch_counters)
+    STARTUP.db_ok = True
+    STARTUP.db_checked_at = time.monotonic()
+    STARTUP.db_ready.set()
+
+async def register_webhook():
+    # Не сбрасываем накопившиеся апдейты: при редеплое Telegram досылает их новому инстансу
+    webhook_url = f"{BASE_URL}{WEBHOOK_PATH}"
+    await bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+    logger.info("✅ Webhook установлен: %s", webhook_url)
+
+async def warm_up_caches():
+    # Заполняем кэш отрисовки очереди: первый запрос заодно прогревает пул и планы Postgres.
+    # Имена всех курьеров - в зеркало на случай работы без базы
+    await asyncio.to_thread(OFFLINE.load_names)
+    ETA.seed(await asyncio.to_thread(get_queue_events, ETA_HISTORY_DAYS))
+    await QUEUE_RENDER.ensure()
+    QUEUE_RENDER.api_json()
+
+async def start_scheduler():
+    import aiocron  # ленивый импорт: тянет croniter/dateutil, на старте не нужен
+    # Запускаем задачу на очистку очереди каждый день в 01:00 по Екатеринбургу (UTC+5)
+    # Это соответствует 20:00 UTC
+    STARTUP.cron = aiocron.crontab('0 20 * * *', func=scheduled_queue_clear)
+    # Через полчаса после очистки - обслуживание секций и архив (смена уже закрыта)
+    STARTUP.retention_cron = aiocron.crontab('30 20 * * *', func=scheduled_retention)
+    logger.info("Планировщик задач запущен. Очередь будет очищаться каждый день в 01:00 по Екатеринбургскому времени (20:00 UTC).")
+
+async def staged_startup():
+    """Всё, что раньше блокировало старт, выполняется после открытия порта:
+    БД и вебхук параллельно, затем таймеры обедов, прогрев и планировщик."""
+    primary = is_primary()
+    if primary:
+        webhook = asyncio.create_task(STARTUP.run("webhook", register_webhook, retry_delay=1))
+    await STARTUP.run("db", start_db, retry_delay=1)
+    PEERS.start(asyncio.get_running_loop())
+    asyncio.create_task(probe_db_loop())
+    stages = [
+        STARTUP.run("timers", restore_lunch_timers, retry_delay=1),
+        STARTUP.run("warmup", warm_up_caches),
+    ]
+    # Единичные обязанности - только у основного воркера
+    if primary:
+        asyncio.create_task(analytics_refresh_loop())
+        stages += [
+            STARTUP.run("scheduler", start_scheduler),
+            STARTUP.run("broadcasts", BROADCASTS.resume, retry_delay=1),
+        ]
+        asyncio.create_task(poll_broadcasts_loop())
+    await asyncio.gather(*stages)
+    if primary:
+        await webhook
+    logger.info("Старт завершён за %.2f с", time.monotonic() - STARTUP.started_at)
+
+# === ЗАВЕРШЕНИЕ РАБОТЫ ===
+class ShutdownCoordinator:
+    """Аккуратная остановка по SIGTERM: перестаём принимать вебхуки, дожидаемся
+    начатых апдейтов, запросов к Bot API и таймеров (не дольше SHUTDOWN_TIMEOUT),
+    сбрасываем буферы и закрываем пул БД."""
+
+    def __init__(self):
+        self.requested = asyncio.Event()
+        self.draining = False
+        self._flushers = []
+
+    def request(self, signame="SIGTERM"):
+        if not self.requested.is_set():
+            logger.info("Получен %s, начинаем остановку...", signame)
+            self.draining = True
+            self.requested.set()
+
+    def on_flush(self, func):
+        """Регистрирует функцию (обычную или async), которую нужно вызвать перед закрытием БД."""
+        self._flushers.append(func)
+        return func
+
+    async def drain(self, runner):
+        started = time.monotonic()
+        for cron in (STARTUP.cron, STARTUP.retention_cron):
+            if cron:
+                cron.stop()
+        # Спящие таймеры обеда отменяем: состояние обеда уже лежит в lunch_sessions
+        # (start_time), и при следующем старте restore_lunch_timers поставит их заново
+        sleeping = list(LUNCH_TIMERS.values())
+        for task in sleeping:
+            task.cancel()
+        logger.info("Отменено спящих таймеров обеда: %s (будут восстановлены при старте)", len(sleeping))
+
+        deadline = started + SHUTDOWN_TIMEOUT
+        if not await UPDATES.drain(max(0, deadline - time.monotonic())):
+            logger.warning("Не все принятые апдейты обработаны за %s с", SHUTDOWN_TIMEOUT)
+        if not await INFLIGHT.wait_idle(max(0, deadline - time.monotonic())):
+            logger.warning("Не дождались завершения работы за %s с: %s", SHUTDOWN_TIMEOUT, dict(INFLIGHT.counts))
+        await UPDATES.stop()
+
+        for func in self._flushers:
+            try:
+                result = func()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error("Ошибка при сбросе буфера %s: %s", getattr(func, '__name__', func), e)
+
+        await runner.cleanup()
+        if DB_POOL is not None:
+            DB_POOL.closeall()
+            logger.info("Пул соединений с БД закрыт.")
+        if REPLICA.pool is not None:
+            REPLICA.pool.closeall()
+        logger.info("Остановка заняла %.2f с", time.monotonic() - started)
+
+SHUTDOWN = ShutdownCoordinator()
+# Начатые апдейты уже обработаны - без базы больше никто не пишет в журнал
+SHUTDOWN.on_flush(OFFLINE.close)
+
+@web.middleware
+async def draining_middleware(request: Request, handler):
+    """Во время остановки новые вебхуки и изменения через API не принимаем (503 -
+    Telegram повторит доставку уже новому инстансу); начатые запросы учитываем в INFLIGHT."""
+    tracked = request.path == WEBHOOK_PATH or request.path.startswith("/api/")
+    if not tracked:
+        return await handler(request)
+    if SHUTDOWN.draining and (request.path == WEBHOOK_PATH or request.method != "GET"):
+        return web.json_response({"error": "Service is shutting down"}, status=503)
+    with INFLIGHT.track("http"):
+        return await handler(request)
+
+RECORDED_API = ("/api/queue", "/api/remove_courier", "/api/call_courier")
+
+@web.middleware
+async def recording_middleware(request: Request, handler):
+    """Вызовы кассы - в запись трафика (RECORD_PATH): тело, статус и длительность."""
+    if not RECORDER.enabled or request.path not in RECORDED_API:
+        return await handler(request)
+    started, clock = time.time(), time.monotonic()
+    body = await request.read() if request.can_read_body else b""
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        RECORDER.http(started, request.method, request.path, body, status, time.monotonic() - clock,
+                      "Idempotency-Key" in request.headers)
+
+@web.middleware
+async def wait_for_db_middleware(request: Request, handler):
+    """Пока БД не готова, вебхук и API ждут её не дольше STARTUP_DB_WAIT.
+    По таймауту отвечаем 503: Telegram доставит апдейт повторно, он не потеряется."""
+    if not STARTUP.db_ready.is_set() and (
+        request.path == WEBHOOK_PATH or request.path.startswith("/api/")
+    ):
+        try:
+            await asyncio.wait_for(STARTUP.db_ready.wait(), STARTUP_DB_WAIT)
+        except asyncio.TimeoutError:
+            return web.json_response({"error": "Service is starting"}, status=503)
+    return await handler(request)
+
+async def metrics_handler(request: Request) -> Response:
+    return web.Response(text=METRICS.render(), content_type="text/plain")
+
+async def health_live(request: Request) -> Response:
+    return web.json_response({"status": "ok"})
+
+async def health_ready(request: Request) -> Response:
+    ready = STARTUP.is_ready() and not SHUTDOWN.draining
+    status = "draining" if SHUTDOWN.draining else "ready" if ready else "starting"
+    body = {"status": status, "bot": "running", **STARTUP.snapshot()}
+    return web.json_response(body, status=200 if ready else 503)
 
 async def scheduled_queue_clear():
     """Асинхронная функция, вызываемая по расписанию."""
     logger.info("Запуск запланированной очистки очереди...")
+    if DAILY_CLEAR_NOTICE:
+        # Получатели снимаются сейчас, пока очередь ещё не очищена
+        try:
+            broadcast_id, recipients = await asyncio.to_thread(create_broadcast, "queue", DAILY_CLEAR_NOTICE)
+            BROADCASTS.start(broadcast_id)
+            logger.info("Рассылка #%s перед очисткой очереди: %s получателей", broadcast_id, recipients)
+        except Exception as e:
+            logger.error("Не удалось создать рассылку перед очисткой очереди: %s", e)
     clear_queue()
 
+def run_retention():
+    with get_db(long_running=True) as conn:
+        with conn.cursor() as cur:
+            return retention.run_retention(cur, RETENTION_MONTHS, ARCHIVE_DIR, BUSINESS_TZ, PARTITIONS_AHEAD)
+
+async def scheduled_retention():
+    """Ежедневно: секции на следующие месяцы, архивация и удаление устаревших."""
+    try:
+        report = await asyncio.to_thread(run_retention)
+        logger.info("Хранение истории: %s", report)
+    except Exception as e:
+        METRICS.inc("retention_failed_total")
+        logger.error("Ошибка архивации истории: %s", e)
+
+async def close_bot_session(app):
+    await bot.session.close()
+
 # === Основная функция запуска ===
-async def main():
-    app = web.Application()
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[draining_middleware, recording_middleware, wait_for_db_middleware])
     
-    # Healthcheck
-    app.router.add_get("/health", healthcheck)
+    # Healthcheck: live - процесс жив, ready - можно слать трафик
+    app.router.add_get("/health/live", health_live)
+    app.router.add_get("/health/ready", health_ready)
+    app.router.add_get("/health", health_ready)
     
     # Главная страница - теперь возвращает кассу
     app.router.add_get("/", root_handler)
@@ -1531,59 +4375,159 @@ async def main():
     # Добавляем новые маршруты
     app.router.add_post("/api/remove_courier", api_remove_courier)
     app.router.add_post("/api/call_courier", api_call_courier) # <-- Новый маршрут
+    app.router.add_get("/api/couriers/{tg_id}/logs", api_courier_logs)
+    app.router.add_get("/api/logs/export", api_logs_export)
+    app.router.add_post("/api/couriers/import", api_couriers_import)
+    app.router.add_get("/api/couriers/export", api_couriers_export)
+    app.router.add_post("/api/couriers/{tg_id}/queue_class", api_queue_class)
+    app.router.add_get("/api/analytics/wait", analytics_handler(analytics.wait_by_hour_of_day))
+    app.router.add_get("/api/analytics/lunch", analytics_handler(analytics.lunch_summary))
+    app.router.add_get("/api/analytics/queue_length", analytics_handler(analytics.queue_length_series))
+    app.router.add_post("/api/broadcast", api_broadcast)
+    app.router.add_get("/api/broadcast/{id}", api_broadcast_status)
+    app.router.add_get("/api/admin/log_level", api_log_level)
+    app.router.add_post("/api/admin/log_level", api_log_level)
     
     # Веб-интерфейс маршруты
     app.router.add_get("/cashier", cashier)
+    app.router.add_get("/cashier-sw.js", cashier_service_worker)
     
-    # Регистрируем обработчик вебхука aiogram
-    webhook_requests_handler = SimpleRequestHandler(
-        dispatcher=dp,
-        bot=bot,
-        secret_token=WEBHOOK_SECRET,
-    )
-    webhook_requests_handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/metrics", metrics_handler)
+    
+    # Вебхук: апдейты раскладываются по дорожкам UpdateScheduler
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    app.on_startup.append(UPDATES.start)
+    app.on_shutdown.append(close_bot_session)
+    app.on_shutdown.append(FORWARDER.close)
     
     setup_application(app, dp, bot=bot)
+    return app
+
+async def main(worker_index=0):
+    global WORKER_INDEX
+    WORKER_INDEX = worker_index
+    if WEB_WORKERS > 1:
+        STARTUP.required = STARTUP.REQUIRED if is_primary() else ("db", "timers")
+        METRICS.const_labels = (("worker", str(worker_index)),)
+        if worker_index:
+            # Свой журнал: временные id обедов у каждого воркера начинаются с -1, а
+            # проигрывать записи должен тот, чьи таймеры на них висят
+            OFFLINE.use_journal(f"{JOURNAL_PATH}.w{worker_index}")
+    app = create_app()
+    if RECORD_PATH:
+        RECORDER.start(traffic.worker_path(RECORD_PATH, worker_index if WEB_WORKERS > 1 else None))
+        SHUTDOWN.on_flush(RECORDER.stop)  # дописать очередь записей в файл
+        METRICS.gauge("traffic_recorded_total", lambda: RECORDER.written)
+        logger.info("Запись трафика в %s", RECORDER.path)
     
     port = int(os.getenv("PORT", 8080))
-    logger.info(f"Попытка запуска сервера на порту {port}")
+    logger.info("Попытка запуска сервера на порту %s", port)
     
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    # При нескольких воркерах порт общий: соединения между ними раскладывает ядро
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=WEB_WORKERS > 1)
     await site.start()
+    if WEB_WORKERS > 1:
+        # Сюда другие воркеры пересылают апдейты курьеров этого воркера
+        path = worker_socket(worker_index)
+        if os.path.exists(path):
+            os.unlink(path)
+        await web.UnixSite(runner, path).start()
     
-    logger.info(f"Сервер запущен на порту {port}")
-    
-    # Устанавливаем вебхук
-    webhook_url = f"{BASE_URL}{WEBHOOK_PATH}"
-    try:
-        await bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
-        logger.info(f"✅ Webhook установлен: {webhook_url}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка установки вебхука: {e}")
-        raise
+    # Порт открыт сразу: /health/live отвечает, остальное догружается в фоне
+    logger.info("Сервер запущен на порту %s за %.2f с", port, time.monotonic() - STARTUP.started_at)
+    startup_task = asyncio.create_task(staged_startup())
 
-    # --- ЗАПУСК ПЛАНИРОВЩИКА ---
-    # Запускаем задачу на очистку очереди каждый день в 01:00 по Екатеринбургу (UTC+5)
-    # Это соответствует 20:00 UTC
-    cron_task = aiocron.crontab('0 20 * * *', func=scheduled_queue_clear)
-    logger.info("Планировщик задач запущен. Очередь будет очищаться каждый день в 01:00 по Екатеринбургскому времени (20:00 UTC).")
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, SHUTDOWN.request, sig.name)
 
-    # Бесконечный цикл для удержания процесса
+    # Ждём сигнала остановки
     try:
-        await asyncio.Event().wait()
-    except asyncio.CancelledError:
+        await SHUTDOWN.requested.wait()
         logger.info("Приложение останавливается...")
-        cron_task.stop() # Останавливаем планировщик при завершении
     finally:
-        await runner.cleanup()
+        SHUTDOWN.draining = True
+        startup_task.cancel()
+        await SHUTDOWN.drain(runner)
         logger.info("Сервер остановлен.")
 
 
-if __name__ == "__main__":
+# === СУПЕРВИЗОР ВОРКЕРОВ ===
+def run_worker(index):
+    """Тело дочернего процесса: свой event loop, свой пул БД. Не возвращается."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+    # Поток-писатель логов через fork не переживает: запускаем свой
+    logsetup.setup(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE, worker=index)
+    code = 0
     try:
-        asyncio.run(main())
-    except Exception as e:
-        logger.error(f"Критическая ошибка в main: {e}")
-        exit(1)
+        asyncio.run(main(index))
+    except BaseException as e:
+        logger.error("Критическая ошибка в воркере %s: %s", index, e)
+        code = 1
+    finally:
+        logsetup.stop()
+        os._exit(code)
+
+def run_supervisor():
+    """WEB_WORKERS воркеров на одном порту (SO_REUSEPORT - соединения между ними
+    раскладывает ядро). Упавший воркер перезапускается с тем же номером, и его
+    обязанности возвращаются вместе с ним. SIGTERM/SIGINT пересылаются воркерам,
+    каждый останавливается как обычно (ShutdownCoordinator); супервизор ждёт всех."""
+    children = {}  # pid -> номер воркера
+    stopping = False
+
+    def spawn(index):
+        # Сигнал между fork и сбросом обработчиков в потомке достался бы копии stop()
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+        children[pid] = index
+        logger.info("Воркер %s запущен (pid %s)", index, pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(WEB_WORKERS):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if stopping:
+            logger.info("Воркер %s остановлен (код %s)", index, code)
+            continue
+        logger.error("Воркер %s (pid %s) завершился с кодом %s, перезапускаем", index, pid, code)
+        time.sleep(1)
+        if not stopping:
+            spawn(index)
+
+if __name__ == "__main__":
+    if WEB_WORKERS > 1:
+        run_supervisor()
+    else:
+        try:
+            asyncio.run(main())
+        except Exception as e:
+            logger.error("Критическая ошибка в main: %s", e)
+            logsetup.stop()
+            exit(1)
+        logsetup.stop()
@@ -0,0 +1,114 @@
+# broadcast.py - рассылки объявлений курьерам с сохранением прогресса в базе
+"""
+Рассылка создаётся одной транзакцией: строка в broadcasts и список получателей
+в broadcast_recipients, снятый с couriers / queue / lunch_sessions на момент
+создания. Отправитель (app.py) берёт получателей пачками со статусом pending и
+после каждой пачки записывает результаты одним запросом. После рестарта
+незавершённые рассылки продолжаются с первого неотправленного получателя;
+повторно может уйти не больше одной пачки, отправленной, но не записанной.
+
+Функции принимают курсор psycopg2 (RealDictCursor) и ничего не коммитят сами.
+"""
+from psycopg2.extras import execute_values
+
+# Кому рассылать: получатели снимаются этим запросом при создании рассылки
+TARGETS = {
+    "all": "SELECT tg_id FROM couriers",
+    "queue": "SELECT DISTINCT tg_id FROM queue",
+    "lunch": "SELECT DISTINCT tg_id FROM lunch_sessions WHERE end_time IS NULL",
+}
+
+# Итоговые статусы получателя; pending - ещё не отправлено
+DELIVERED, FAILED, BLOCKED = "delivered", "failed", "blocked"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id SERIAL PRIMARY KEY,
+        target TEXT NOT NULL,
+        text TEXT NOT NULL,
+        created_by BIGINT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        finished_at TIMESTAMPTZ
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+        tg_id BIGINT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        sent_at TIMESTAMPTZ,
+        PRIMARY KEY (broadcast_id, tg_id)
+    )
+    """,
+    # Отправитель читает только неотправленных
+    """
+    CREATE INDEX IF NOT EXISTS broadcast_recipients_pending_idx
+    ON broadcast_recipients (broadcast_id, tg_id) WHERE status = 'pending'
+    """,
+]
+
+
+def init_schema(cur):
+    for statement in SCHEMA:
+        cur.execute(statement)
+
+
+def create(cur, target, text, created_by=None):
+    """Создаёт рассылку и снимает список получателей. Возвращает (id, получателей)."""
+    cur.execute(
+        "INSERT INTO broadcasts (target, text, created_by) VALUES (%s, %s, %s) RETURNING id",
+        (target, text, created_by),
+    )
+    broadcast_id = cur.fetchone()['id']
+    cur.execute(
+        f"INSERT INTO broadcast_recipients (broadcast_id, tg_id) SELECT %s, tg_id FROM ({TARGETS[target]}) t",
+        (broadcast_id,),
+    )
+    return broadcast_id, cur.rowcount
+
+
+def get(cur, broadcast_id):
+    cur.execute("SELECT id, target, text, created_by, created_at, finished_at FROM broadcasts WHERE id = %s", (broadcast_id,))
+    return cur.fetchone()
+
+
+def unfinished(cur):
+    """id рассылок, прерванных остановкой процесса."""
+    cur.execute("SELECT id FROM broadcasts WHERE finished_at IS NULL ORDER BY id")
+    return [row['id'] for row in cur.fetchall()]
+
+
+def pending(cur, broadcast_id, limit):
+    cur.execute("""
+        SELECT tg_id FROM broadcast_recipients
+        WHERE broadcast_id = %s AND status = 'pending'
+        ORDER BY tg_id LIMIT %s
+    """, (broadcast_id, limit))
+    return [row['tg_id'] for row in cur.fetchall()]
+
+
+def record(cur, broadcast_id, results):
+    """Записывает результаты пачки: results - [(tg_id, статус, ошибка или None)]."""
+    execute_values(cur, """
+        UPDATE broadcast_recipients r
+        SET status = v.status, error = v.error, sent_at = NOW()
+        FROM (VALUES %s) AS v (broadcast_id, tg_id, status, error)
+        WHERE r.broadcast_id = v.broadcast_id AND r.tg_id = v.tg_id
+    """, [(broadcast_id, tg_id, status, error) for tg_id, status, error in results])
+
+
+def finish(cur, broadcast_id):
+    cur.execute("UPDATE broadcasts SET finished_at = NOW() WHERE id = %s AND finished_at IS NULL", (broadcast_id,))
+
+
+def report(cur, broadcast_id):
+    """Счётчики по статусам: {"pending": .., "delivered": .., "failed": .., "blocked": ..}."""
+    cur.execute("""
+        SELECT status, COUNT(*) AS n FROM broadcast_recipients
+        WHERE broadcast_id = %s GROUP BY status
+    """, (broadcast_id,))
+    counts = {"pending": 0, DELIVERED: 0, FAILED: 0, BLOCKED: 0}
+    counts.update({row['status']: row['n'] for row in cur.fetchall()})
+    return counts
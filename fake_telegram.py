@@ -0,0 +1,381 @@
+# fake_telegram.py - локальная заглушка Telegram Bot API (задержки, 429, ошибки)
+"""
+Поднимает aiohttp сервер, который отвечает на методы Bot API, используемые ботом
+(sendMessage, editMessageText, answerCallbackQuery, getChat, setWebhook и пара служебных),
+и позволяет воспроизводить медленный Telegram и шторм 429 без выхода в интернет.
+
+Запуск:
+    python fake_telegram.py --port 8081 --latency lognormal:80:0.6 --rate-limit 0.05
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 python app.py
+
+Распределения задержки (мс): const:50, uniform:20:200, normal:100:30,
+lognormal:<медиана>:<sigma>, exp:<среднее>. Для отдельных методов:
+    --method-latency sendMessage=uniform:100:400 --method-latency getChat=const:5
+
+Служебные маршруты:
+    GET  /_fake/stats    - счётчики и перцентили задержек по методам
+    POST /_fake/config   - изменить настройки на лету (JSON с теми же ключами, что у Config)
+    POST /_fake/reset    - сбросить статистику
+    POST /_fake/updates  - переслать Update (JSON) на вебхук, зарегистрированный через setWebhook
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field, asdict
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("fake_telegram")
+
+NOT_MODIFIED = (
+    "Bad Request: message is not modified: specified new message content and reply markup "
+    "are exactly the same as a current content and reply markup of the message"
+)
+
+
+# === РАСПРЕДЕЛЕНИЯ ЗАДЕРЖКИ ===
+def parse_latency(spec):
+    """Разбирает строку вида 'uniform:20:200' и возвращает функцию rng -> задержка в секундах."""
+    kind, _, rest = spec.partition(":")
+    args = [float(x) for x in rest.split(":") if x]
+    if kind == "const":
+        (ms,) = args or (0.0,)
+        return lambda rng: ms / 1000
+    if kind == "uniform":
+        lo, hi = args
+        return lambda rng: rng.uniform(lo, hi) / 1000
+    if kind == "normal":
+        mean, std = args
+        return lambda rng: max(0.0, rng.gauss(mean, std)) / 1000
+    if kind == "lognormal":
+        median, sigma = args
+        mu = math.log(median)
+        return lambda rng: rng.lognormvariate(mu, sigma) / 1000
+    if kind == "exp":
+        (mean,) = args
+        return lambda rng: rng.expovariate(1 / mean) / 1000
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+@dataclass
+class Config:
+    latency: str = "const:0"
+    method_latency: dict = field(default_factory=dict)  # {"sendMessage": "uniform:50:300"}
+    rate_limit: float = 0.0        # доля случайных ответов 429
+    retry_after: int = 3           # retry_after для 429
+    error_rate: float = 0.0        # доля ответов 500/502
+    global_rps: float = 0.0        # лимит запросов в секунду на весь бот (0 - без лимита)
+    chat_rps: float = 0.0          # лимит сообщений в секунду на чат (0 - без лимита)
+    seed: int = None
+
+    def samplers(self):
+        default = parse_latency(self.latency)
+        per_method = {m: parse_latency(s) for m, s in self.method_latency.items()}
+        return default, per_method
+
+
+class TokenBucket:
+    """Простой токен-бакет: rate токенов в секунду, ёмкость burst."""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self):
+        """Возвращает 0, если токен взят, иначе сколько секунд ждать."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class MethodStats:
+    __slots__ = ("calls", "ok", "rate_limited", "errors", "latencies")
+
+    def __init__(self):
+        self.calls = 0
+        self.ok = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=10000)
+
+    def as_dict(self):
+        data = sorted(self.latencies)
+
+        def pct(p):
+            if not data:
+                return None
+            return round(data[min(len(data) - 1, int(len(data) * p))] * 1000, 1)
+
+        return {
+            "calls": self.calls,
+            "ok": self.ok,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+        }
+
+
+class FakeTelegram:
+    """Состояние заглушки: сообщения по чатам, вебхук, лимиты и статистика."""
+
+    def __init__(self, config: Config):
+        self.stats = defaultdict(MethodStats)
+        self.messages = {}  # (chat_id, message_id) -> (text, reply_markup)
+        self.next_message_id = defaultdict(lambda: 1)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.next_update_id = 1
+        self.apply_config(config)
+
+    def apply_config(self, config: Config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.default_latency, self.method_latency = config.samplers()
+        self.global_bucket = TokenBucket(config.global_rps) if config.global_rps else None
+        self.chat_buckets = {}
+
+    # --- ответы в формате Bot API ---
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def fail(code, description, retry_after=None):
+        payload = {"ok": False, "error_code": code, "description": description}
+        if retry_after is not None:
+            payload["parameters"] = {"retry_after": retry_after}
+        return web.json_response(payload, status=code)
+
+    def bot_user(self, token):
+        bot_id = int(token.split(":", 1)[0]) if token.split(":", 1)[0].isdigit() else 1
+        return {"id": bot_id, "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"}
+
+    def throttle(self, method, params):
+        """Решает, отвечать ли 429: случайно или по превышению лимитов бота/чата."""
+        cfg = self.config
+        if cfg.rate_limit and self.rng.random() < cfg.rate_limit:
+            return cfg.retry_after
+        if self.global_bucket:
+            wait = self.global_bucket.take()
+            if wait:
+                return max(1, math.ceil(wait))
+        chat_id = params.get("chat_id")
+        if cfg.chat_rps and chat_id is not None and method == "sendMessage":
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(cfg.chat_rps, 1)
+            wait = bucket.take()
+            if wait:
+                return max(1, math.ceil(wait))
+        return None
+
+    # --- методы ---
+    def message(self, token, chat_id, message_id, text, reply_markup):
+        msg = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": self.bot_user(token),
+            "text": text,
+        }
+        if reply_markup:
+            msg["reply_markup"] = reply_markup
+        return msg
+
+    def call(self, token, method, params):
+        if method == "getMe":
+            return self.ok(self.bot_user(token))
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            logger.info(f"Вебхук зарегистрирован: {self.webhook_url}")
+            return self.ok(True)
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            return self.ok(True)
+        if method == "getWebhookInfo":
+            return self.ok({"url": self.webhook_url or "", "has_custom_certificate": False,
+                            "pending_update_count": 0})
+        if method == "answerCallbackQuery":
+            return self.ok(True)
+        if method == "getChat":
+            chat_id = int(params["chat_id"])
+            chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup",
+                    "accent_color_id": 0, "max_reaction_count": 11}
+            if chat_id > 0:
+                chat.update(first_name=f"User {chat_id}", username=f"user{chat_id}")
+            else:
+                chat["title"] = f"Chat {chat_id}"
+            return self.ok(chat)
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            message_id = self.next_message_id[chat_id]
+            self.next_message_id[chat_id] += 1
+            markup = params.get("reply_markup")
+            self.messages[(chat_id, message_id)] = (params.get("text"), markup)
+            return self.ok(self.message(token, chat_id, message_id, params.get("text"), markup))
+        if method == "editMessageText":
+            if params.get("inline_message_id"):
+                return self.ok(True)
+            chat_id = int(params["chat_id"])
+            message_id = int(params["message_id"])
+            key = (chat_id, message_id)
+            markup = params.get("reply_markup")
+            # Неизвестные сообщения (например, из пересланных апдейтов) считаем существующими
+            if self.messages.get(key) == (params.get("text"), markup):
+                return self.fail(400, NOT_MODIFIED)
+            self.messages[key] = (params.get("text"), markup)
+            return self.ok(self.message(token, chat_id, message_id, params.get("text"), markup))
+        return self.fail(404, "Not Found")
+
+    # --- HTTP ---
+    async def handle_method(self, request: web.Request) -> web.Response:
+        token = request.match_info["token"]
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        for key in ("reply_markup", "entities"):
+            if isinstance(params.get(key), str):
+                params[key] = json.loads(params[key])
+
+        stats = self.stats[method]
+        stats.calls += 1
+        started = time.monotonic()
+        sampler = self.method_latency.get(method, self.default_latency)
+        await asyncio.sleep(sampler(self.rng))
+
+        retry_after = self.throttle(method, params)
+        if retry_after is not None:
+            stats.rate_limited += 1
+            response = self.fail(429, f"Too Many Requests: retry after {retry_after}", retry_after)
+        elif self.config.error_rate and self.rng.random() < self.config.error_rate:
+            stats.errors += 1
+            code = self.rng.choice((500, 502))
+            response = self.fail(code, "Internal Server Error" if code == 500 else "Bad Gateway")
+        else:
+            response = self.call(token, method, params)
+            if response.status == 200:
+                stats.ok += 1
+            else:
+                stats.errors += 1
+        stats.latencies.append(time.monotonic() - started)
+        return response
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "config": asdict(self.config),
+            "webhook_url": self.webhook_url,
+            "methods": {m: s.as_dict() for m, s in sorted(self.stats.items())},
+        })
+
+    async def handle_config(self, request: web.Request) -> web.Response:
+        changes = await request.json()
+        try:
+            config = Config(**{**asdict(self.config), **changes})
+            self.apply_config(config)
+        except (TypeError, ValueError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        logger.info(f"Настройки заглушки изменены: {changes}")
+        return web.json_response(asdict(self.config))
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.stats.clear()
+        return web.json_response({"status": "ok"})
+
+    async def handle_updates(self, request: web.Request) -> web.Response:
+        """Отправляет Update на вебхук бота и возвращает статус и время ответа."""
+        if not self.webhook_url:
+            return web.json_response({"error": "Webhook is not set"}, status=409)
+        update = await request.json()
+        if "update_id" not in update:
+            update["update_id"] = self.next_update_id
+        self.next_update_id = max(self.next_update_id, update["update_id"]) + 1
+        headers = {}
+        if self.webhook_secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+        started = time.monotonic()
+        async with request.app["client"].post(self.webhook_url, json=update, headers=headers) as resp:
+            await resp.read()
+            status = resp.status
+        return web.json_response({
+            "update_id": update["update_id"],
+            "status": status,
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        })
+
+
+def create_app(config: Config) -> web.Application:
+    fake = FakeTelegram(config)
+    app = web.Application()
+    app["fake"] = fake
+
+    async def open_client(app):
+        app["client"] = ClientSession(timeout=ClientTimeout(total=60))
+
+    async def close_client(app):
+        await app["client"].close()
+
+    app.on_startup.append(open_client)
+    app.on_cleanup.append(close_client)
+    app.router.add_get("/_fake/stats", fake.handle_stats)
+    app.router.add_post("/_fake/config", fake.handle_config)
+    app.router.add_post("/_fake/reset", fake.handle_reset)
+    app.router.add_post("/_fake/updates", fake.handle_updates)
+    app.router.add_route("*", "/bot{token}/{method}", fake.handle_method)
+    return app
+
+
+def parse_args(argv=None):
+    env = os.getenv
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default=env("FAKE_TG_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(env("FAKE_TG_PORT", 8081)))
+    parser.add_argument("--latency", default=env("FAKE_TG_LATENCY", "const:0"))
+    parser.add_argument("--method-latency", action="append", default=[],
+                        help="метод=распределение, можно повторять")
+    parser.add_argument("--rate-limit", type=float, default=float(env("FAKE_TG_RATE_LIMIT", 0)))
+    parser.add_argument("--retry-after", type=int, default=int(env("FAKE_TG_RETRY_AFTER", 3)))
+    parser.add_argument("--error-rate", type=float, default=float(env("FAKE_TG_ERROR_RATE", 0)))
+    parser.add_argument("--global-rps", type=float, default=float(env("FAKE_TG_GLOBAL_RPS", 0)))
+    parser.add_argument("--chat-rps", type=float, default=float(env("FAKE_TG_CHAT_RPS", 0)))
+    parser.add_argument("--seed", type=int, default=int(env("FAKE_TG_SEED")) if env("FAKE_TG_SEED") else None)
+    args = parser.parse_args(argv)
+
+    method_specs = [s for s in env("FAKE_TG_METHOD_LATENCY", "").split(",") if s] + args.method_latency
+    method_latency = dict(spec.split("=", 1) for spec in method_specs)
+    config = Config(
+        latency=args.latency,
+        method_latency=method_latency,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        error_rate=args.error_rate,
+        global_rps=args.global_rps,
+        chat_rps=args.chat_rps,
+        seed=args.seed,
+    )
+    config.samplers()  # проверяем строки распределений до старта
+    return args, config
+
+
+if __name__ == "__main__":
+    args, config = parse_args()
+    logger.info(f"Заглушка Bot API на http://{args.host}:{args.port} ({config})")
+    web.run_app(create_app(config), host=args.host, port=args.port, print=None)
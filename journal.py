@@ -0,0 +1,165 @@
+# journal.py - локальный журнал изменений очереди и обедов на время недоступности Postgres
+"""
+Пока база недоступна, каждое изменение (встал/вышел из очереди, обед, запись в
+логе, очистка очереди) дописывается в локальный SQLite-файл. Когда база
+возвращается, записи проигрываются в исходном порядке с исходным временем.
+
+Проигрывание идемпотентно: op_id каждой записи вставляется в journal_applied в
+той же транзакции, что и само изменение, поэтому запись, применённая до сбоя
+процесса, при повторном проигрывании пропускается.
+
+apply_entry принимает курсор psycopg2 (RealDictCursor) и ничего не коммитит сам.
+"""
+import json
+import sqlite3
+import threading
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+Entry = namedtuple("Entry", "seq op_id op tg_id at data")
+
+# Сколько дней помнить применённые op_id (журнал столько точно не живёт)
+APPLIED_TTL_DAYS = 30
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS journal_applied (
+        op_id TEXT PRIMARY KEY,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+]
+
+
+def init_schema(cur):
+    for statement in SCHEMA:
+        cur.execute(statement)
+
+
+class Journal:
+    """Журнал в SQLite (WAL, synchronous=NORMAL): запись - микросекунды, без fsync
+    на каждую операцию; переживает перезапуск процесса, но не потерю диска."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op_id TEXT NOT NULL UNIQUE,
+                    op TEXT NOT NULL,
+                    tg_id INTEGER,
+                    at TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    applied INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_pending_idx ON entries (applied, seq)")
+            self._conn = conn
+        return self._conn
+
+    def append(self, op, tg_id, at: datetime, **data):
+        op_id = uuid.uuid4().hex
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO entries (op_id, op, tg_id, at, data) VALUES (?, ?, ?, ?, ?)",
+                (op_id, op, tg_id, at.isoformat(), json.dumps(data, ensure_ascii=False)),
+            )
+        return op_id
+
+    def pending(self, limit=500):
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT seq, op_id, op, tg_id, at, data FROM entries WHERE applied = 0 ORDER BY seq LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [Entry(seq, op_id, op, tg_id, datetime.fromisoformat(at), json.loads(data))
+                for seq, op_id, op, tg_id, at, data in rows]
+
+    def count_pending(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM entries WHERE applied = 0").fetchone()[0]
+
+    def mark_applied(self, seq):
+        with self._lock:
+            self._db().execute("UPDATE entries SET applied = 1 WHERE seq = ?", (seq,))
+
+    def compact(self):
+        """Удаляет проигранные записи."""
+        with self._lock:
+            self._db().execute("DELETE FROM entries WHERE applied = 1")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def apply_entry(cur, entry: Entry):
+    """Применяет запись журнала к базе. Возвращает (временный, настоящий) session_id
+    для проигранного начала обеда, иначе None. Повторно применённая запись - no-op."""
+    cur.execute(
+        "INSERT INTO journal_applied (op_id) VALUES (%s) ON CONFLICT DO NOTHING",
+        (entry.op_id,),
+    )
+    if not cur.rowcount:
+        return None
+    data = entry.data
+    if entry.op == "join":
+        cur.execute("""
+            INSERT INTO queue (tg_id, join_time, sort_key)
+            SELECT %(tg_id)s, %(at)s, COALESCE(%(key)s, (extract(epoch FROM %(at)s::timestamptz) * 1000000)::bigint)
+            WHERE NOT EXISTS (SELECT 1 FROM queue WHERE tg_id = %(tg_id)s)
+        """, {"tg_id": entry.tg_id, "at": entry.at, "key": data.get("sort_key")})
+    elif entry.op == "leave":
+        cur.execute("""
+            WITH gone AS (DELETE FROM queue WHERE tg_id = %s RETURNING tg_id, join_time)
+            INSERT INTO queue_exits (tg_id, join_time, exit_time, reason)
+            SELECT tg_id, join_time, %s, %s FROM gone
+        """, (entry.tg_id, entry.at, data["reason"]))
+    elif entry.op == "clear":
+        cur.execute("""
+            WITH gone AS (DELETE FROM queue WHERE join_time <= %(at)s RETURNING tg_id, join_time)
+            INSERT INTO queue_exits (tg_id, join_time, exit_time, reason)
+            SELECT tg_id, join_time, %(at)s, 'daily_clear' FROM gone
+        """, {"at": entry.at})
+    elif entry.op == "lunch_start":
+        cur.execute("""
+            INSERT INTO lunch_sessions (tg_id, start_time, date, return_key, allowed_seconds)
+            SELECT %(tg_id)s, %(at)s, %(date)s, %(return_key)s, %(allowed_seconds)s
+            WHERE NOT EXISTS (SELECT 1 FROM lunch_sessions WHERE tg_id = %(tg_id)s AND end_time IS NULL)
+            RETURNING session_id
+        """, {"tg_id": entry.tg_id, "at": entry.at, "date": data["date"], "return_key": data.get("return_key"),
+              "allowed_seconds": data.get("allowed_seconds")})
+        row = cur.fetchone()
+        if row:
+            return data["session_id"], row['session_id']
+    elif entry.op == "lunch_end":
+        cur.execute("""
+            UPDATE lunch_sessions SET end_time = %s
+            WHERE tg_id = %s AND end_time IS NULL AND start_time <= %s
+        """, (entry.at, entry.tg_id, entry.at))
+    elif entry.op == "log":
+        cur.execute("""
+            INSERT INTO logs (tg_id, courier_name, action, timestamp, formatted_time)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (entry.tg_id, data["courier_name"], data["action"], entry.at, data["formatted_time"]))
+    else:
+        raise ValueError(f"Неизвестная операция журнала: {entry.op}")
+    return None
+
+
+def prune_applied(cur):
+    cur.execute(
+        "DELETE FROM journal_applied WHERE applied_at < NOW() - %s * INTERVAL '1 day'",
+        (APPLIED_TTL_DAYS,),
+    )
@@ -0,0 +1,147 @@
+# logsetup.py - неблокирующее логирование: очередь в памяти и фоновый писатель
+"""
+Хендлеры и таймеры только кладут LogRecord в очередь (QueueHandler) - без
+форматирования и без записи в поток вывода. Текст сообщения (msg % args),
+JSON и запись в stderr делает поток QueueListener. Поэтому в горячем коде
+сообщения пишутся с аргументами, а не f-строкой:
+    logger.info("Курьер %s встал в очередь", tg_id)
+- тогда сборка строки тоже уходит в фоновый поток, а для выключенного
+уровня не происходит вовсе.
+
+Выборка (sampling): для шумных логгеров INFO и ниже пропускается одна запись
+из N (LOG_SAMPLE="aiogram.event=10,aiohttp.access=10"). WARNING и выше не
+выбрасываются никогда. Отброшенные записи считаются в SAMPLER.dropped.
+
+Формат - JSON по строке на запись (LOG_FORMAT=json) или прежний текстовый
+(LOG_FORMAT=text). Поля, переданные через extra=, попадают в JSON как есть.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from collections import defaultdict
+
+# Атрибуты LogRecord, которые не являются пользовательскими extra-полями
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, static=None):
+        super().__init__()
+        self.static = static or {}
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **self.static,
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает одну запись из N для логгеров из rates (уровень INFO и ниже)."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.seen = defaultdict(int)
+        self.dropped = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        every = self.rates.get(record.name)
+        if not every or every <= 1:
+            return True
+        self.seen[record.name] += 1
+        if self.seen[record.name] % every == 1:
+            return True
+        self.dropped[record.name] += 1
+        return False
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: запись уходит в очередь
+    как есть (очередь внутри процесса, сериализация не нужна)."""
+
+    def prepare(self, record):
+        return record
+
+
+def parse_sampling(spec):
+    """"aiogram.event=10,aiohttp.access=10" -> {"aiogram.event": 10, "aiohttp.access": 10}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, every = item.partition("=")
+        rates[name.strip()] = int(every)
+    return rates
+
+
+SAMPLER = SamplingFilter({})
+_listener = None
+_records = None
+
+
+def setup(level="INFO", fmt="json", sampling="", worker=None):
+    """(Пере)настраивает корневой логгер на очередь и запускает фоновый писатель.
+    Вызывается при импорте app.py и заново в каждом воркере после fork (поток
+    писателя через fork не переживает); worker - номер воркера в каждой записи."""
+    global _listener, _records
+    stop()
+    SAMPLER.rates = parse_sampling(sampling)
+    output = logging.StreamHandler(sys.stderr)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter(None if worker is None else {"worker": worker}))
+    else:
+        prefix = "" if worker is None else f"w{worker}:"
+        output.setFormatter(logging.Formatter(TEXT_FORMAT.replace("%(name)s", prefix + "%(name)s")))
+    records = _records = queue.SimpleQueue()
+    handler = _LazyQueueHandler(records)
+    handler.addFilter(SAMPLER)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """Дописывает всё, что осталось в очереди, и останавливает писатель."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def queue_depth():
+    """Сколько записей ждут писателя (растёт, если stderr не успевает)."""
+    return _records.qsize() if _records is not None else 0
+
+
+def set_level(name, level):
+    """Меняет уровень логгера на лету (name "" или "root" - корневой)."""
+    logger = logging.getLogger(None if name in ("", "root") else name)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    return logging.getLevelName(logger.level)
+
+
+def levels():
+    """Текущие явно заданные уровни: {"root": "INFO", "aiogram.event": "WARNING", ...}."""
+    result = {"root": logging.getLevelName(logging.getLogger().level)}
+    for name, logger in sorted(logging.root.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            result[name] = logging.getLevelName(logger.level)
+    return result
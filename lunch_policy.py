@@ -0,0 +1,132 @@
+# lunch_policy.py - правила обеда и счётчики обедов за смену
+"""
+Правила обеда: длительность, сколько раз за смену можно уйти на обед и когда
+начинается смена (время по часовому поясу точки). Смена длится сутки от этой
+границы: при SHIFT_START=01:00 обед в 00:30 относится к вчерашней смене.
+
+Значения по умолчанию задаются переменными окружения app.py, отличия для
+отдельных точек - одной строкой, общей для всех точек (каждая берёт своё по
+LOCATION):
+    "vainera:duration=30,max=3;malysheva:max=1,shift_start=08:00"
+duration - минуты, max - обедов за смену, shift_start - ЧЧ:ММ.
+
+LunchCounters - сколько обедов каждый курьер начал в текущей смене. Таблица
+живёт в памяти: при старте заполняется одним запросом, дальше увеличивается
+при каждом начатом обеде (в том числе без базы и у соседних воркеров) и
+очищается при первом обращении после границы смены. Проверка лимита - поиск
+в словаре, без запроса к базе.
+"""
+import threading
+from datetime import datetime, time, timedelta
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+
+class LunchPolicy(NamedTuple):
+    duration: int          # секунды
+    max_per_shift: int
+    shift_start: time      # граница смены, местное время точки
+    tz: ZoneInfo
+
+    @property
+    def duration_minutes(self):
+        return round(self.duration / 60)
+
+    def shift_day(self, moment):
+        """Дата смены, к которой относится момент (aware datetime)."""
+        local = moment.astimezone(self.tz)
+        return (local - timedelta(hours=self.shift_start.hour, minutes=self.shift_start.minute)).date()
+
+    def shift_started_at(self, moment):
+        return datetime.combine(self.shift_day(moment), self.shift_start, tzinfo=self.tz)
+
+    def remaining(self, start_time, now):
+        """Сколько секунд обеда, начатого в start_time, осталось к now."""
+        return int(max(0, self.duration - (now - start_time).total_seconds()))
+
+    def ends_at(self, start_time):
+        return start_time + timedelta(seconds=self.duration)
+
+
+def parse_time(value):
+    try:
+        hours, minutes = value.strip().split(":")
+        return time(int(hours), int(minutes))
+    except ValueError:
+        raise ValueError(f"время смены должно быть ЧЧ:ММ, а не {value!r}") from None
+
+
+_FIELDS = {
+    "duration": ("duration", lambda value: int(float(value) * 60)),
+    "max": ("max_per_shift", int),
+    "shift_start": ("shift_start", parse_time),
+}
+
+
+def parse_overrides(spec):
+    """"vainera:duration=30,max=3;malysheva:max=1" -> {"vainera": {"duration": 1800, "max_per_shift": 3}, ...}."""
+    overrides = {}
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        location, _, rules = item.partition(":")
+        fields = {}
+        for rule in filter(None, (part.strip() for part in rules.split(","))):
+            key, _, value = rule.partition("=")
+            if key.strip() not in _FIELDS:
+                raise ValueError(f"неизвестное правило {key.strip()!r} для точки {location.strip()!r}")
+            name, convert = _FIELDS[key.strip()]
+            fields[name] = convert(value)
+        overrides[location.strip()] = fields
+    return overrides
+
+
+def configure(tz, duration_minutes, max_per_shift, shift_start, location="", overrides=""):
+    """Правила для точки location: значения по умолчанию с её отличиями из overrides.
+    ValueError, если строка правил не разбирается или значения бессмысленны."""
+    policy = LunchPolicy(int(duration_minutes * 60), int(max_per_shift), parse_time(shift_start), ZoneInfo(tz))
+    policy = policy._replace(**parse_overrides(overrides).get(location, {}))
+    if policy.duration <= 0 or policy.max_per_shift < 0:
+        raise ValueError(f"длительность обеда должна быть больше нуля, лимит - не меньше нуля: {policy}")
+    return policy
+
+
+class LunchCounters:
+    """tg_id -> обедов начато в текущей смене; сбрасывается на границе смены."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.day = None
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def _roll(self, now):
+        day = self.policy.shift_day(now)
+        if day != self.day:
+            self.day = day
+            self.counts = {}
+
+    def count(self, tg_id, now):
+        with self._lock:
+            self._roll(now)
+            return self.counts.get(tg_id, 0)
+
+    def allowed(self, tg_id, now):
+        """Можно ли курьеру начать ещё один обед в этой смене."""
+        return self.count(tg_id, now) < self.policy.max_per_shift
+
+    def note(self, tg_id, at, now):
+        """Курьер начал обед в момент at (обеды прошлых смен не считаются)."""
+        with self._lock:
+            self._roll(now)
+            if self.policy.shift_day(at) == self.day:
+                self.counts[tg_id] = self.counts.get(tg_id, 0) + 1
+
+    def load(self, counts, now):
+        """Счётчики текущей смены из базы: {tg_id: обедов}. Обеды, отмеченные,
+        пока шёл запрос, не теряются - берётся большее."""
+        with self._lock:
+            self._roll(now)
+            for tg_id, count in counts.items():
+                self.counts[tg_id] = max(count, self.counts.get(tg_id, 0))
+
+    def __len__(self):
+        return len(self.counts)
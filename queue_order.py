@@ -0,0 +1,157 @@
+# queue_order.py - порядок очереди: ключ сортировки, дисциплины и индекс позиций
+"""
+Порядок в очереди задаёт ключ sort_key (BIGINT, колонка queue.sort_key):
+    sort_key = ранг класса * CLASS_STEP + время постановки в микросекундах
+Меньший ключ - ближе к кассе; при равных ключах раньше меньший tg_id. Классы
+(QUEUE_CLASSES="car,*,foot") - приоритет по порядку в списке: все "car" стоят
+перед всеми "foot", внутри класса - по времени. "*" - место курьеров без класса
+(по умолчанию - после всех перечисленных). Без классов ранг у всех 0 и порядок -
+обычный FIFO по времени постановки.
+
+Дисциплина (QUEUE_POLICY):
+    fifo         - вернувшийся с обеда встаёт в конец (своего класса);
+    return_slot  - возвращается на прежнее место: ключ, с которым курьер ушёл на
+                   обед, сохраняется в lunch_sessions.return_key и выдаётся снова.
+
+QueueIndex - упорядоченный индекс очереди в памяти (зеркало в app.py): skip-list
+с длинами ссылок, вставка, удаление и номер позиции - O(log n) в среднем.
+"""
+import random
+from datetime import datetime
+
+# Шаг ранга класса: время в микросекундах (~1.8e15 сейчас) в него помещается,
+# а BIGINT - ещё на 900 с лишним классов
+CLASS_STEP = 10 ** 16
+POLICIES = ("fifo", "return_slot")
+
+
+def time_key(at: datetime):
+    """Ключ FIFO: время в микросекундах от эпохи."""
+    return int(at.timestamp() * 1_000_000)
+
+
+class QueueDiscipline:
+    def __init__(self, policy="fifo", classes=""):
+        if policy not in POLICIES:
+            raise ValueError(f"неизвестная дисциплина очереди {policy!r}, есть: {', '.join(POLICIES)}")
+        self.policy = policy
+        names = [name.strip() for name in classes.split(",") if name.strip()]
+        if len(set(names)) != len(names):
+            raise ValueError(f"класс указан дважды: {classes!r}")
+        self.default_rank = names.index("*") if "*" in names else len(names)
+        self.ranks = {name: rank for rank, name in enumerate(names) if name != "*"}
+
+    @property
+    def return_to_slot(self):
+        return self.policy == "return_slot"
+
+    @property
+    def classes(self):
+        return list(self.ranks)
+
+    def rank(self, courier_class):
+        return self.ranks.get(courier_class, self.default_rank)
+
+    def key(self, at, courier_class=None, slot=None):
+        """Ключ для постановки в момент at; slot - ключ, с которым курьер ушёл на обед."""
+        if slot is not None and self.return_to_slot:
+            return slot
+        return self.rank(courier_class) * CLASS_STEP + time_key(at)
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, height):
+        self.key = key
+        self.next = [None] * height
+        self.width = [1] * height
+
+
+class QueueIndex:
+    """tg_id в порядке (sort_key, tg_id). Skip-list: на каждом уровне ссылка
+    помнит, сколько элементов она перепрыгивает, - из этого складывается позиция."""
+
+    MAX_HEIGHT = 24  # хватает на миллионы элементов
+
+    def __init__(self):
+        self.keys = {}  # tg_id -> sort_key
+        self.clear()
+
+    def clear(self):
+        self.keys.clear()
+        self._head = _Node(None, self.MAX_HEIGHT)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, tg_id):
+        return tg_id in self.keys
+
+    def __iter__(self):
+        node = self._head.next[0]
+        while node is not None:
+            yield node.key[1]
+            node = node.next[0]
+
+    def key(self, tg_id):
+        return self.keys.get(tg_id)
+
+    def _path(self, key):
+        """Для каждого уровня - последний узел перед key и его позиция (с 0 у головы)."""
+        path = [None] * self.MAX_HEIGHT
+        steps = [0] * self.MAX_HEIGHT
+        node, position = self._head, 0
+        for level in reversed(range(self.MAX_HEIGHT)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            path[level], steps[level] = node, position
+        return path, steps
+
+    def insert(self, tg_id, sort_key):
+        if tg_id in self.keys:
+            self.remove(tg_id)
+        key = (sort_key, tg_id)
+        height = 1
+        while height < self.MAX_HEIGHT and random.random() < 0.5:
+            height += 1
+        path, steps = self._path(key)
+        node = _Node(key, height)
+        position = steps[0] + 1  # позиция нового узла
+        for level in range(self.MAX_HEIGHT):
+            before = path[level]
+            if level < height:
+                node.next[level] = before.next[level]
+                # before перепрыгивал width; теперь до нового узла и от него дальше
+                node.width[level] = before.width[level] - (position - steps[level]) + 1
+                before.next[level] = node
+                before.width[level] = position - steps[level]
+            else:
+                before.width[level] += 1
+        self.keys[tg_id] = sort_key
+
+    def remove(self, tg_id):
+        """Убирает курьера; возвращает его ключ (None, если не стоял)."""
+        sort_key = self.keys.pop(tg_id, None)
+        if sort_key is None:
+            return None
+        key = (sort_key, tg_id)
+        path, _ = self._path(key)
+        target = path[0].next[0]
+        for level in range(self.MAX_HEIGHT):
+            before = path[level]
+            if before.next[level] is target:
+                before.width[level] += target.width[level] - 1
+                before.next[level] = target.next[level]
+            else:
+                before.width[level] -= 1
+        return sort_key
+
+    def rank(self, tg_id):
+        """Позиция в очереди с 1; 0 - не стоит."""
+        sort_key = self.keys.get(tg_id)
+        if sort_key is None:
+            return 0
+        _, steps = self._path((sort_key, tg_id))
+        return steps[0] + 1
@@ -0,0 +1,60 @@
+# records.py - типизированные строки данных: курьеры, очередь, обеды, логи
+"""
+Пул соединений по умолчанию отдаёт RealDictCursor: строка - словарь с ключами
+по именам колонок. Для данных, которые читаются часто и держатся в памяти
+(очередь, обеды, список курьеров, история логов), это лишний словарь на строку.
+Здесь такие запросы читаются обычным курсором psycopg2 (строка - кортеж), а
+кортеж сразу становится записью NamedTuple: поля по именам и типам, без
+__dict__ на экземпляр, без промежуточных копий строки.
+
+Колонки SELECT идут в порядке полей записи - так и надо писать запросы,
+читающие fetch_all/fetch_one; хвостовые поля со значением по умолчанию
+можно не выбирать.
+"""
+from datetime import datetime
+from itertools import starmap
+from typing import NamedTuple, Optional
+
+import psycopg2.extensions
+
+
+class Courier(NamedTuple):
+    tg_id: int
+    name: str
+
+
+class QueueEntry(NamedTuple):
+    tg_id: int
+    name: str
+    join_time: datetime
+    sort_key: Optional[int] = None  # ключ порядка (queue_order.py), если запрос его читает
+
+
+class LunchSession(NamedTuple):
+    session_id: int
+    tg_id: int
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    return_key: Optional[int] = None  # место в очереди до обеда (sort_key)
+    name: Optional[str] = None  # имя курьера, если запрос его читает
+
+
+class LogEntry(NamedTuple):
+    log_id: int
+    action: str
+    timestamp: datetime
+    formatted_timestamp: str
+
+
+def tuple_cursor(conn, name=None):
+    """Курсор, отдающий кортежи (name - серверный курсор)."""
+    return conn.cursor(name=name, cursor_factory=psycopg2.extensions.cursor)
+
+
+def fetch_all(cur, record):
+    return list(starmap(record, cur.fetchall()))
+
+
+def fetch_one(cur, record):
+    row = cur.fetchone()
+    return record(*row) if row is not None else None
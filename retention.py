@@ -0,0 +1,280 @@
+# retention.py - помесячное секционирование logs / lunch_sessions и архивация старых данных
+"""
+logs и lunch_sessions секционированы по месяцам (границы - начало месяца в
+бизнес-часовом поясе): запросы с условием по времени читают только нужные
+секции, а старый месяц удаляется целиком, без DELETE и VACUUM по всей таблице.
+
+Срок хранения задаётся для каждой таблицы отдельно (в месяцах, 0 - хранить всё).
+Перед удалением секция выгружается в ARCHIVE_DIR в CSV.gz; секция удаляется,
+только когда архив полностью записан на диск. orders и queue_exits не
+секционированы (строк там мало), для них старые строки архивируются и удаляются.
+
+Все функции принимают курсор psycopg2 (RealDictCursor); коммит - на вызывающем.
+"""
+import gzip
+import os
+from datetime import date
+
+# Ключ advisory-блокировки: создание секций и архивацию выполняет один процесс
+RETENTION_LOCK_KEY = 4_203_402
+
+# Секционированные таблицы: колонка времени, колонки в порядке исходной схемы
+# (первичный ключ обязан включать ключ секционирования) и индексы
+PARTITIONED = {
+    "logs": {
+        "column": "timestamp",
+        "ddl": """
+            log_id INTEGER NOT NULL,
+            tg_id BIGINT NOT NULL REFERENCES couriers(tg_id) ON DELETE CASCADE,
+            courier_name TEXT NOT NULL DEFAULT '',
+            action TEXT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            formatted_time TEXT,
+            PRIMARY KEY (log_id, timestamp)
+        """,
+        "id": "log_id",
+        "indexes": [
+            "CREATE INDEX IF NOT EXISTS logs_tg_id_timestamp_idx ON logs (tg_id, timestamp DESC, log_id DESC)",
+            "CREATE INDEX IF NOT EXISTS logs_timestamp_idx ON logs (timestamp)",
+        ],
+    },
+    "lunch_sessions": {
+        "column": "start_time",
+        "ddl": """
+            session_id INTEGER NOT NULL,
+            tg_id BIGINT NOT NULL REFERENCES couriers(tg_id) ON DELETE CASCADE,
+            start_time TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            end_time TIMESTAMPTZ,
+            date DATE DEFAULT CURRENT_DATE,
+            PRIMARY KEY (session_id, start_time)
+        """,
+        "id": "session_id",
+        "indexes": [
+            "CREATE INDEX IF NOT EXISTS lunch_sessions_end_time_idx ON lunch_sessions (end_time)",
+            # Незавершённые обеды: в старых секциях этот индекс пуст, поиск по ним - одна страница
+            "CREATE INDEX IF NOT EXISTS lunch_sessions_open_idx ON lunch_sessions (tg_id) WHERE end_time IS NULL",
+        ],
+    },
+}
+
+# Несекционированные таблицы: колонка, по которой строка считается старой
+ROW_ARCHIVED = {
+    "orders": "assigned_at",
+    "queue_exits": "exit_time",
+}
+
+ROW_ARCHIVE_BATCH = 10_000
+
+
+def _month_start(day: date, shift=0):
+    months = day.year * 12 + day.month - 1 + shift
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def _partition_name(table, month: date):
+    return f"{table}_y{month.year}m{month.month:02}"
+
+
+def _is_partitioned(cur, table):
+    cur.execute("""
+        SELECT c.relkind FROM pg_class c
+        WHERE c.oid = to_regclass(%s)
+    """, (table,))
+    row = cur.fetchone()
+    return row is not None and row['relkind'] == 'p'
+
+
+def _local_today(cur, tz):
+    cur.execute("SELECT (NOW() AT TIME ZONE %s)::date AS today", (tz,))
+    return cur.fetchone()['today']
+
+
+def ensure_partition(cur, table, month: date, tz):
+    """Создаёт секцию за месяц, если её ещё нет. Строки этого месяца, успевшие
+    попасть в секцию по умолчанию, переносятся в новую секцию."""
+    name = _partition_name(table, month)
+    cur.execute("SELECT to_regclass(%s) AS rel", (name,))
+    if cur.fetchone()['rel']:
+        return False
+    column = PARTITIONED[table]["column"]
+    bounds = {"lo": month, "hi": _month_start(month, 1), "tz": tz}
+    lo_hi = ("(%(lo)s::date)::timestamp AT TIME ZONE %(tz)s",
+             "(%(hi)s::date)::timestamp AT TIME ZONE %(tz)s")
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {table}_default
+            WHERE {column} >= {lo_hi[0]} AND {column} < {lo_hi[1]}
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """, bounds)
+    # Границы секции - литералы: вычисляем их заранее
+    cur.execute(f"SELECT {lo_hi[0]} AS lo, {lo_hi[1]} AS hi", bounds)
+    row = cur.fetchone()
+    cur.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+        (row['lo'], row['hi']),
+    )
+    return True
+
+
+def _convert_to_partitioned(cur, table, tz):
+    """Переносит обычную таблицу в секционированную с теми же колонками,
+    значениями и последовательностью идентификаторов."""
+    spec = PARTITIONED[table]
+    column, id_column = spec["column"], spec["id"]
+    legacy = f"{table}_legacy"
+    cur.execute("SELECT pg_get_serial_sequence(%s, %s) AS seq", (table, id_column))
+    sequence = cur.fetchone()['seq']
+    cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    cur.execute(f"CREATE TABLE {table} ({spec['ddl']}) PARTITION BY RANGE ({column})")
+    cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    cur.execute(f"SELECT MIN({column}) AS first FROM {legacy}")
+    first = cur.fetchone()['first']
+    if first is not None:
+        cur.execute("SELECT (%s AT TIME ZONE %s)::date AS day", (first, tz))
+        month = _month_start(cur.fetchone()['day'])
+        this_month = _month_start(_local_today(cur, tz))
+        while month <= this_month:
+            ensure_partition(cur, table, month, tz)
+            month = _month_start(month, 1)
+    cur.execute("SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position) AS cols "
+                "FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema()",
+                (table,))
+    columns = cur.fetchone()['cols']
+    cur.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}")
+    moved = cur.rowcount
+    if sequence:
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+    cur.execute(f"DROP TABLE {legacy}")
+    if sequence:
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN {id_column} SET DEFAULT nextval('{sequence}')")
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.{id_column}")
+    return moved
+
+
+def init_partitioning(cur, tz, months_ahead=2):
+    """Переводит logs и lunch_sessions на секции (однократно) и создаёт секции
+    на текущий и months_ahead следующих месяцев. Возвращает {таблица: перенесено строк}
+    для таблиц, которые были переведены сейчас."""
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (RETENTION_LOCK_KEY,))
+    converted = {}
+    for table, spec in PARTITIONED.items():
+        if not _is_partitioned(cur, table):
+            converted[table] = _convert_to_partitioned(cur, table, tz)
+        for statement in spec["indexes"]:
+            cur.execute(statement)
+    ensure_future_partitions(cur, tz, months_ahead)
+    return converted
+
+
+def ensure_future_partitions(cur, tz, months_ahead=2):
+    this_month = _month_start(_local_today(cur, tz))
+    created = []
+    for table in PARTITIONED:
+        for shift in range(months_ahead + 1):
+            month = _month_start(this_month, shift)
+            if ensure_partition(cur, table, month, tz):
+                created.append(_partition_name(table, month))
+    return created
+
+
+def _write_archive(cur, archive_dir, filename, query, params=None):
+    """COPY результата запроса в archive_dir/filename (CSV.gz). Файл появляется
+    под итоговым именем только после полной записи и fsync."""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, filename)
+    tmp_path = path + ".tmp"
+    copy_sql = cur.mogrify(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params).decode()
+    with open(tmp_path, "wb") as raw:
+        with gzip.open(raw, "wt", encoding="utf-8", newline="") as out:
+            cur.copy_expert(copy_sql, out)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _expired_partitions(cur, table, cutoff_month: date):
+    """Секции таблицы, целиком лежащие до cutoff_month, по возрастанию."""
+    cur.execute("""
+        SELECT child.relname AS name
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+        ORDER BY child.relname
+    """, (table,))
+    expired = []
+    for row in cur.fetchall():
+        name = row['name']
+        suffix = name[len(table) + 1:]
+        if len(suffix) != 8 or not suffix.startswith("y") or suffix[5] != "m":
+            continue  # секция по умолчанию
+        month = date(int(suffix[1:5]), int(suffix[6:8]), 1)
+        if month < cutoff_month:
+            expired.append((name, month))
+    return expired
+
+
+def archive_partitions(cur, table, keep_months, archive_dir, tz):
+    """Архивирует и удаляет секции старше keep_months полных месяцев (0 - ничего не делать).
+    Каждая секция - своя транзакция: выгрузка, затем DETACH и DROP."""
+    if keep_months <= 0:
+        return []
+    cutoff = _month_start(_local_today(cur, tz), -keep_months)
+    archived = []
+    for name, month in _expired_partitions(cur, table, cutoff):
+        path = _write_archive(cur, archive_dir, f"{table}_{month:%Y_%m}.csv.gz", f"SELECT * FROM {name}")
+        cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        cur.execute(f"DROP TABLE {name}")
+        cur.connection.commit()
+        archived.append(path)
+    return archived
+
+
+def archive_rows(cur, table, keep_months, archive_dir, tz):
+    """Для несекционированных таблиц: выгружает строки старше срока хранения
+    и удаляет их пачками. Возвращает число удалённых строк."""
+    if keep_months <= 0:
+        return 0
+    column = ROW_ARCHIVED[table]
+    cutoff_month = _month_start(_local_today(cur, tz), -keep_months)
+    params = {"cutoff": cutoff_month, "tz": tz}
+    where = f"{column} < (%(cutoff)s::date)::timestamp AT TIME ZONE %(tz)s"
+    cur.execute(f"SELECT COUNT(*) AS n FROM {table} WHERE {where}", params)
+    if not cur.fetchone()['n']:
+        return 0
+    _write_archive(cur, archive_dir, f"{table}_before_{cutoff_month:%Y_%m}.csv.gz",
+                   f"SELECT * FROM {table} WHERE {where}", params)
+    deleted = 0
+    while True:
+        cur.execute(f"""
+            DELETE FROM {table} WHERE ctid IN (
+                SELECT ctid FROM {table} WHERE {where} LIMIT %(batch)s
+            )
+        """, {**params, "batch": ROW_ARCHIVE_BATCH})
+        deleted += cur.rowcount
+        cur.connection.commit()
+        if cur.rowcount < ROW_ARCHIVE_BATCH:
+            return deleted
+
+
+def run_retention(cur, keep_months: dict, archive_dir, tz, months_ahead=2):
+    """Плановый прогон: секции наперёд, затем архивация по срокам хранения
+    {таблица: месяцев}. None - прогон уже идёт в другом процессе."""
+    cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (RETENTION_LOCK_KEY,))
+    if not cur.fetchone()['locked']:
+        return None
+    try:
+        report = {"created": ensure_future_partitions(cur, tz, months_ahead)}
+        cur.connection.commit()
+        for table in PARTITIONED:
+            report[table] = archive_partitions(cur, table, keep_months.get(table, 0), archive_dir, tz)
+        for table in ROW_ARCHIVED:
+            report[table] = archive_rows(cur, table, keep_months.get(table, 0), archive_dir, tz)
+        return report
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_LOCK_KEY,))
+        cur.connection.commit()
@@ -0,0 +1,173 @@
+# roster.py - массовая загрузка и выгрузка списка курьеров (CSV через COPY)
+"""
+Формат файла - CSV с заголовком: tg_id,name (UTF-8, разделитель запятая).
+
+Загрузка: файл потоком уходит через COPY во временную таблицу roster_staging
+(строки как есть, текстом), там же проверяется одним запросом, и корректные
+строки вливаются в couriers через INSERT ... ON CONFLICT DO UPDATE. Память не
+зависит от размера файла: ни Python, ни курсор не держат его целиком.
+Правила проверки - те же, что при регистрации в боте (имя и фамилия):
+    tg_id   - целое положительное число;
+    name    - минимум два слова, не длиннее NAME_MAX_LENGTH символов.
+При повторе tg_id в файле берётся последняя строка. Некорректные строки
+пропускаются (или, при strict, отменяют всю загрузку) и попадают в отчёт.
+
+Выгрузка: COPY (SELECT ...) TO STDOUT прямо в переданный файл.
+
+Функции принимают курсор psycopg2 и ничего не коммитят сами. Запуск из консоли:
+    python roster.py import couriers.csv [--strict] [--dry-run]
+    python roster.py export [couriers.csv]
+Бот подхватывает имена, загруженные из консоли, при следующем изменении очереди
+или рестарте; загрузка через /api/couriers/import обновляет их сразу.
+"""
+import argparse
+import json
+import os
+import sys
+
+import psycopg2
+
+NAME_MAX_LENGTH = 128
+# Сколько некорректных строк перечислять в отчёте (считаются все)
+ERROR_SAMPLE = 100
+COPY_CHUNK = 64 * 1024
+
+
+def import_csv(cur, source, strict=False, dry_run=False):
+    """Загружает CSV из source (файловый объект с read()) в couriers.
+    Возвращает отчёт; ValueError, если файл не разбирается как CSV tg_id,name."""
+    cur.execute("SET LOCAL client_encoding TO 'UTF8'")
+    cur.execute("""
+        CREATE TEMP TABLE roster_staging (
+            line_no BIGSERIAL,
+            tg_id TEXT,
+            name TEXT,
+            error TEXT
+        ) ON COMMIT DROP
+    """)
+    try:
+        cur.copy_expert(
+            "COPY roster_staging (tg_id, name) FROM STDIN WITH (FORMAT csv, HEADER true)",
+            source, size=COPY_CHUNK,
+        )
+    except psycopg2.DataError as e:
+        raise ValueError(f"{e.diag.message_primary} ({e.diag.context})") from e
+    total = cur.rowcount
+
+    cur.execute("""
+        UPDATE roster_staging SET error = CASE
+            WHEN btrim(coalesce(tg_id, '')) !~ '^0*[1-9][0-9]{0,17}$'
+                THEN 'tg_id должен быть целым положительным числом'
+            WHEN array_length(regexp_split_to_array(btrim(coalesce(name, '')), '\\s+'), 1) < 2
+                THEN 'нужны имя и фамилия'
+            WHEN length(btrim(name)) > %s
+                THEN 'имя длиннее ' || %s || ' символов'
+        END
+    """, (NAME_MAX_LENGTH, NAME_MAX_LENGTH))
+    cur.execute("""
+        SELECT line_no + 1 AS line, tg_id, error FROM roster_staging
+        WHERE error IS NOT NULL ORDER BY line_no LIMIT %s
+    """, (ERROR_SAMPLE,))
+    errors = [{"line": line, "tg_id": tg_id, "error": error} for line, tg_id, error in _tuples(cur)]
+    cur.execute("SELECT COUNT(*) FROM roster_staging WHERE error IS NOT NULL")
+    invalid = _scalar(cur)
+
+    report = {"rows": total, "invalid": invalid, "errors": errors,
+              "duplicates": 0, "inserted": 0, "updated": 0, "unchanged": 0, "applied": False}
+    if strict and invalid:
+        return report
+
+    # Одна строка на tg_id - последняя в файле; остальные считаем дубликатами
+    cur.execute("""
+        CREATE TEMP TABLE roster_valid ON COMMIT DROP AS
+        SELECT DISTINCT ON (btrim(tg_id)::bigint) btrim(tg_id)::bigint AS tg_id,
+               regexp_replace(btrim(name), '\\s+', ' ', 'g') AS name
+        FROM roster_staging
+        WHERE error IS NULL
+        ORDER BY btrim(tg_id)::bigint, line_no DESC
+    """)
+    valid = cur.rowcount
+    cur.execute("SELECT COUNT(*) FROM roster_staging WHERE error IS NULL")
+    report["duplicates"] = _scalar(cur) - valid
+    cur.execute("""
+        WITH upserted AS (
+            INSERT INTO couriers (tg_id, name)
+            SELECT tg_id, name FROM roster_valid
+            ON CONFLICT (tg_id) DO UPDATE SET name = EXCLUDED.name
+            WHERE couriers.name IS DISTINCT FROM EXCLUDED.name
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted) AS inserted, COUNT(*) FILTER (WHERE NOT inserted) AS updated
+        FROM upserted
+    """)
+    report["inserted"], report["updated"] = _tuples(cur)[0]
+    report["unchanged"] = valid - report["inserted"] - report["updated"]
+    report["applied"] = not dry_run
+    return report
+
+
+def export_csv(cur, target):
+    """Пишет список курьеров в target (файл с write()). Возвращает число строк."""
+    cur.execute("SET LOCAL client_encoding TO 'UTF8'")
+    cur.copy_expert(
+        "COPY (SELECT tg_id, name FROM couriers ORDER BY tg_id) TO STDOUT WITH (FORMAT csv, HEADER true)",
+        target, size=COPY_CHUNK,
+    )
+    return cur.rowcount
+
+
+def _tuples(cur):
+    # Модуль работает и с RealDictCursor приложения, и с обычным курсором CLI
+    return [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cur.fetchall()]
+
+
+def _scalar(cur):
+    return _tuples(cur)[0][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Загрузка и выгрузка списка курьеров (CSV: tg_id,name)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("import", help="загрузить CSV в couriers (upsert)")
+    load.add_argument("path", help="CSV-файл, '-' - stdin")
+    load.add_argument("--strict", action="store_true", help="при любой ошибке не загружать ничего")
+    load.add_argument("--dry-run", action="store_true", help="только проверить, ничего не менять")
+    dump = commands.add_parser("export", help="выгрузить couriers в CSV")
+    dump.add_argument("path", nargs="?", default="-", help="куда писать, по умолчанию stdout")
+    args = parser.parse_args(argv)
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        parser.error("DATABASE_URL не установлен")
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            if args.command == "export":
+                if args.path == "-":
+                    rows = export_csv(cur, sys.stdout.buffer)
+                else:
+                    with open(args.path, "wb") as f:
+                        rows = export_csv(cur, f)
+                print(f"Выгружено курьеров: {rows}", file=sys.stderr)
+                return 0
+            source = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+            try:
+                report = import_csv(cur, source, strict=args.strict, dry_run=args.dry_run)
+            except ValueError as e:
+                print(f"Файл не разобран: {e}", file=sys.stderr)
+                return 1
+            finally:
+                if source is not sys.stdin.buffer:
+                    source.close()
+        if report["applied"]:
+            conn.commit()
+        else:
+            conn.rollback()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0 if report["applied"] or args.dry_run else 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
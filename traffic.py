@@ -0,0 +1,455 @@
+# traffic.py - запись боевого трафика (вебхук и API кассы) и его проигрывание
+"""
+Запись (RECORD_PATH в app.py, по умолчанию выключена): каждый принятый апдейт
+вебхука и каждый вызов API кассы (/api/queue, /api/remove_courier,
+/api/call_courier) дописываются строкой JSON в файл - с временем прихода, а для
+кассы ещё со статусом и длительностью ответа. Хендлер только кладёт сырые
+данные в очередь; обезличивание, JSON и запись делает фоновый поток. При
+WEB_WORKERS > 1 у каждого воркера свой файл (RECORD_PATH.w<номер>).
+
+Обезличивание: id пользователей и чатов заменяются псевдонимами HMAC(соль, id) -
+у одного курьера псевдоним один и тот же во всех его апдейтах и вызовах кассы,
+но исходный id по нему не восстановить. Имена и username выбрасываются, текст
+сообщений (кроме команд) заменяется на "Курьер N" - так регистрация при
+проигрывании проходит как настоящая. Соль - RECORD_SALT или случайная на запуск
+(общая для воркеров). Токены и заголовки запросов не пишутся.
+
+Формат строки:
+    {"t": 1712.5, "k": "u", "u": {...апдейт...}}
+    {"t": 1712.5, "k": "h", "m": "POST", "p": "/api/call_courier", "b": {"tg_id": ...},
+     "s": 200, "d": 12.3, "i": 1}
+t - time.time() прихода, d - длительность ответа в мс, i - был Idempotency-Key.
+
+Проигрывание - против локального Postgres (DATABASE_URL, данные в нём меняются!)
+и заглушки Bot API (fake_telegram.py, поднимается здесь же):
+    python traffic.py traffic.jsonl [traffic.jsonl.w1 ...] [--speed 10] [--json]
+Апдейты идут прямо в dp.feed_update (по порядку для каждого курьера), вызовы
+кассы - HTTP-запросами в приложение app.create_app(). В отчёте по каждому виду
+событий - задержка (p50/p95/p99/max) и число запросов к БД на событие.
+При ускорении окна ограничения частоты нажатий и защиты от двойного клика кассы
+сжимаются во столько же раз; таймеры обедов идут в реальном времени, поэтому
+автовозврат с обеда проигрывается только на 1x.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import json
+import os
+import queue
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import psycopg2.extensions
+
+# Ключи, под которыми в апдейте лежат пользователи и чаты
+_PEOPLE = ("from", "chat", "user", "sender_chat")
+# Что остаётся от сообщения: без текста чужих сообщений, вложений и разметки
+_MESSAGE_FIELDS = ("message_id", "date", "chat", "from", "text")
+
+
+def worker_path(path, worker):
+    """Файл записи воркера: при нескольких воркерах у каждого свой."""
+    return path if worker is None else f"{path}.w{worker}"
+
+
+def pseudo_name(pseudo_id):
+    return f"Курьер {pseudo_id % 100000}"
+
+
+class Anonymizer:
+    def __init__(self, salt):
+        self.salt = salt
+
+    def pseudonym(self, value):
+        """Стабильный псевдоним id: 13 цифр, знак сохраняется (группы - отрицательные)."""
+        value = int(value)
+        digest = hmac.new(self.salt, str(abs(value)).encode(), hashlib.sha256).digest()
+        pseudo = 10 ** 12 + int.from_bytes(digest[:8], "big") % 10 ** 12
+        return -pseudo if value < 0 else pseudo
+
+    def _person(self, person):
+        pseudo = self.pseudonym(person["id"])
+        result = {"id": pseudo}
+        if "first_name" in person:
+            result["first_name"] = "Курьер"
+        for key in ("is_bot", "type"):
+            if key in person:
+                result[key] = person[key]
+        return result
+
+    def _message(self, message, own_text):
+        result = {key: message[key] for key in _MESSAGE_FIELDS if key in message}
+        for key in _PEOPLE:
+            if isinstance(result.get(key), dict):
+                result[key] = self._person(result[key])
+        text = result.pop("text", None)
+        if own_text and isinstance(text, str):
+            # Команды оставляем как есть (без аргументов), остальной текст - имя-псевдоним
+            if text.startswith("/"):
+                result["text"] = text.split()[0]
+            elif "from" in result:
+                result["text"] = pseudo_name(result["from"]["id"])
+        return result
+
+    def update(self, data):
+        result = {}
+        for key, event in data.items():
+            if not isinstance(event, dict):
+                result[key] = event
+            elif key in ("message", "edited_message"):
+                result[key] = self._message(event, own_text=True)
+            else:
+                event = dict(event)
+                for person in _PEOPLE:
+                    if isinstance(event.get(person), dict):
+                        event[person] = self._person(event[person])
+                if isinstance(event.get("message"), dict):
+                    # Сообщение бота под кнопкой: его текст - чужие имена из очереди
+                    event["message"] = self._message(event["message"], own_text=False)
+                result[key] = event
+        return result
+
+    def body(self, raw):
+        """Тело запроса кассы (байты) -> JSON с псевдонимом tg_id; не JSON - None."""
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            return None
+        if isinstance(body, dict) and "tg_id" in body:
+            try:
+                body = {**body, "tg_id": self.pseudonym(body["tg_id"])}
+            except (TypeError, ValueError):
+                pass  # некорректный tg_id - касса получит тот же 400
+        return body
+
+
+class Recorder:
+    """Очередь в памяти и фоновый поток, дописывающий строки в файл."""
+
+    def __init__(self, salt=None):
+        self.anonymizer = Anonymizer(salt or secrets.token_bytes(16))
+        self.path = None
+        self.written = 0
+        self._queue = None
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, args=(open(path, "a", encoding="utf-8"),),
+                                        name="traffic-recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Дописывает очередь и закрывает файл."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def update(self, data):
+        self._queue.put(("u", time.time(), data))
+
+    def http(self, started, method, path, body, status, duration, idempotent):
+        self._queue.put(("h", started, (method, path, body, status, duration, idempotent)))
+
+    def _entry(self, kind, at, payload):
+        if kind == "u":
+            return {"t": round(at, 3), "k": "u", "u": self.anonymizer.update(payload)}
+        method, path, body, status, duration, idempotent = payload
+        entry = {"t": round(at, 3), "k": "h", "m": method, "p": path, "s": status, "d": round(duration * 1000, 1)}
+        body = self.anonymizer.body(body) if body else None
+        if body is not None:
+            entry["b"] = body
+        if idempotent:
+            entry["i"] = 1
+        return entry
+
+    def _write(self, f):
+        with f:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                f.write(json.dumps(self._entry(*item), ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+                self.written += 1
+                if self._queue.empty():
+                    f.flush()
+
+
+def read(paths):
+    """Записи из всех файлов (воркеров), по времени прихода."""
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+# === ПОДСЧЁТ ЗАПРОСОВ К БД ===
+# Счётчик текущего события; asyncio.to_thread копирует контекст, поэтому запросы из
+# потоков попадают в счётчик события, которое их вызвало
+QUERIES = contextvars.ContextVar("replay_queries", default=None)
+
+
+class QueryTotals:
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.total += 1
+        counter = QUERIES.get()
+        if counter is not None:
+            counter[0] += 1
+
+
+TOTALS = QueryTotals()
+_counting_cursors = {}
+
+
+def _counting_cursor(factory):
+    cls = _counting_cursors.get(factory)
+    if cls is None:
+        class CountingCursor(factory):
+            def execute(self, query, vars=None):
+                TOTALS.count()
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                TOTALS.count()
+                return super().executemany(query, vars_list)
+
+            def copy_expert(self, sql, file, size=8192):
+                TOTALS.count()
+                return super().copy_expert(sql, file, size)
+
+        cls = _counting_cursors[factory] = CountingCursor
+    return cls
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Соединение, курсоры которого считают выполненные запросы (app.DB_CONNECTION_FACTORY)."""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _counting_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+
+# === ПРОИГРЫВАНИЕ ===
+def event_kind(entry):
+    if entry["k"] == "h":
+        return f"{entry['m']} {entry['p']}"
+    update = entry["u"]
+    if "callback_query" in update:
+        return f"callback {update['callback_query'].get('data')}"
+    message = update.get("message") or update.get("edited_message")
+    if message is not None:
+        text = message.get("text", "")
+        return f"message {text}" if text.startswith("/") else "message text"
+    return "update " + next((key for key in update if key != "update_id"), "?")
+
+
+def entry_user(entry):
+    if entry["k"] == "h":
+        tg_id = (entry.get("b") or {}).get("tg_id")
+        return tg_id if isinstance(tg_id, int) else None
+    for event in entry["u"].values():
+        if isinstance(event, dict):
+            person = event.get("from") or event.get("chat")
+            if isinstance(person, dict) and not person.get("is_bot"):
+                return person["id"]
+    return None
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def summarize(results):
+    """results - [(вид, задержка в с, запросов, ошибка?, записанная задержка в мс)]."""
+    by_kind = defaultdict(list)
+    for result in results:
+        by_kind[result[0]].append(result)
+    report = {}
+    for kind, rows in sorted(by_kind.items()):
+        latencies = [row[1] * 1000 for row in rows]
+        queries = [row[2] for row in rows]
+        recorded = [row[4] for row in rows if row[4] is not None]
+        report[kind] = {
+            "count": len(rows),
+            "errors": sum(1 for row in rows if row[3]),
+            "p50_ms": round(percentile(latencies, 0.5), 1),
+            "p95_ms": round(percentile(latencies, 0.95), 1),
+            "p99_ms": round(percentile(latencies, 0.99), 1),
+            "max_ms": round(max(latencies), 1),
+            "queries_avg": round(sum(queries) / len(queries), 2),
+            "queries_max": max(queries),
+        }
+        if recorded:
+            report[kind]["recorded_p50_ms"] = round(percentile(recorded, 0.5), 1)
+    return report
+
+
+def print_report(report, totals):
+    header = f"{'событие':<32} {'n':>6} {'ош.':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'БД/соб.':>8} {'запись p50':>11}"
+    print(header)
+    print("-" * len(header))
+    for kind, row in report.items():
+        recorded = row.get("recorded_p50_ms")
+        print(f"{kind[:32]:<32} {row['count']:>6} {row['errors']:>4} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+              f"{row['p99_ms']:>8} {row['max_ms']:>8} {row['queries_avg']:>8} {'' if recorded is None else recorded:>11}")
+    print(f"\nСобытий: {totals['events']}, за {totals['elapsed_s']} с; запросов к БД всего: "
+          f"{totals['queries']} (из них фоновых, вне событий: {totals['background_queries']})")
+
+
+async def replay(paths, speed, seed_couriers=True):
+    entries = read(paths)
+    if not entries:
+        raise SystemExit("Нет записей для проигрывания")
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+    import fake_telegram
+
+    # Заглушка Bot API - до импорта app: адрес читается при импорте
+    fake_runner = web.AppRunner(fake_telegram.create_app(fake_telegram.Config()))
+    await fake_runner.setup()
+    fake_site = web.TCPSite(fake_runner, "127.0.0.1", 0)
+    await fake_site.start()
+    host, port = fake_runner.addresses[0][:2]
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    os.environ.update({
+        "TELEGRAM_API_BASE": f"http://{host}:{port}",
+        "JOURNAL_PATH": os.path.join(workdir, "journal.sqlite3"),
+        "RECORD_PATH": "",
+        "WEB_WORKERS": "1",
+    })
+    os.environ.setdefault("BOT_TOKEN", "123456:replay")
+    os.environ.setdefault("CALL_CHAT_ID", "-100")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import app
+    from aiogram.types import Update
+
+    app.DB_CONNECTION_FACTORY = CountingConnection
+    if speed > 0:
+        app.RATE_LIMITER.limits = {kind: (burst, per / speed) for kind, (burst, per) in app.RATE_LIMITER.limits.items()}
+        app.CASHIER_DEDUP_WINDOW /= speed
+    await app.start_db()
+    users = {user for user in map(entry_user, entries) if user is not None and user > 0}
+    if seed_couriers and users:
+        def seed():
+            with app.get_db() as conn:
+                with conn.cursor() as cur:
+                    cur.executemany(
+                        "INSERT INTO couriers (tg_id, name) VALUES (%s, %s) ON CONFLICT (tg_id) DO NOTHING",
+                        [(user, pseudo_name(user)) for user in users],
+                    )
+        await asyncio.to_thread(seed)
+    await app.warm_up_caches()
+
+    counters = {}
+
+    @web.middleware
+    async def attribute_queries(request, handler):
+        # Запрос обслуживается в задаче сервера: счётчик события передаём заголовком
+        QUERIES.set(counters.get(request.headers.get("X-Replay-Event")))
+        return await handler(request)
+
+    web_app = app.create_app()
+    web_app.middlewares.insert(0, attribute_queries)
+    client = TestClient(TestServer(web_app))
+    await client.start_server()
+
+    locks = defaultdict(asyncio.Lock)
+    results = []
+    background_before = TOTALS.total
+
+    async def run(index, entry):
+        counter = counters[str(index)] = [0]
+        QUERIES.set(counter)
+        error, recorded = False, None
+        user = entry_user(entry)
+        async with locks[user] if user is not None else asyncio.Lock():
+            started = time.perf_counter()
+            try:
+                if entry["k"] == "u":
+                    update = Update.model_validate(entry["u"], context={"bot": app.bot})
+                    await app.dp.feed_update(app.bot, update)
+                else:
+                    recorded = entry["d"]
+                    headers = {"X-Replay-Event": str(index)}
+                    if entry.get("i"):
+                        headers["Idempotency-Key"] = str(uuid.uuid4())
+                    async with client.request(entry["m"], entry["p"], json=entry.get("b"), headers=headers) as resp:
+                        await resp.read()
+                        error = resp.status >= 500 or resp.status != entry["s"]
+            except Exception as e:
+                error = True
+                print(f"Событие {index} ({event_kind(entry)}): {e}", file=sys.stderr)
+            elapsed = time.perf_counter() - started
+        results.append((event_kind(entry), elapsed, counter[0], error, recorded))
+
+    loop = asyncio.get_running_loop()
+    first, started = entries[0]["t"], loop.time()
+    tasks = []
+    for index, entry in enumerate(entries):
+        if speed > 0:
+            delay = (entry["t"] - first) / speed - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run(index, entry)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - started
+
+    attributed = sum(result[2] for result in results)
+    totals = {
+        "events": len(results),
+        "elapsed_s": round(elapsed, 2),
+        "queries": TOTALS.total - background_before,
+        "background_queries": TOTALS.total - background_before - attributed,
+    }
+    await client.close()
+    if app.DB_POOL is not None:
+        app.DB_POOL.closeall()
+    await fake_runner.cleanup()
+    return summarize(results), totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проигрывание записанного трафика бота и кассы")
+    parser.add_argument("paths", nargs="+", help="файлы записи (RECORD_PATH, RECORD_PATH.w<N>)")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение (1 - как было, 0 - без пауз)")
+    parser.add_argument("--no-seed", action="store_true", help="не добавлять курьеров-псевдонимов в couriers (регистрация пойдёт через бота)")
+    parser.add_argument("--json", action="store_true", help="отчёт в JSON")
+    args = parser.parse_args(argv)
+    if not os.getenv("DATABASE_URL"):
+        parser.error("DATABASE_URL не установлен (нужна локальная база - данные в ней меняются)")
+    if args.speed < 0:
+        parser.error("--speed не может быть отрицательным")
+    report, totals = asyncio.run(replay(args.paths, args.speed, seed_couriers=not args.no_seed))
+    if args.json:
+        print(json.dumps({"kinds": report, **totals}, ensure_ascii=False, indent=2))
+    else:
+        print_report(report, totals)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())